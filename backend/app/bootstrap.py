@@ -0,0 +1,84 @@
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from . import migrations, models
+from .passwords import password_hasher
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Every worker process imports the app, so schema migrations and seeding the
+# admin user run under a lock: the first worker does the work and the others
+# wait for it, then find nothing left to do. PostgreSQL uses an advisory
+# lock, which also covers workers on other hosts; anything else uses a lock
+# file, next to the database for SQLite.
+ADVISORY_LOCK_ID = 0x616C6973  # "alis"
+
+
+def lock_file_path(engine) -> str:
+    path = os.getenv("STARTUP_LOCK_FILE")
+    if path:
+        return path
+    database = engine.url.database
+    if engine.dialect.name == "sqlite" and database not in (None, "", ":memory:"):
+        return database + ".lock"
+    return os.path.join(tempfile.gettempdir(), "alist-image-api.lock")
+
+
+@contextmanager
+def startup_lock(engine):
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+                conn.commit()
+        return
+
+    with open(lock_file_path(engine), "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    # Retries for about ten seconds before raising
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def seed_admin(engine):
+    with Session(engine) as db:
+        if db.scalar(select(models.User.id).where(models.User.username == "admin")) is not None:
+            return
+        logger.info("Creating the default admin user")
+        db.add(models.User(username="admin", hashed_password=password_hasher.hash_now("admin"), is_admin=True))
+        db.commit()
+
+
+def run(engine):
+    with startup_lock(engine):
+        migrations.upgrade(engine)
+        seed_admin(engine)
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+from . import http_cache
+from .counts import image_counts
+from .database import AsyncSessionLocal
+from .pools import candidate_pools
+from .shared import shared_state
+from .tag_index import tag_index
+from .user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# In-memory state to update after a committed write. Each function patches
+# this worker's tag index, candidate pools and caches, then publishes the
+# change so the other workers apply it too (see shared.py). Image counts
+# are the exception: the writing worker adjusts them exactly around its
+# commit, while the others simply drop that user's counts. Listing ETag
+# versions move once the change is published (see http_cache.py). Payloads
+# are plain ids so any backend can carry them as JSON.
+
+
+async def _publish_image_change(owner_id: int, name: str, **payload):
+    # Listings move on once the change has its place on the feed
+    position = await shared_state.publish(name, owner_id=owner_id, **payload)
+    http_cache.image_versions.bump(owner_id, position)
+
+def _applied_image_change(owner_id: int):
+    image_counts.forget_user(owner_id)
+    http_cache.image_versions.bump(owner_id, shared_state.position)
+
+
+def _images_added(owner_id: int, image_ids: list[int], tag_ids: list[int]):
+    tag_ids = set(tag_ids)
+    tag_index.images_added(image_ids, owner_id, tag_ids)
+    for image_id in image_ids:
+        candidate_pools.image_added(image_id, tag_ids)
+
+async def images_added(owner_id: int, image_ids: list[int], tag_ids):
+    _images_added(owner_id, image_ids, tag_ids)
+    await _publish_image_change(owner_id, "images_added", image_ids=list(image_ids), tag_ids=list(tag_ids))
+
+@shared_state.handler("images_added")
+def _apply_images_added(owner_id: int, image_ids: list[int], tag_ids: list[int]):
+    _applied_image_change(owner_id)
+    _images_added(owner_id, image_ids, tag_ids)
+
+
+def _images_removed(owner_id: int, image_tags: dict[int, set[int]]):
+    tag_index.images_removed(list(image_tags), owner_id, set().union(*image_tags.values()))
+    candidate_pools.images_removed(image_tags)
+
+async def images_removed(owner_id: int, image_tags: dict[int, set[int]]):
+    # image_tags maps each deleted image id to its tag ids
+    _images_removed(owner_id, image_tags)
+    await _publish_image_change(owner_id, "images_removed",
+                                images=[[image_id, list(tag_ids)] for image_id, tag_ids in image_tags.items()])
+
+@shared_state.handler("images_removed")
+def _apply_images_removed(owner_id: int, images: list[list]):
+    _applied_image_change(owner_id)
+    _images_removed(owner_id, {image_id: set(tag_ids) for image_id, tag_ids in images})
+
+
+def _image_retagged(owner_id: int, image_id: int, old_tag_ids: list[int], new_tag_ids: list[int]):
+    old_tag_ids, new_tag_ids = set(old_tag_ids), set(new_tag_ids)
+    tag_index.images_retagged([image_id], old_tag_ids, new_tag_ids)
+    candidate_pools.image_retagged(image_id, old_tag_ids, new_tag_ids)
+
+async def image_retagged(owner_id: int, image_id: int, old_tag_ids, new_tag_ids):
+    _image_retagged(owner_id, image_id, old_tag_ids, new_tag_ids)
+    await _publish_image_change(owner_id, "image_retagged", image_id=image_id,
+                                old_tag_ids=list(old_tag_ids), new_tag_ids=list(new_tag_ids))
+
+@shared_state.handler("image_retagged")
+def _apply_image_retagged(owner_id: int, image_id: int, old_tag_ids: list[int], new_tag_ids: list[int]):
+    _applied_image_change(owner_id)
+    _image_retagged(owner_id, image_id, old_tag_ids, new_tag_ids)
+
+
+def _images_retagged(owner_id: int, image_ids: list[int], removed_tag_ids: list[int], added_tag_ids: list[int]):
+    removed_tag_ids, added_tag_ids = set(removed_tag_ids), set(added_tag_ids)
+    tag_index.images_retagged(image_ids, removed_tag_ids, added_tag_ids)
+    candidate_pools.tags_changed(removed_tag_ids | added_tag_ids)
+
+async def images_retagged(owner_id: int, image_ids: list[int], removed_tag_ids, added_tag_ids):
+    _images_retagged(owner_id, image_ids, removed_tag_ids, added_tag_ids)
+    await _publish_image_change(owner_id, "images_retagged", image_ids=list(image_ids),
+                                removed_tag_ids=list(removed_tag_ids), added_tag_ids=list(added_tag_ids))
+
+@shared_state.handler("images_retagged")
+def _apply_images_retagged(owner_id: int, image_ids: list[int], removed_tag_ids: list[int], added_tag_ids: list[int]):
+    _applied_image_change(owner_id)
+    _images_retagged(owner_id, image_ids, removed_tag_ids, added_tag_ids)
+
+
+async def images_renamed(owner_id: int):
+    # Only counts filtered by filename change, and this worker has those
+    await _publish_image_change(owner_id, "images_renamed")
+
+@shared_state.handler("images_renamed")
+def _apply_images_renamed(owner_id: int):
+    _applied_image_change(owner_id)
+
+
+def _api_key_changed(owner_id: int, key: str):
+    # Cached pools carry the key's settings
+    candidate_pools.discard(key)
+
+async def api_key_changed(owner_id: int, key: str):
+    _api_key_changed(owner_id, key)
+    position = await shared_state.publish("api_key_changed", owner_id=owner_id, key=key)
+    http_cache.api_key_versions.bump(owner_id, position)
+
+@shared_state.handler("api_key_changed")
+def _apply_api_key_changed(owner_id: int, key: str):
+    _api_key_changed(owner_id, key)
+    http_cache.api_key_versions.bump(owner_id, shared_state.position)
+
+
+@shared_state.handler("user_changed")
+def _user_changed(user_id: int, deleted: bool):
+    user_cache.invalidate(user_id)
+    if deleted:
+        image_counts.forget_user(user_id)
+
+async def user_changed(user_id: int, deleted: bool = False):
+    _user_changed(user_id, deleted)
+    await shared_state.publish("user_changed", user_id=user_id, deleted=deleted)
+
+
+_rebuild_task = None
+
+@shared_state.handler("resync")
+def _resync():
+    # Changes from other workers were missed, so nothing cached can be
+    # trusted: drop it all and reload the tag index
+    global _rebuild_task
+    candidate_pools.clear()
+    image_counts.clear()
+    user_cache.clear()
+    http_cache.reset_versions(shared_state.position)
+    if tag_index.enabled and (_rebuild_task is None or _rebuild_task.done()):
+        _rebuild_task = asyncio.get_running_loop().create_task(_rebuild_tag_index())
+
+async def _rebuild_tag_index():
+    try:
+        async with AsyncSessionLocal() as db:
+            await tag_index.build(db)
+    except Exception:
+        logger.exception("Rebuilding the tag index failed")
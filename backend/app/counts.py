@@ -0,0 +1,154 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Cached image totals per (user, tag filter, text filters), kept in step
+# with writes instead of re-counting on every gallery page.
+#
+# Each user has a version that every write bumps twice: once before its
+# commit and once after. A count is stored with the version read before it
+# was queried, and is exact only while the version is unchanged. After a
+# commit, entries that were exact before the write started are adjusted by
+# the write's known delta; anything the write cannot account for (filename
+# filters, unknown tags) is left stale, where total=estimate can still use it.
+class ImageCounts:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._versions: dict[int, int] = {}
+        self._writing: dict[int, int] = {}
+        self._counts: dict[int, OrderedDict] = {}
+        self._lock = threading.Lock()
+
+    def version(self, user_id: int) -> int:
+        return self._versions.get(user_id, 0)
+
+    def token(self, user_id: int):
+        # Read before counting. None while a write is committing, because the
+        # count may or may not include it.
+        with self._lock:
+            if self._writing.get(user_id):
+                return None
+            return self.version(user_id)
+
+    def get(self, user_id: int, key, stale_ok: bool = False):
+        with self._lock:
+            entry = self._counts.get(user_id, {}).get(key)
+            if entry is not None:
+                version, count = entry
+                if version == self.version(user_id):
+                    self.hits += 1
+                    return count
+                if stale_ok:
+                    self.stale_hits += 1
+                    return count
+            self.misses += 1
+            return None
+
+    def put(self, user_id: int, key, count: int, token):
+        with self._lock:
+            # A write that began after the token may be in the count already
+            if token is None or token != self.version(user_id):
+                return
+            counts = self._counts.setdefault(user_id, OrderedDict())
+            counts[key] = (token, count)
+            counts.move_to_end(key)
+            while len(counts) > self.maxsize:
+                counts.popitem(last=False)
+
+    @contextmanager
+    def change(self, user_id: int):
+        # Wrap the commit of a write to user_id's images and record what it
+        # did on the yielded ImageCountChange.
+        with self._lock:
+            base = self.version(user_id)
+            self._versions[user_id] = base + 1
+            self._writing[user_id] = self._writing.get(user_id, 0) + 1
+        change = ImageCountChange()
+        try:
+            yield change
+        except BaseException:
+            change.adjust = None
+            raise
+        finally:
+            with self._lock:
+                self._writing[user_id] -= 1
+                if not self._writing[user_id]:
+                    del self._writing[user_id]
+                # Only entries nobody else has touched since base are exact
+                fresh = self.version(user_id) == base + 1
+                version = self.version(user_id) + 1
+                self._versions[user_id] = version
+                counts = self._counts.get(user_id, {})
+                if fresh and change.adjust is not None:
+                    for key, (entry_version, count) in counts.items():
+                        if entry_version != base:
+                            continue
+                        # Any text filter counts as filename_like here
+                        tags, *text_filters = key
+                        count = change.adjust(tags, any(text_filters), count)
+                        if count is not None:
+                            counts[key] = (version, count)
+
+    def forget_user(self, user_id: int):
+        with self._lock:
+            self._counts.pop(user_id, None)
+            self._versions[user_id] = self.version(user_id) + 1
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            for user_id in self._versions:
+                self._versions[user_id] += 1
+
+    def stats(self):
+        return {
+            "users": len(self._counts),
+            "entries": sum(len(counts) for counts in self._counts.values()),
+            "maxsize_per_user": self.maxsize,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
+
+
+class ImageCountChange:
+    # adjust(tags, filename_like, count) returns the new count for a filter,
+    # or None when the write's effect on it is unknown
+    def __init__(self):
+        self.adjust = None
+
+    def added(self, tag_names, images: int = 1):
+        tag_names = frozenset(tag_names)
+        self.adjust = lambda tags, filename_like, count: None if filename_like else count + images * (tags <= tag_names)
+
+    def removed(self, tag_names=None, images: int = 1):
+        # Without tag_names only the unfiltered total can be kept
+        tag_names = None if tag_names is None else frozenset(tag_names)
+
+        def adjust(tags, filename_like, count):
+            if filename_like or (tags and tag_names is None):
+                return None
+            return count - images * (tag_names is None or tags <= tag_names)
+        self.adjust = adjust
+
+    def retagged(self, old_tag_names=None, new_tag_names=None):
+        if old_tag_names is None or new_tag_names is None:
+            self.adjust = lambda tags, filename_like, count: None if tags else count
+            return
+        old_tag_names, new_tag_names = frozenset(old_tag_names), frozenset(new_tag_names)
+
+        def adjust(tags, filename_like, count):
+            if filename_like and tags:
+                return None
+            return count + (tags <= new_tag_names) - (tags <= old_tag_names)
+        self.adjust = adjust
+
+    def renamed(self):
+        self.adjust = lambda tags, filename_like, count: None if filename_like else count
+
+
+image_counts = ImageCounts(int(os.getenv("IMAGE_COUNT_CACHE_SIZE", 100)))
@@ -0,0 +1,453 @@
+import asyncio
+import logging
+import os
+import posixpath
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import httpx
+from sqlalchemy import and_, case, or_, select, update
+
+from . import crud, models
+from .database import AsyncSessionLocal
+from .shared import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Server-side import of an AList directory tree.
+#
+# A crawl job walks the tree under its root through AList's fs/list API,
+# listing up to CRAWL_CONCURRENCY directories at once on the pooled upstream
+# client. Each listed page of images goes straight to crud.import_images, so
+# memory is bounded by the page size however big the tree is. The
+# directories left to list, with the next page of those being listed, are
+# the job's checkpoint, saved every CRAWL_CHECKPOINT_SECONDS: a pass that
+# stops for any reason carries on from there, and since imports skip known
+# URLs, redoing a page is harmless.
+#
+# After a completed pass the next one is incremental. It still lists every
+# directory, as a directory's modified time does not change with its
+# subdirectories, but only imports files modified since the last pass
+# started, or every file of a directory that itself changed or is new,
+# because a file copied in keeps its old modified time. Known files that
+# changed are dropped from the disk cache so their new bytes get fetched.
+#
+# A job is run by the worker that claims its row; saving the checkpoint is
+# its heartbeat, and a job whose worker stopped saving gets taken over.
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".svg", ".avif", ".heic", ".heif", ".tif", ".tiff", ".ico"}
+IMAGE_TYPE = 5  # AList's file type for images
+RETRIES = 3
+MAX_FAILED_DIRECTORIES = 20
+
+
+class AListError(Exception):
+    def __init__(self, message: str, code=None):
+        super().__init__(message)
+        self.code = code
+
+    @property
+    def fatal(self) -> bool:
+        # A bad token or password fails every other listing too
+        return self.code in (401, 403)
+
+
+def parse_modified(value):
+    # AList sends RFC 3339 times, and the zero time when a storage has none
+    try:
+        timestamp = datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return timestamp if timestamp > 0 else None
+
+
+def is_image(entry: dict) -> bool:
+    return entry.get("type") == IMAGE_TYPE or os.path.splitext(entry.get("name", ""))[1].lower() in IMAGE_EXTENSIONS
+
+
+def new_progress():
+    return {"directories": 0, "pages": 0, "files": 0, "imported": 0, "changed": 0, "skipped": 0, "errors": 0, "failed_directories": []}
+
+
+class CrawlRun:
+    # One pass over a job's tree, in the worker that claimed it
+    def __init__(self, crawler, job: models.CrawlJob, checkpoint: dict, progress: dict):
+        self.crawler = crawler
+        self.job_id = job.id
+        self.owner_id = job.owner_id
+        self.base_url = job.base_url.rstrip("/")
+        self.root = job.root
+        self.token = job.token
+        self.password = job.password
+        self.tags = list(job.tags or [])
+        self.path_tags = job.path_tags
+        self.concurrency = job.concurrency or crawler.concurrency
+        self.since = checkpoint["since"]
+        self.started_at = checkpoint["started_at"]
+        # path -> [next page, whether the directory changed since the last pass]
+        self.pending = {path: [page, changed] for path, page, changed in checkpoint["pending"]}
+        self.progress = progress
+        self.error = None
+        self.stop_status = None
+        self.task: asyncio.Task | None = None
+        self._seen = set(self.pending)
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._stopped = asyncio.Event()
+        self._imports: set[asyncio.Task] = set()
+
+    def checkpoint(self):
+        return {"since": self.since, "started_at": self.started_at,
+                "pending": [[path, page, changed] for path, (page, changed) in self.pending.items()]}
+
+    def report(self):
+        return {**self.progress, "pending": len(self.pending), "started_at": self.started_at, "updated_at": time.time()}
+
+    def stop(self, status: str):
+        # "cancelled", or "lost" when another worker took the job over
+        self.stop_status = status
+        self._stopped.set()
+
+    async def run(self):
+        # Returns the status to record, or None when the job is no longer ours
+        for path in self.pending:
+            self._queue.put_nowait(path)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        waiters = [asyncio.create_task(self._queue.join()), asyncio.create_task(self._heartbeat()), asyncio.create_task(self._stopped.wait())]
+        try:
+            # Workers only return on an error that stops the whole job
+            await asyncio.wait([*workers, *waiters], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in [*workers, *waiters]:
+                task.cancel()
+            await asyncio.gather(*workers, *waiters, return_exceptions=True)
+            # Imports are shielded, so a stopped pass never leaves a commit
+            # without its in-memory updates
+            if self._imports:
+                await asyncio.wait(self._imports)
+        if self.error:
+            return "failed"
+        if self.stop_status:
+            return None if self.stop_status == "lost" else self.stop_status
+        return "completed"
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.crawler.checkpoint_seconds)
+            try:
+                status = await self.crawler.save(self)
+            except Exception:
+                logger.exception("Saving the checkpoint of crawl %d failed", self.job_id)
+                continue
+            if status != "running":
+                self.stop("cancelled" if status == "cancelling" else "lost")
+                return
+
+    async def _worker(self):
+        while True:
+            path = await self._queue.get()
+            try:
+                await self._crawl_directory(path)
+            except AListError as exc:
+                if exc.fatal or path == self.root:
+                    self.error = f"{path}: {exc}"
+                    return
+                # Left out of this pass; the next one lists it again
+                logger.warning("Crawl %d skipped %s: %s", self.job_id, path, exc)
+                self.pending.pop(path, None)
+                self.progress["errors"] += 1
+                if len(self.progress["failed_directories"]) < MAX_FAILED_DIRECTORIES:
+                    self.progress["failed_directories"].append({"path": path, "error": str(exc)})
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.exception("Crawl %d failed at %s", self.job_id, path)
+                self.error = f"{path}: {type(exc).__name__}: {exc}"
+                return
+            finally:
+                self._queue.task_done()
+
+    async def _crawl_directory(self, path: str):
+        page, changed = self.pending[path]
+        if not changed and page == 1:
+            changed = self.pending[path][1] = not await self._known(path)
+        per_page = self.crawler.page_size
+        tags = self._tags(path)
+        listing = asyncio.create_task(self._list(path, page))
+        try:
+            while True:
+                content, total = await listing
+                more = len(content) >= per_page and (not total or page * per_page < total)
+                # The next page downloads while this one is imported
+                listing = asyncio.create_task(self._list(path, page + 1)) if more else None
+                images = self._scan(path, content, changed)
+                if images:
+                    await self._import(images, tags)
+                self.progress["pages"] += 1
+                if not more:
+                    break
+                page += 1
+                self.pending[path][0] = page
+        finally:
+            if listing is not None and not listing.done():
+                listing.cancel()
+        del self.pending[path]
+        self.progress["directories"] += 1
+
+    async def _list(self, path: str, page: int):
+        for attempt in range(RETRIES):
+            try:
+                return await self.crawler.list_directory(self, path, page)
+            except AListError as exc:
+                if exc.fatal or attempt == RETRIES - 1:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def _known(self, path: str) -> bool:
+        # Whether an earlier pass imported anything from the directory. One
+        # copied in with its modified times kept looks unchanged, but is new.
+        prefix = f"{self.base_url}/d{quote(path.rstrip('/'))}/"
+        async with AsyncSessionLocal() as db:
+            return await db.scalar(
+                select(models.Image.id).where(models.Image.url >= prefix, models.Image.url < prefix + "\uffff").limit(1)
+            ) is not None
+
+    def _modified_since(self, modified) -> bool:
+        return self.since is None or modified is None or modified > self.since
+
+    def _scan(self, path: str, content: list, changed: bool):
+        # Queues subdirectories and returns {url: modified} for the images
+        # this pass imports
+        images = {}
+        for entry in content:
+            name = entry.get("name")
+            if not name:
+                continue
+            child = posixpath.join(path, name)
+            modified = parse_modified(entry.get("modified"))
+            if entry.get("is_dir"):
+                if child not in self._seen:
+                    self._seen.add(child)
+                    self.pending[child] = [1, self._modified_since(modified)]
+                    self._queue.put_nowait(child)
+                continue
+            if not is_image(entry):
+                continue
+            self.progress["files"] += 1
+            if not changed and not self._modified_since(modified):
+                self.progress["skipped"] += 1
+                continue
+            url = f"{self.base_url}/d{quote(child)}"
+            if entry.get("sign"):
+                url += f"?sign={quote(entry['sign'])}"
+            images[url] = modified
+        return images
+
+    def _tags(self, path: str):
+        if not self.path_tags:
+            return self.tags
+        relative = posixpath.relpath(path, self.root)
+        directories = [] if relative == "." else relative.split("/")
+        return list(dict.fromkeys(self.tags + [name for name in directories if name.strip()]))
+
+    def _import(self, images: dict, tags: list[str]):
+        task = asyncio.create_task(self._import_page(images, tags))
+        self._imports.add(task)
+        task.add_done_callback(self._imports.discard)
+        return asyncio.shield(task)
+
+    async def _import_page(self, images: dict, tags: list[str]):
+        async with AsyncSessionLocal() as db:
+            created = [image async for chunk, _ in crud.import_images(db, ((url, None) for url in images), tags, self.owner_id) for image in chunk]
+        self.progress["imported"] += len(created)
+        if self.since is None:
+            return
+        created_urls = {image["url"] for image in created}
+        changed = [url for url, modified in images.items() if url not in created_urls and modified is not None and modified > self.since]
+        self.progress["changed"] += len(changed)
+        if self.crawler.cache is not None:
+            for url in changed:
+                self.crawler.cache.discard(url)
+
+
+class Crawler:
+    def __init__(self, client: httpx.AsyncClient, cache, concurrency: int, page_size: int, checkpoint_seconds: float, stale_seconds: float):
+        self.client = client
+        self.cache = cache
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.checkpoint_seconds = checkpoint_seconds
+        self.stale_seconds = stale_seconds
+        self._runs: dict[int, CrawlRun] = {}
+        self._sweeper: asyncio.Task | None = None
+
+    async def list_directory(self, run: CrawlRun, path: str, page: int):
+        headers = {"Authorization": run.token} if run.token else {}
+        body = {"path": path, "password": run.password or "", "page": page, "per_page": self.page_size, "refresh": False}
+        try:
+            resp = await self.client.post(f"{run.base_url}/api/fs/list", json=body, headers=headers)
+        except httpx.HTTPError as exc:
+            raise AListError(f"{type(exc).__name__}: {exc}")
+        if resp.status_code != 200:
+            raise AListError(f"HTTP {resp.status_code}", resp.status_code)
+        try:
+            result = resp.json()
+        except ValueError:
+            raise AListError("Not an AList API response")
+        # AList reports errors in the body, mostly with HTTP 200
+        if result.get("code") != 200:
+            raise AListError(result.get("message") or f"code {result.get('code')}", result.get("code"))
+        data = result.get("data") or {}
+        return data.get("content") or [], data.get("total") or 0
+
+    def running(self, job_id: int) -> bool:
+        return job_id in self._runs
+
+    def _stale(self, now: float):
+        return models.CrawlJob.heartbeat_at < now - self.stale_seconds
+
+    async def start(self, job_id: int, full: bool = False) -> bool:
+        # Claims the job and starts a pass, resuming its checkpoint unless
+        # full; False when another worker is running it
+        now = time.time()
+        job = models.CrawlJob
+        async with AsyncSessionLocal() as db:
+            claimed = await db.execute(
+                update(job)
+                .where(job.id == job_id, or_(job.status.notin_(("running", "cancelling")), self._stale(now)))
+                .values(status="running", runner=shared_state.worker_id, heartbeat_at=now, error=None, finished_at=None)
+            )
+            if claimed.rowcount != 1:
+                await db.rollback()
+                return False
+            db_job = await db.get(job, job_id)
+            if full or not db_job.checkpoint:
+                checkpoint = {"since": None if full else db_job.synced_at, "started_at": now, "pending": [[db_job.root, 1, True]]}
+                progress = new_progress()
+            else:
+                checkpoint = db_job.checkpoint
+                progress = {**new_progress(), **(db_job.progress or {})}
+            run = CrawlRun(self, db_job, checkpoint, progress)
+            db_job.checkpoint = run.checkpoint()
+            db_job.progress = run.report()
+            await db.commit()
+        logger.info("Crawl %d started", job_id)
+        self._runs[job_id] = run
+        run.task = asyncio.create_task(self._run(run))
+        return True
+
+    async def _run(self, run: CrawlRun):
+        status = None
+        try:
+            status = await run.run()
+        except asyncio.CancelledError:
+            # Shutting down; another worker or the next start resumes it
+            status = "interrupted"
+            raise
+        except Exception as exc:
+            logger.exception("Crawl %d failed", run.job_id)
+            run.error = f"{type(exc).__name__}: {exc}"
+            status = "failed"
+        finally:
+            self._runs.pop(run.job_id, None)
+            if status is not None:
+                await self._finish(run, status)
+
+    async def save(self, run: CrawlRun):
+        # Returns the job's status, or None when another worker has it now
+        job = models.CrawlJob
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(job).where(job.id == run.job_id, job.runner == shared_state.worker_id)
+                .values(checkpoint=run.checkpoint(), progress=run.report(), heartbeat_at=time.time())
+            )
+            status = await db.scalar(select(job.status).where(job.id == run.job_id, job.runner == shared_state.worker_id))
+            await db.commit()
+        return status
+
+    async def _finish(self, run: CrawlRun, status: str):
+        now = time.time()
+        values = {"status": status, "runner": None, "progress": run.report(), "heartbeat_at": now, "error": run.error}
+        if status == "completed":
+            # Directories skipped after errors still need everything since
+            # the previous pass
+            values.update(checkpoint=None, synced_at=run.since if run.progress["errors"] else run.started_at, finished_at=now)
+        else:
+            values.update(checkpoint=run.checkpoint(), finished_at=None if status == "interrupted" else now)
+        job = models.CrawlJob
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(job).where(job.id == run.job_id, job.runner == shared_state.worker_id).values(**values))
+                await db.commit()
+        except Exception:
+            logger.exception("Recording the end of crawl %d failed", run.job_id)
+        logger.info("Crawl %d %s: %s", run.job_id, status, run.progress)
+
+    async def cancel(self, job_id: int):
+        run = self._runs.get(job_id)
+        if run is not None:
+            run.stop("cancelled")
+            await asyncio.wait({run.task})
+            return
+        # Another worker's run stops at its next checkpoint; a job whose
+        # worker is gone is cancelled outright
+        now = time.time()
+        job = models.CrawlJob
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(job).where(job.id == job_id, job.status == "running")
+                .values(status=case((self._stale(now), "cancelled"), else_="cancelling"))
+            )
+            await db.commit()
+
+    async def resume(self):
+        # Picks up jobs interrupted by a shutdown, and those of workers that
+        # stopped without one
+        now = time.time()
+        job = models.CrawlJob
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(job).where(job.status == "cancelling", self._stale(now)).values(status="cancelled", runner=None))
+            job_ids = list(await db.scalars(
+                select(job.id).where(or_(job.status == "interrupted", and_(job.status == "running", self._stale(now))))
+            ))
+            await db.commit()
+        for job_id in job_ids:
+            if job_id not in self._runs:
+                await self.start(job_id)
+
+    def open(self):
+        self._sweeper = asyncio.create_task(self._sweep())
+
+    async def _sweep(self):
+        while True:
+            try:
+                await self.resume()
+            except Exception:
+                logger.exception("Resuming crawls failed")
+            await asyncio.sleep(self.stale_seconds)
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        tasks = [run.task for run in self._runs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def progress(self, job_id: int):
+        # Live counters of a job running in this worker, fresher than the
+        # last saved checkpoint
+        run = self._runs.get(job_id)
+        return run.report() if run is not None else None
+
+
+def create_crawler(client: httpx.AsyncClient, cache):
+    return Crawler(
+        client,
+        cache,
+        concurrency=int(os.getenv("CRAWL_CONCURRENCY", 4)),
+        page_size=int(os.getenv("CRAWL_PAGE_SIZE", 500)),
+        checkpoint_seconds=float(os.getenv("CRAWL_CHECKPOINT_SECONDS", 2)),
+        stale_seconds=float(os.getenv("CRAWL_STALE_SECONDS", 60)),
+    )
@@ -1,257 +1,606 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from . import models, schemas
+from sqlalchemy import DateTime, String, and_, cast, delete, func, literal, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from . import changes, models, schemas
+from .counts import image_counts
+from .database import insert_ignore
+from .delivery import delivery_stats
+from .passwords import password_hasher
+from .pools import CandidatePool, candidate_pools
+from .search import filename_filter, ranked_search, search_filter
+from .tag_index import tag_index
+from .tags import get_tags, lookup_tags, resolve_tags
+import base64
+import json
 import random
 import uuid
-from urllib.parse import unquote
+from urllib.parse import unquote, urlsplit
 import os
-from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt is deliberately slow, so it runs in its own bounded pool; both raise
+# PasswordPoolBusy when the pool is saturated
+async def hash_password(password: str):
+    return await password_hasher.hash(password)
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+async def verify_password(password: str, hashed_password: str):
+    valid, _ = await password_hasher.verify_and_update(password, hashed_password)
+    return valid
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.scalar(select(models.User).where(models.User.id == user_id))
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+async def get_user_by_username(db: AsyncSession, username: str):
+    return await db.scalar(select(models.User).where(models.User.username == username))
 
-def delete_user_by_id(db: Session, user_id: int):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user_by_username(db, username=username)
+    if not user:
+        return None
+    valid, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not valid:
+        return None
+    if new_hash:
+        # Stored with another work factor: move it to BCRYPT_ROUNDS
+        user.hashed_password = new_hash
+        await db.commit()
+    return user
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
+    return (await db.scalars(select(models.User).offset(skip).limit(limit))).all()
+
+async def delete_user_by_id(db: AsyncSession, user_id: int):
+    db_user = await get_user(db, user_id=user_id)
     if db_user:
-        db.delete(db_user)
-        db.commit()
+        await db.delete(db_user)
+        await db.commit()
+        await changes.user_changed(user_id, deleted=True)
     return db_user
 
-def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+async def update_user(db: AsyncSession, user_id: int, user_update: schemas.UserUpdate):
+    db_user = await get_user(db, user_id=user_id)
     if not db_user:
         return None
-    
+
     if user_update.username:
         db_user.username = user_update.username
-    
+
     if user_update.password:
-        db_user.hashed_password = pwd_context.hash(user_update.password)
-        
-    db.commit()
-    db.refresh(db_user)
+        db_user.hashed_password = await hash_password(user_update.password)
+
+    await db.commit()
+    await changes.user_changed(user_id)
     return db_user
 
-def create_user(db: Session, user: schemas.UserCreate, is_admin: bool = False):
-    hashed_password = pwd_context.hash(user.password)
+async def create_user(db: AsyncSession, user: schemas.UserCreate, is_admin: bool = False):
+    hashed_password = await hash_password(user.password)
     db_user = models.User(username=user.username, hashed_password=hashed_password, is_admin=is_admin)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
     return db_user
 
-def get_tag_by_name(db: Session, name: str):
-    return db.query(models.Tag).filter(models.Tag.name == name).first()
+async def get_tag_by_name(db: AsyncSession, name: str):
+    return await db.scalar(select(models.Tag).where(models.Tag.name == name))
 
-def create_tag(db: Session, tag: schemas.TagCreate):
-    db_tag = models.Tag(name=tag.name)
-    db.add(db_tag)
-    db.commit()
-    db.refresh(db_tag)
-    return db_tag
+def url_filename(url: str) -> str:
+    # Without the query string, which signed AList URLs carry
+    try:
+        path = urlsplit(url).path
+    except ValueError:
+        # e.g. an unclosed IPv6 bracket; any URL is accepted as stored
+        path = url
+    return unquote(os.path.basename(path))
 
-def create_image(db: Session, image: schemas.ImageCreate, user_id: int):
-    filename = unquote(os.path.basename(image.url))
+async def create_image(db: AsyncSession, image: schemas.ImageCreate, user_id: int):
+    filename = url_filename(image.url)
     filetype = os.path.splitext(filename)[1]
     db_image = models.Image(
         url=image.url,
         description=image.description,
         filename=filename,
         filetype=filetype,
-        owner_id=user_id
+        owner_id=user_id,
+        tags=await get_tags(db, image.tags)
     )
-    
-    for tag_name in image.tags:
-        db_tag = get_tag_by_name(db, name=tag_name)
-        if db_tag is None:
-            db_tag = create_tag(db, schemas.TagCreate(name=tag_name))
-        db_image.tags.append(db_tag)
-        
+
     db.add(db_image)
-    db.commit()
-    db.refresh(db_image)
+    with image_counts.change(user_id) as change:
+        await db.commit()
+        change.added(image.tags)
+    await changes.images_added(user_id, [db_image.id], {tag.id for tag in db_image.tags})
     return db_image
 
-def create_bulk_images(db: Session, bulk_data: schemas.ImageBulkCreate, user_id: int):
-    created_images = []
-    for url in bulk_data.urls:
-        # Skip if image with this URL already exists
-        existing_image = db.query(models.Image).filter(models.Image.url == url).first()
-        if existing_image:
+BULK_CHUNK_SIZE = 500
+
+async def _chunked(items, size: int):
+    # Accepts plain and async iterables so NDJSON bodies stream through
+    chunk = []
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    else:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+async def import_images(db: AsyncSession, entries, tags: list[str], user_id: int):
+    # entries yields (url, description) pairs. Each chunk costs one SELECT for
+    # existing URLs, one multi-row INSERT for images and one for tag links,
+    # and commits on its own: a body still arriving over the network never
+    # holds the write lock, and nothing accumulates across chunks. Yields
+    # (created images, entries read) per chunk.
+    tag_rows = None
+    async for chunk in _chunked(entries, BULK_CHUNK_SIZE):
+        if tag_rows is None:
+            tag_rows = await resolve_tags(db, tags)
+            tag_ids = set(tag_rows.values())
+            tag_list = [{"id": tag_id, "name": name} for name, tag_id in tag_rows.items()]
+        descriptions = dict(chunk)
+        existing = set(await db.scalars(select(models.Image.url).where(models.Image.url.in_(descriptions))))
+        rows = []
+        for url, description in descriptions.items():
+            if url in existing:
+                continue
+            filename = url_filename(url)
+            rows.append({
+                "url": url,
+                "description": description,
+                "filename": filename,
+                "filetype": os.path.splitext(filename)[1],
+                "owner_id": user_id,
+            })
+        if not rows:
+            # Ends the read, and commits tags created for this import
+            await db.commit()
+            yield [], len(chunk)
             continue
 
-        filename = unquote(os.path.basename(url))
-        filetype = os.path.splitext(filename)[1]
-        db_image = models.Image(url=url, filename=filename, filetype=filetype, owner_id=user_id)
-        for tag_name in bulk_data.tags:
-            db_tag = get_tag_by_name(db, name=tag_name)
-            if db_tag is None:
-                db_tag = create_tag(db, schemas.TagCreate(name=tag_name))
-            db_image.tags.append(db_tag)
-        
-        db.add(db_image)
-        created_images.append(db_image)
-    
-    db.commit()
-    for img in created_images:
-        db.refresh(img)
-    return created_images
-
-def get_images(db: Session, user_id: int, skip: int = 0, limit: int = 10, tags: list[str] | None = None, sort_by: str = 'created_at', sort_order: str = 'desc', filename_like: str | None = None):
-    query = db.query(models.Image).filter(models.Image.owner_id == user_id)
-
+        inserted = (await db.execute(
+            insert_ignore(db, models.Image.__table__).returning(*models.Image.__table__.c), rows
+        )).mappings().all()
+        if tag_ids and inserted:
+            await db.execute(
+                insert_ignore(db, models.ImageTagAssociation),
+                [{"image_id": row["id"], "tag_id": tag_id} for row in inserted for tag_id in tag_ids],
+            )
+        with image_counts.change(user_id) as change:
+            await db.commit()
+            change.added(tag_rows, len(inserted))
+        created = [{**row, "tags": tag_list} for row in inserted]
+        if created:
+            await changes.images_added(user_id, [image["id"] for image in created], tag_ids)
+        yield created, len(chunk)
+
+async def create_bulk_images(db: AsyncSession, bulk_data: schemas.ImageBulkCreate, user_id: int):
+    return [image async for created, _ in import_images(db, ((url, None) for url in bulk_data.urls), bulk_data.tags, user_id) for image in created]
+
+def _images_with_tags():
+    # Async sessions cannot lazy load, so every Image returned to a route
+    # carries its tags with it
+    return select(models.Image).options(selectinload(models.Image.tags))
+
+async def get_image(db: AsyncSession, image_id: int):
+    return await db.scalar(_images_with_tags().where(models.Image.id == image_id))
+
+async def get_user_image(db: AsyncSession, image_id: int, user_id: int):
+    return await db.scalar(_images_with_tags().where(models.Image.id == image_id, models.Image.owner_id == user_id))
+
+def encode_cursor(sort_by: str, sort_order: str, value, image_id: int):
+    payload = json.dumps([sort_by, sort_order, value, image_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort_by: str, sort_order: str):
+    # Returns (value, id) of the last row of the previous page
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        cursor_sort_by, cursor_sort_order, value, image_id = payload
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(value, (str, int, float, type(None))) or not isinstance(image_id, int):
+        raise ValueError("Invalid cursor")
+    if (cursor_sort_by, cursor_sort_order) != (sort_by, sort_order):
+        raise ValueError("Cursor does not match the requested sort order")
+    return value, image_id
+
+def _cursor_column(column):
+    # SQLite keeps timestamps as text in a different format from the one
+    # SQLAlchemy binds, so cursors carry and compare the stored text
+    return (cast(column, String) if isinstance(column.type, DateTime) else column).label("cursor_value")
+
+def _cursor_param(db: AsyncSession, column, value):
+    if isinstance(column.type, DateTime):
+        if db.get_bind().dialect.name == "sqlite":
+            return literal(value, String)
+        return cast(literal(value, String), column.type)
+    return value
+
+def _after_cursor(db: AsyncSession, column, value, image_id: int, descending: bool):
+    # Rows that sort after (value, image_id). NULLs come first ascending and
+    # last descending, which is SQLite's default ordering.
+    id_column = models.Image.__table__.c.id
+    if column is id_column:
+        return id_column < value if descending else id_column > value
+    if value is None:
+        if descending:
+            return and_(column.is_(None), id_column < image_id)
+        return or_(column.is_not(None), id_column > image_id)
+    value = _cursor_param(db, column, value)
+    if descending:
+        after = tuple_(column, id_column) < tuple_(value, image_id)
+        # Server defaults (created_at) are never NULL, and leaving out the
+        # IS NULL branch lets the index seek straight to the cursor
+        nullable = column.nullable and column.server_default is None
+        return or_(after, column.is_(None)) if nullable else after
+    return tuple_(column, id_column) > tuple_(value, image_id)
+
+# Tag filters matching at most this many images are passed to the listing
+# query as an id list from the tag index
+TAG_INDEX_IN_LIMIT = int(os.getenv("TAG_INDEX_IN_LIMIT", 1000))
+
+async def get_images(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 10, tags: list[str] | None = None, sort_by: str = 'created_at', sort_order: str = 'desc', filename_like: str | None = None, cursor: str | None = None, total: str = 'exact', search: str | None = None):
+    query = _images_with_tags().where(models.Image.owner_id == user_id)
+    dialect = db.get_bind().dialect.name
+
+    tag_matches = None
     if tags:
-        for tag_name in tags:
-            query = query.filter(models.Image.tags.any(name=tag_name))
-    
-    if filename_like:
-        query = query.filter(models.Image.filename.ilike(f"%{filename_like}%"))
+        tag_ids = await lookup_tags(db, tags)
+        if len(tag_ids) < len(set(tags)):
+            # No image can carry a tag that does not exist
+            return {"total": None if total == "none" else 0, "images": [], "next_cursor": None}
+        tag_matches = tag_index.match(tag_ids.values(), owner_id=user_id)
+        if tag_matches is not None and len(tag_matches) <= TAG_INDEX_IN_LIMIT:
+            # Few enough matches to hand the database their ids directly
+            query = query.where(models.Image.id.in_(list(tag_matches)))
+        else:
+            # Many matches, or no index yet: walking the listing index and
+            # checking tags row by row finds a page quickly
+            for tag_id in tag_ids.values():
+                query = query.where(models.Image.tags.any(models.Tag.id == tag_id))
 
-    sort_column = getattr(models.Image, sort_by, models.Image.created_at)
-    if sort_order == 'desc':
-        query = query.order_by(sort_column.desc())
+    if filename_like:
+        query = query.where(filename_filter(dialect, filename_like))
+
+    # sort_by=relevance ranks search results instead of filtering them
+    relevance = bool(search) and sort_by == 'relevance'
+    if relevance:
+        if cursor:
+            raise ValueError("Cursor pagination is not available for relevance ordering")
+        query = ranked_search(query, dialect, search)
+    elif search:
+        query = query.where(search_filter(dialect, search))
+
+    total_count = None
+    if total != "none" and tag_matches is not None and not filename_like and not search:
+        total_count = len(tag_matches)
+    elif total != "none":
+        # Totals are cached per filter and kept up to date by the write
+        # paths; estimate also accepts a count some writes have outdated
+        key = (frozenset(tags or ()), filename_like or None, search or None)
+        total_count = image_counts.get(user_id, key, stale_ok=total == "estimate")
+        if total_count is None:
+            token = image_counts.token(user_id)
+            total_count = await db.scalar(select(func.count()).select_from(query.subquery()))
+            image_counts.put(user_id, key, total_count, token)
+
+    if relevance:
+        images = (await db.scalars(query.offset(skip).limit(limit))).all()
+        return {"total": total_count, "images": images, "next_cursor": None}
+
+    if sort_by not in models.Image.__table__.c:
+        sort_by = 'created_at'
+    sort_column = models.Image.__table__.c[sort_by]
+    descending = sort_order == 'desc'
+    if cursor:
+        value, image_id = decode_cursor(cursor, sort_by, sort_order)
+        query = query.where(_after_cursor(db, sort_column, value, image_id, descending))
+        skip = 0
+
+    # id breaks ties so every row has a unique position for the next cursor
+    if sort_column is models.Image.__table__.c.id:
+        order = [sort_column]
+    else:
+        order = [sort_column, models.Image.__table__.c.id]
+    if dialect == "sqlite":
+        query = query.order_by(*(c.desc() if descending else c.asc() for c in order))
     else:
-        query = query.order_by(sort_column.asc())
-    
-    total = query.count()
-    images = query.offset(skip).limit(limit).all()
-    return {"total": total, "images": images}
-
-def delete_image(db: Session, image_id: int, user_id: int):
-    db_image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == user_id).first()
+        query = query.order_by(*(c.desc().nulls_last() if descending else c.asc().nulls_first() for c in order))
+
+    # One extra row tells whether there is a next page
+    rows = (await db.execute(query.add_columns(_cursor_column(sort_column)).offset(skip).limit(limit + 1))).all()
+    next_cursor = None
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if has_more and rows:
+        last_image, last_value = rows[-1]
+        next_cursor = encode_cursor(sort_by, sort_order, last_value, last_image.id)
+    return {"total": total_count, "images": [image for image, _ in rows], "next_cursor": next_cursor}
+
+async def delete_image(db: AsyncSession, image_id: int, user_id: int):
+    db_image = await get_user_image(db, image_id=image_id, user_id=user_id)
     if db_image:
-        db.delete(db_image)
-        db.commit()
+        tag_ids = {tag.id for tag in db_image.tags}
+        tag_names = [tag.name for tag in db_image.tags]
+        await db.delete(db_image)
+        with image_counts.change(user_id) as change:
+            await db.commit()
+            change.removed(tag_names)
+        await changes.images_removed(user_id, {image_id: tag_ids})
     return db_image
 
-def delete_images_bulk(db: Session, image_ids: list[int], user_id: int):
-    db.query(models.Image).filter(models.Image.id.in_(image_ids), models.Image.owner_id == user_id).delete(synchronize_session=False)
-    db.commit()
+async def delete_images_bulk(db: AsyncSession, image_ids: list[int], user_id: int):
+    association = models.ImageTagAssociation
+    tag_pairs = (await db.execute(
+        select(association.c.image_id, association.c.tag_id).where(association.c.image_id.in_(image_ids))
+    )).all()
+    deleted = set(await db.scalars(
+        delete(models.Image).where(models.Image.id.in_(image_ids), models.Image.owner_id == user_id)
+        .returning(models.Image.id),
+        execution_options={"synchronize_session": False},
+    ))
+    with image_counts.change(user_id) as change:
+        await db.commit()
+        change.removed(images=len(deleted))
+    image_tags = {image_id: set() for image_id in deleted}
+    for image_id, tag_id in tag_pairs:
+        if image_id in image_tags:
+            image_tags[image_id].add(tag_id)
+    await changes.images_removed(user_id, image_tags)
     return {"status": "success", "deleted_ids": image_ids}
 
-def update_image_tags(db: Session, image_id: int, tags: list[str], user_id: int):
-    db_image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == user_id).first()
+async def update_image_tags(db: AsyncSession, image_id: int, tags: list[str], user_id: int):
+    db_image = await get_user_image(db, image_id=image_id, user_id=user_id)
     if not db_image:
         return None
 
-    # Clear existing tags
-    db_image.tags.clear()
-
-    # Add new tags
-    for tag_name in tags:
-        db_tag = get_tag_by_name(db, name=tag_name)
-        if db_tag is None:
-            db_tag = create_tag(db, schemas.TagCreate(name=tag_name))
-        db_image.tags.append(db_tag)
-    
-    db.commit()
-    db.refresh(db_image)
+    old_tag_ids = {tag.id for tag in db_image.tags}
+    old_tag_names = [tag.name for tag in db_image.tags]
+
+    # Replace the existing tags
+    db_image.tags = await get_tags(db, tags)
+
+    with image_counts.change(user_id) as change:
+        await db.commit()
+        change.retagged(old_tag_names, tags)
+    await changes.image_retagged(user_id, db_image.id, old_tag_ids, {tag.id for tag in db_image.tags})
     return db_image
 
-def add_tags_to_images_bulk(db: Session, image_ids: list[int], tags: list[str], user_id: int):
-    images = db.query(models.Image).filter(models.Image.id.in_(image_ids), models.Image.owner_id == user_id).all()
-    if not images:
+async def _owned_image_ids(db: AsyncSession, image_ids: list[int], user_id: int):
+    owned = []
+    for start in range(0, len(image_ids), BULK_CHUNK_SIZE):
+        owned += await db.scalars(select(models.Image.id).where(
+            models.Image.id.in_(image_ids[start:start + BULK_CHUNK_SIZE]), models.Image.owner_id == user_id
+        ))
+    return owned
+
+async def _linked_tag_ids(db: AsyncSession, image_ids: list[int]):
+    tag_ids = set()
+    for start in range(0, len(image_ids), BULK_CHUNK_SIZE):
+        tag_ids.update(await db.scalars(select(models.ImageTagAssociation.c.tag_id).where(
+            models.ImageTagAssociation.c.image_id.in_(image_ids[start:start + BULK_CHUNK_SIZE])
+        ).distinct()))
+    return tag_ids
+
+async def retag_images_bulk(db: AsyncSession, image_ids: list[int], tags: list[str], user_id: int, mode: str = "add"):
+    # Set-based retagging straight on image_tag_association: "add" inserts the
+    # missing links, "remove" deletes links to the given tags and "replace"
+    # does both so the images end up with exactly these tags. Returns a
+    # summary, or None when none of the images belong to the user.
+    owned = await _owned_image_ids(db, image_ids, user_id)
+    if not owned:
         return None
 
-    for image in images:
-        for tag_name in tags:
-            db_tag = get_tag_by_name(db, name=tag_name)
-            if db_tag is None:
-                db_tag = create_tag(db, schemas.TagCreate(name=tag_name))
-            if db_tag not in image.tags:
-                image.tags.append(db_tag)
-    
-    db.commit()
+    association = models.ImageTagAssociation
+    if mode == "remove":
+        # Removing a tag that does not exist is a no-op, so never create it
+        tag_ids = set((await lookup_tags(db, tags)).values())
+    else:
+        tag_ids = set((await resolve_tags(db, tags)).values())
+
+    removed = added = 0
+    unlinked_tag_ids = set()
+    if mode == "remove":
+        unlinked_tag_ids = tag_ids
+    elif mode == "replace":
+        unlinked_tag_ids = await _linked_tag_ids(db, owned)
+    for start in range(0, len(owned), BULK_CHUNK_SIZE):
+        chunk = owned[start:start + BULK_CHUNK_SIZE]
+        if mode in ("remove", "replace"):
+            condition = association.c.image_id.in_(chunk)
+            if mode == "remove":
+                condition &= association.c.tag_id.in_(tag_ids)
+            removed += (await db.execute(delete(association).where(condition))).rowcount
+        if mode in ("add", "replace") and tag_ids:
+            added += (await db.execute(
+                insert_ignore(db, association),
+                [{"image_id": image_id, "tag_id": tag_id} for image_id in chunk for tag_id in tag_ids],
+            )).rowcount
+
+    with image_counts.change(user_id) as change:
+        await db.commit()
+        change.retagged()
+    await changes.images_retagged(user_id, owned, unlinked_tag_ids, tag_ids if mode != "remove" else ())
+    return {"images": len(owned), "added": added, "removed": removed, "image_ids": owned}
+
+async def add_tags_to_images_bulk(db: AsyncSession, image_ids: list[int], tags: list[str], user_id: int):
+    return await retag_images_bulk(db, image_ids, tags, user_id, mode="add")
+
+async def get_images_by_ids(db: AsyncSession, image_ids: list[int]):
+    images = []
+    for start in range(0, len(image_ids), BULK_CHUNK_SIZE):
+        images += await db.scalars(
+            _images_with_tags().where(models.Image.id.in_(image_ids[start:start + BULK_CHUNK_SIZE]))
+            .execution_options(populate_existing=True)
+        )
     return images
 
-def update_image_filename(db: Session, image_id: int, filename: str, user_id: int):
-    db_image = db.query(models.Image).filter(models.Image.id == image_id, models.Image.owner_id == user_id).first()
+async def update_image_filename(db: AsyncSession, image_id: int, filename: str, user_id: int):
+    db_image = await get_user_image(db, image_id=image_id, user_id=user_id)
     if not db_image:
         return None
-    
+
     db_image.filename = filename
-    db.commit()
-    db.refresh(db_image)
+    with image_counts.change(user_id) as change:
+        await db.commit()
+        change.renamed()
+    await changes.images_renamed(user_id)
     return db_image
 
-def get_random_image(db: Session, tag_name: str | None = None):
-    query = db.query(models.Image)
-    if tag_name:
-        query = query.join(models.Image.tags).filter(models.Tag.name == tag_name)
-    
-    images = query.all()
-    if not images:
+RANDOM_PROBES = 32
+
+async def _pick_random_image(db: AsyncSession, ids):
+    # Separate scalar subqueries so each bound is a single index seek
+    low, high = (await db.execute(select(
+        select(func.min(models.Image.id)).scalar_subquery(),
+        select(func.max(models.Image.id)).scalar_subquery(),
+    ))).one()
+    if low is None:
+        return None
+
+    # Probe random ids over the id range first. Each probe is a primary key
+    # lookup and the first probe that matches is a uniform pick.
+    probes = [random.randint(low, high) for _ in range(RANDOM_PROBES)]
+    hits = set(await db.scalars(ids.where(models.Image.id.in_(probes))))
+    for image_id in probes:
+        if image_id in hits:
+            return await get_image(db, image_id)
+
+    # Sparse matches: count the candidates and jump to a random offset over
+    # the id index, so only a single row is ever loaded.
+    total = await db.scalar(select(func.count()).select_from(ids.subquery()))
+    if not total:
         return None
-    
-    return random.choice(images)
+    image_id = await db.scalar(ids.order_by(models.Image.id).offset(random.randrange(total)).limit(1))
+    return await get_image(db, image_id)
+
+async def get_random_image(db: AsyncSession, tag_name: str | None = None):
+    if tag_index.ready:
+        tag_ids = await lookup_tags(db, [tag_name]) if tag_name else {}
+        if tag_name and not tag_ids:
+            return None
+        matches = tag_index.match(tag_ids.values())
+        if matches is not None:
+            if not matches.chunks:
+                return None
+            return await get_image(db, matches.nth(random.randrange(len(matches))))
+
+    ids = select(models.Image.id)
+    if tag_name:
+        ids = ids.where(models.Image.tags.any(name=tag_name))
+
+    return await _pick_random_image(db, ids)
 
-def get_api_key_by_key(db: Session, key: str):
-    return db.query(models.ApiKey).filter(models.ApiKey.key == key).first()
+def _api_keys_with_tags():
+    return select(models.ApiKey).options(selectinload(models.ApiKey.tags_and), selectinload(models.ApiKey.tags_or))
 
-def get_api_keys(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.ApiKey).filter(models.ApiKey.owner_id == user_id).offset(skip).limit(limit).all()
+async def get_api_key_by_key(db: AsyncSession, key: str):
+    return await db.scalar(_api_keys_with_tags().where(models.ApiKey.key == key))
 
-def create_api_key(db: Session, api_key: schemas.ApiKeyCreate, user_id: int):
+async def get_api_keys(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 100):
+    return (await db.scalars(_api_keys_with_tags().where(models.ApiKey.owner_id == user_id).offset(skip).limit(limit))).all()
+
+async def create_api_key(db: AsyncSession, api_key: schemas.ApiKeyCreate, user_id: int):
     db_api_key = models.ApiKey(
         key=str(uuid.uuid4()),
         name=api_key.name,
-        owner_id=user_id
+        mode=api_key.mode,
+        prefetch_depth=api_key.prefetch_depth,
+        owner_id=user_id,
+        tags_and=await get_tags(db, api_key.tags_and),
+        tags_or=await get_tags(db, api_key.tags_or)
     )
-    
-    for tag_name in api_key.tags_and:
-        db_tag = get_tag_by_name(db, name=tag_name)
-        if db_tag is None:
-            db_tag = create_tag(db, schemas.TagCreate(name=tag_name))
-        db_api_key.tags_and.append(db_tag)
-
-    for tag_name in api_key.tags_or:
-        db_tag = get_tag_by_name(db, name=tag_name)
-        if db_tag is None:
-            db_tag = create_tag(db, schemas.TagCreate(name=tag_name))
-        db_api_key.tags_or.append(db_tag)
-        
+
     db.add(db_api_key)
-    db.commit()
-    db.refresh(db_api_key)
+    await db.commit()
+    await changes.api_key_changed(user_id, db_api_key.key)
     return db_api_key
 
-def delete_api_key(db: Session, api_key_id: int, user_id: int):
-    db_api_key = db.query(models.ApiKey).filter(models.ApiKey.id == api_key_id, models.ApiKey.owner_id == user_id).first()
+async def delete_api_key(db: AsyncSession, api_key_id: int, user_id: int):
+    db_api_key = await db.scalar(_api_keys_with_tags().where(models.ApiKey.id == api_key_id, models.ApiKey.owner_id == user_id))
     if db_api_key:
-        db.delete(db_api_key)
-        db.commit()
+        await db.delete(db_api_key)
+        await db.commit()
+        await changes.api_key_changed(user_id, db_api_key.key)
+        delivery_stats.forget(db_api_key.id)
     return db_api_key
 
-def get_random_image_by_api_key(db: Session, key: str):
-    api_key = get_api_key_by_key(db, key=key)
-    if not api_key:
-        return None
-    
-    tags_and = {tag.name for tag in api_key.tags_and}
-    tags_or = {tag.name for tag in api_key.tags_or}
+async def update_api_key(db: AsyncSession, api_key_id: int, user_id: int, **values):
+    db_api_key = await db.scalar(_api_keys_with_tags().where(models.ApiKey.id == api_key_id, models.ApiKey.owner_id == user_id))
+    if db_api_key:
+        for name, value in values.items():
+            setattr(db_api_key, name, value)
+        await db.commit()
+        await changes.api_key_changed(user_id, db_api_key.key)
+    return db_api_key
 
-    if not tags_and and not tags_or:
-        return get_random_image(db)
+async def _build_candidate_pool(db: AsyncSession, api_key: models.ApiKey):
+    tags_and = {tag.id for tag in api_key.tags_and}
+    tags_or = {tag.id for tag in api_key.tags_or}
 
-    query = db.query(models.Image)
+    matches = tag_index.match(tags_and, tags_or)
+    if matches is not None:
+        return CandidatePool(api_key.id, api_key.name, api_key.mode, api_key.prefetch_depth, tags_and, tags_or, iter(matches))
 
-    if tags_and:
-        for tag_name in tags_and:
-            query = query.filter(models.Image.tags.any(name=tag_name))
-    
+    # Read tag -> image ids off the association index instead of checking
+    # every image
+    association = models.ImageTagAssociation
+    query = select(models.Image.id)
+    for tag_id in tags_and:
+        query = query.where(models.Image.id.in_(select(association.c.image_id).where(association.c.tag_id == tag_id)))
     if tags_or:
-        query = query.filter(or_(*[models.Image.tags.any(name=tag_name) for tag_name in tags_or]))
+        query = query.where(models.Image.id.in_(select(association.c.image_id).where(association.c.tag_id.in_(tags_or))))
+
+    image_ids = await db.scalars(query)
+    return CandidatePool(api_key.id, api_key.name, api_key.mode, api_key.prefetch_depth, tags_and, tags_or, image_ids)
+
+async def get_api_key_pool(db: AsyncSession, key: str):
+    pool = candidate_pools.get(key)
+    if pool is None:
+        generation = candidate_pools.generation
+        api_key = await get_api_key_by_key(db, key=key)
+        if not api_key:
+            return None
+        pool = candidate_pools.store(key, await _build_candidate_pool(db, api_key), generation)
+    return pool
+
+async def get_random_image_by_api_key(db: AsyncSession, key: str):
+    pool = await get_api_key_pool(db, key)
+    if pool is None:
+        return None
+    return await get_random_image_from_pool(db, pool)
 
-    images = query.distinct().all()
-    if not images:
+async def get_random_image_from_pool(db: AsyncSession, pool: CandidatePool):
+    image_id = pool.pick()
+    if image_id is None:
         return None
-        
-    return random.choice(images)
\ No newline at end of file
+    return await get_image(db, image_id)
+
+async def create_crawl_job(db: AsyncSession, crawl: schemas.CrawlJobCreate, user_id: int):
+    db_job = models.CrawlJob(
+        base_url=crawl.base_url.rstrip("/"),
+        root="/" + crawl.root.strip("/"),
+        token=crawl.token,
+        password=crawl.password,
+        tags=crawl.tags,
+        path_tags=crawl.path_tags,
+        concurrency=crawl.concurrency,
+        owner_id=user_id,
+    )
+    db.add(db_job)
+    await db.commit()
+    return db_job
+
+async def get_crawl_jobs(db: AsyncSession, user_id: int):
+    return (await db.scalars(select(models.CrawlJob).where(models.CrawlJob.owner_id == user_id).order_by(models.CrawlJob.id))).all()
+
+async def get_crawl_job(db: AsyncSession, job_id: int, user_id: int):
+    return await db.scalar(select(models.CrawlJob).where(models.CrawlJob.id == job_id, models.CrawlJob.owner_id == user_id))
+
+async def delete_crawl_job(db: AsyncSession, db_job: models.CrawlJob):
+    await db.delete(db_job)
+    await db.commit()
@@ -1,12 +1,88 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///../alist_images.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL", "sqlite:///../alist_images.db")
+
+# Async drivers for the sync URLs people usually configure
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+# Applied to every new SQLite connection. WAL lets the random endpoints keep
+# reading while a bulk import writes, and busy_timeout makes writers wait for
+# the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64000)),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+def async_database_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)).render_as_string(hide_password=False)
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas: dict = SQLITE_PRAGMAS):
+    cursor = dbapi_connection.cursor()
+    # busy_timeout goes first so switching journal mode can wait for the lock
+    for name in sorted(pragmas, key=lambda name: name != "busy_timeout"):
+        cursor.execute(f"PRAGMA {name}={pragmas[name]}")
+    cursor.close()
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+def engine_options(url: str) -> dict:
+    url = make_url(url)
+    is_sqlite = url.get_backend_name() == "sqlite"
+    if is_sqlite and url.database in (None, "", ":memory:"):
+        return {"connect_args": {"check_same_thread": False}}
+
+    options = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 20)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    }
+    if is_sqlite:
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        options["pool_recycle"] = int(os.getenv("DB_POOL_RECYCLE", 1800))
+        options["pool_pre_ping"] = True
+    return options
+
+def create_engines(url: str = SQLALCHEMY_DATABASE_URL, tuned: bool = True):
+    # Returns (sync engine, async engine) for the same database
+    sync_engine = create_engine(url, **engine_options(url))
+    async_engine = create_async_engine(async_database_url(url), **engine_options(url))
+    if tuned and sync_engine.dialect.name == "sqlite":
+        for target in (sync_engine, async_engine.sync_engine):
+            event.listen(target, "connect", lambda dbapi_connection, _: apply_sqlite_pragmas(dbapi_connection))
+    return sync_engine, async_engine
+
+# The sync engine is only used for schema management and scripts; requests
+# go through the async engine so queries never block the event loop
+engine, async_engine = create_engines()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
+
+def insert_ignore(db: AsyncSession, table):
+    # INSERT ... ON CONFLICT DO NOTHING in the dialect of the session's engine
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table).on_conflict_do_nothing()
 
-Base = declarative_base()
\ No newline at end of file
+# Dependency shared by routes and auth, so FastAPI resolves it once and a
+# request holds a single pooled connection
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,62 @@
+import threading
+
+from starlette.responses import Response
+
+MODES = ("proxy", "redirect", "json")
+
+# Requests served per API key and delivery mode, plus the image bytes that
+# went through this process for proxied ones. Shows which keys are worth
+# moving to redirect.
+class DeliveryStats:
+    def __init__(self):
+        self._keys: dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, api_key_id: int, name: str, mode: str, proxied_bytes: int = 0):
+        with self._lock:
+            entry = self._keys.get(api_key_id)
+            if entry is None:
+                entry = self._keys[api_key_id] = {"name": name, "proxied_bytes": 0, **{m: 0 for m in MODES}}
+            entry[mode] += 1
+            entry["proxied_bytes"] += proxied_bytes
+
+    def forget(self, api_key_id: int):
+        with self._lock:
+            self._keys.pop(api_key_id, None)
+
+    def report(self):
+        with self._lock:
+            keys = [{"api_key_id": api_key_id, **entry} for api_key_id, entry in self._keys.items()]
+        totals = {mode: sum(key[mode] for key in keys) for mode in (*MODES, "proxied_bytes")}
+        return {"totals": totals, "keys": keys}
+
+
+# Wraps a response to report the body bytes it actually sent once it is done:
+# Content-Length is the whole file for a Range request answered from the
+# disk cache, is still set on a HEAD or 304, and is absent when a shared
+# download is streamed through.
+class CountedResponse(Response):
+    def __init__(self, response: Response, on_sent):
+        self.response = response
+        self.on_sent = on_sent
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope, receive, send):
+        sent = 0
+
+        async def send_and_count(message):
+            nonlocal sent
+            # Servers drop the body of a HEAD response even if one is sent
+            if message["type"] == "http.response.body" and scope["method"] != "HEAD":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.response(scope, receive, send_and_count)
+        finally:
+            self.on_sent(sent)
+
+
+delivery_stats = DeliveryStats()
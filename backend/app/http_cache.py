@@ -0,0 +1,109 @@
+import hashlib
+import os
+import secrets
+import threading
+from email.utils import parsedate_to_datetime
+
+from fastapi import Request, Response
+
+# Validators and Cache-Control for the JSON listings and the random endpoints.
+#
+# Listing ETags are derived from a per-user data version read before the
+# query, so an unchanged gallery answers If-None-Match with a 304 without
+# touching the database.
+#
+# With several workers, a version is the shared feed position (see
+# shared.py) of the user's last change. Every worker reaches the same value
+# once it has applied that change, so any of them honours a tag another one
+# issued, trailing a write by at most SHARED_POLL_SECONDS. A change that is
+# not on a feed, with one process or when publishing failed, counts locally
+# under BOOT_ID instead, so an ETag handed out before a restart never
+# matches.
+BOOT_ID = secrets.token_hex(4)
+
+# Listings are per user: browsers may keep them, but must revalidate
+LISTING_CACHE_CONTROL = "private, no-cache"
+
+# Set to e.g. "public, max-age=5" to let a CDN absorb random image traffic
+RANDOM_CACHE_CONTROL = os.getenv("RANDOM_CACHE_CONTROL", "no-cache")
+
+
+class Versions:
+    # Per-user version of one kind of data, moved after every committed write
+    def __init__(self):
+        self._positions: dict[int, object] = {}
+        self._local: dict[int, int] = {}
+        # The version of users with no change seen since startup
+        self._base = BOOT_ID
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> str:
+        position = self._positions.get(user_id, self._base)
+        local = self._local.get(user_id)
+        return f"{position}+{BOOT_ID}.{local}" if local else str(position)
+
+    def bump(self, user_id: int, position=None):
+        # position is the change's place on the shared feed, or None. Changes
+        # from several workers can be applied out of order, so the latest wins.
+        with self._lock:
+            if position is None:
+                self._local[user_id] = self._local.get(user_id, 0) + 1
+            elif user_id not in self._positions or position > self._positions[user_id]:
+                self._positions[user_id] = position
+
+    def reset(self, base):
+        # For when the changes made so far are unknown: at startup, or after
+        # missing some. base must not repeat a version already handed out.
+        with self._lock:
+            self._positions.clear()
+            self._local.clear()
+            self._base = base
+
+
+image_versions = Versions()
+api_key_versions = Versions()
+
+
+def reset_versions(position):
+    # position is where this worker joined or rejoined the shared feed
+    image_versions.reset(position)
+    api_key_versions.reset(position)
+
+
+def listing_headers(request: Request, user_id: int, version: str) -> dict[str, str]:
+    # The query string is part of the tag, so every page and filter has its own
+    key = f"{user_id}:{version}:{request.url.path}?{request.url.query}"
+    digest = hashlib.blake2s(key.encode(), digest_size=8).hexdigest()
+    return {"ETag": f'W/"{digest}"', "Cache-Control": LISTING_CACHE_CONTROL, "Vary": "Authorization"}
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag.strip().removeprefix("W/")
+
+
+def not_modified(request: Request, validators: dict[str, str]) -> bool:
+    # Whether the client's cached copy still matches validators. ETags use the
+    # weak comparison If-None-Match calls for, and If-Modified-Since only
+    # counts when no If-None-Match was sent.
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        etag = validators.get("ETag")
+        if not etag:
+            return False
+        return if_none_match.strip() == "*" or _opaque_tag(etag) in {_opaque_tag(tag) for tag in if_none_match.split(",")}
+    if_modified_since = request.headers.get("If-Modified-Since")
+    last_modified = validators.get("Last-Modified")
+    if not if_modified_since or not last_modified:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified_response(headers: dict[str, str]) -> Response:
+    # A 304 repeats the validators and caching headers, but never the body's
+    return Response(status_code=304, headers={
+        name: value for name, value in headers.items()
+        if name.lower() not in ("content-type", "content-length", "content-encoding", "content-range")
+    })
@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# On-disk cache of proxied image bytes, keyed by Image.url. Each entry is a
+# body file plus a small JSON sidecar with the headers to replay. Entries are
+# evicted least-recently-used once the byte budget is exceeded. Writers fill a
+# temporary file and publish it with an atomic rename, so concurrent writers
+# for the same URL never expose a partial body.
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # Rebuild the LRU order from the timestamps touched on every hit, and
+        # sweep temporary files abandoned by a crashed writer
+        files = []
+        for name in os.listdir(self.directory):
+            # Other workers sharing the directory publish, evict and sweep
+            # while this one starts, so a listed file may be gone already
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+                if name.endswith(".tmp"):
+                    if stat.st_mtime < time.time() - 3600:
+                        os.remove(os.path.join(self.directory, name))
+                    continue
+            except FileNotFoundError:
+                continue
+            if not name.endswith(".json"):
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, url: str):
+        # Returns (path, headers) for a cached body, or None on a miss
+        key = self._key(url)
+        with self._lock:
+            size = self._entries.get(key)
+            if size is None:
+                size = self._adopt(key)
+            if size is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += size
+        try:
+            with open(self._path(key) + ".json") as f:
+                headers = json.load(f)
+            os.utime(self._path(key))
+        except OSError:
+            self._forget(key)
+            return None
+        return self._path(key), headers
+
+    def contains(self, url: str) -> bool:
+        # Whether url is cached, without counting a hit or miss: for
+        # background work such as prefetching rather than a served request
+        key = self._key(url)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            return self._adopt(key) is not None
+
+    def _adopt(self, key: str):
+        # Other worker processes sharing the directory publish entries this
+        # one has not seen; take them over instead of fetching again. Each
+        # process enforces the byte budget on the entries it knows about.
+        try:
+            size = os.stat(self._path(key)).st_size
+        except OSError:
+            return None
+        self._entries[key] = size
+        self._size += size
+        self._trim()
+        return size
+
+    def _trim(self):
+        # Evicts least recently used entries, never the newest one
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            evicted, evicted_size = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
+            self._remove_files(evicted)
+
+    def writer(self, url: str, headers: dict[str, str]):
+        return CacheWriter(self, self._key(url), headers)
+
+    def _publish(self, key: str, tmp_path: str, headers: dict[str, str], size: int):
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        with open(tmp_path + ".json.tmp", "w") as f:
+            json.dump(headers, f)
+        os.replace(tmp_path + ".json.tmp", self._path(key) + ".json")
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._trim()
+
+    def discard(self, url: str):
+        # For a URL whose content changed upstream
+        self._forget(self._key(url))
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+        self._remove_files(key)
+
+    def _remove_files(self, key: str):
+        for path in (self._path(key), self._path(key) + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+        }
+
+
+# Collects a body as it streams to the client; commit() publishes it, and
+# anything else (an upstream error, a client disconnect) discards it. The
+# methods block on the disk, so tee() calls them from worker threads, where
+# a cancelled request's last write may still run alongside or after its
+# discard; the lock and the discarded flag make that write a no-op.
+class CacheWriter:
+    def __init__(self, cache: DiskCache, key: str, headers: dict[str, str]):
+        self._cache = cache
+        self._key = key
+        self._headers = headers
+        self._size = 0
+        self._file = None
+        self._discarded = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._file is None:
+            fd, self._tmp_path = tempfile.mkstemp(dir=self._cache.directory, suffix=".tmp")
+            self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes):
+        with self._lock:
+            if self._discarded:
+                return
+            self._open()
+            self._file.write(chunk)
+            self._size += len(chunk)
+
+    def commit(self):
+        with self._lock:
+            self._open()
+            self._file.close()
+            self._cache._publish(self._key, self._tmp_path, self._headers, self._size)
+            self._file = None
+
+    def discard(self):
+        with self._lock:
+            self._discarded = True
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            try:
+                os.remove(self._tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+async def tee(chunks, writer: CacheWriter):
+    # Yield upstream chunks to the client while copying them into the cache.
+    # Each chunk is written in a thread while it is relayed, so the disk
+    # holds up neither the event loop nor the client.
+    completed = False
+    pending = None
+    try:
+        async for chunk in chunks:
+            if pending is not None:
+                await pending
+            pending = asyncio.ensure_future(asyncio.to_thread(writer.write, chunk))
+            yield chunk
+        if pending is not None:
+            await pending
+        completed = True
+    finally:
+        # A write still running when the client went away finishes in its
+        # thread, and discard() waits for it; one that already failed has its
+        # error dropped along with the entry
+        if pending is not None and not pending.cancel() and not pending.cancelled():
+            pending.exception()
+        # commit() renames into place and may evict older entries
+        await asyncio.to_thread(writer.commit if completed else writer.discard)
+
+
+def create_cache():
+    max_bytes = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+    if max_bytes <= 0:
+        return None
+    directory = os.getenv("IMAGE_CACHE_DIR", os.path.join(os.path.dirname(__file__), "..", "..", "image_cache"))
+    return DiskCache(directory, max_bytes)
@@ -1,26 +1,130 @@
+from dotenv import load_dotenv
+
+# Load settings before the app modules read them at import time
+load_dotenv(dotenv_path=".env")
+
+import asyncio
 import httpx
-from fastapi import FastAPI, Depends, HTTPException, Query, status
-from fastapi.responses import StreamingResponse, FileResponse
+import logging
+import json
+import time
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from pydantic import ValidationError
+from starlette.background import BackgroundTask
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Union
+
+from . import crud, models, schemas, auth, upstream, image_cache, bootstrap, http_cache, prefetch, metrics, profiling, crawler
+from .singleflight import create_single_flight
+from .database import AsyncSessionLocal, async_engine, engine, get_db
+from .pools import candidate_pools
+from .counts import image_counts
+from .delivery import CountedResponse, delivery_stats
+from .passwords import PasswordPoolBusy, password_hasher
+from .shared import shared_state
+from .tag_index import tag_index
+from .tags import tag_cache
+from .user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Create or upgrade the database schema and seed the admin user, once
+# across all worker processes
+bootstrap.run(engine)
 
-from . import crud, models, schemas, auth
-from .database import SessionLocal, engine, Base
+app = FastAPI()
 
-# Create database tables on startup
-Base.metadata.create_all(bind=engine)
+@app.on_event("startup")
+async def open_upstream_client():
+    # One pooled client for every proxied image, so AList connections are reused
+    app.state.http_client = upstream.create_client()
+    app.state.image_cache = image_cache.create_cache()
+    app.state.upstream_flights = create_single_flight()
+    app.state.prefetcher = prefetch.create_prefetcher(app.state.http_client, app.state.upstream_flights, app.state.image_cache)
+    app.state.crawler = crawler.create_crawler(app.state.http_client, app.state.image_cache)
 
-app = FastAPI()
+@app.on_event("startup")
+async def register_metrics():
+    # Read at scrape time from the stats the components already keep
+    metrics.collector.add_cache("images", lambda: app.state.image_cache.stats() if app.state.image_cache else None)
+    metrics.collector.add_cache("tags", tag_cache.stats)
+    metrics.collector.add_cache("counts", image_counts.stats)
+    metrics.collector.add_cache("users", user_cache.stats)
+    metrics.collector.add_cache("prefetch", app.state.prefetcher.stats)
+    metrics.collector.add_gauges("upstream_flights", app.state.upstream_flights.stats)
+    metrics.collector.add_gauges("password_pool", password_hasher.stats)
+    metrics.collector.add_gauges("threadpool", metrics.threadpool_stats)
 
 @app.on_event("startup")
-def on_startup():
-    db = SessionLocal()
-    user = crud.get_user_by_username(db, username="admin")
-    if not user:
-        user_in = schemas.UserCreate(username="admin", password="admin")
-        crud.create_user(db=db, user=user_in, is_admin=True)
-    db.close()
+async def start_shared_state():
+    # Follows the other workers' changes from here on, so it starts before
+    # the tag index loads
+    shared_state.add_stats("delivery", lambda: delivery_stats.report()["totals"])
+    shared_state.add_stats("prefetch", lambda: {name: value for name, value in app.state.prefetcher.stats().items() if name != "latency"})
+    shared_state.add_stats("password_pool", password_hasher.stats)
+    shared_state.add_stats("images", lambda: app.state.image_cache.stats() if app.state.image_cache else None)
+    await shared_state.start()
+    if shared_state.enabled:
+        # Listing ETags follow the shared feed from where this worker joined
+        http_cache.reset_versions(shared_state.position)
+
+@app.on_event("startup")
+async def load_tag_index():
+    # Loaded in the background; tag filters use SQL until it is ready
+    async def load():
+        try:
+            async with AsyncSessionLocal() as db:
+                await tag_index.build(db)
+        except Exception:
+            logger.exception("Loading the tag index failed")
+    app.state.tag_index_task = asyncio.create_task(load())
+
+@app.on_event("startup")
+async def resume_crawls():
+    # Carries on with crawls interrupted by a restart, and takes over those
+    # of workers that died
+    app.state.crawler.open()
+
+@app.on_event("shutdown")
+async def stop_crawls():
+    # Running crawls save their checkpoint before the client closes
+    await app.state.crawler.close()
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    app.state.prefetcher.close()
+    await app.state.http_client.aclose()
+
+@app.on_event("shutdown")
+async def close_password_pool():
+    password_hasher.shutdown()
+
+@app.on_event("shutdown")
+async def close_shared_state():
+    await shared_state.close()
+
+@app.exception_handler(PasswordPoolBusy)
+async def password_pool_busy(request: Request, exc: PasswordPoolBusy):
+    # Every bcrypt slot and queue place is taken; ask the client to back off
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": "Too many password operations in progress, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+if metrics.ENABLED:
+    metrics.instrument_engine(engine)
+    metrics.instrument_engine(async_engine.sync_engine)
+    app.add_middleware(metrics.MetricsMiddleware)
+
+if profiling.query_profiler.enabled:
+    profiling.query_profiler.instrument(engine, explain_engine=engine)
+    profiling.query_profiler.instrument(async_engine.sync_engine, explain_engine=engine)
+    if profiling.query_profiler.track_requests:
+        app.add_middleware(profiling.QueryProfilingMiddleware)
 
 # CORS Middleware
 from fastapi.middleware.cors import CORSMiddleware
@@ -32,22 +136,13 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 import os
-from fastapi import Request
 
 class AppConfig(schemas.BaseModel):
     api_endpoint: str
 
 @app.get("/api/config", response_model=AppConfig)
-def get_app_config(request: Request):
+async def get_app_config(request: Request):
     # Construct the base URL from the request
     # This is more reliable than env vars when behind a reverse proxy
     base_url = str(request.base_url)
@@ -56,52 +151,52 @@ def get_app_config(request: Request):
     return AppConfig(api_endpoint=base_url)
 
 @app.post("/api/users/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     if user.username == "admin":
         raise HTTPException(status_code=400, detail="Cannot register with username 'admin'")
-    db_user = crud.get_user_by_username(db, username=user.username)
+    db_user = await crud.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return crud.create_user(db=db, user=user)
+    return await crud.create_user(db=db, user=user)
 
 @app.get("/api/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def read_users(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    users = crud.get_users(db, skip=skip, limit=limit)
+    users = await crud.get_users(db, skip=skip, limit=limit)
     return users
 
 @app.delete("/api/users/{user_id}", response_model=schemas.User)
-def delete_user(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
-    user_to_delete = crud.get_user(db, user_id=user_id)
+    user_to_delete = await crud.get_user(db, user_id=user_id)
     if not user_to_delete:
         raise HTTPException(status_code=404, detail="User not found")
     
     if user_to_delete.is_admin:
         raise HTTPException(status_code=400, detail="Cannot delete an admin user")
 
-    return crud.delete_user_by_id(db, user_id=user_id)
+    return await crud.delete_user_by_id(db, user_id=user_id)
 
 @app.get("/api/users/me", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
+async def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
     return current_user
 
 @app.put("/api/users/me", response_model=schemas.User)
-def update_user_me(user_update: schemas.UserUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def update_user_me(user_update: schemas.UserUpdate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     # Check if new username is already taken
-    if user_update.username and crud.get_user_by_username(db, username=user_update.username):
+    if user_update.username and await crud.get_user_by_username(db, username=user_update.username):
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    updated_user = crud.update_user(db, user_id=current_user.id, user_update=user_update)
+    updated_user = await crud.update_user(db, user_id=current_user.id, user_update=user_update)
     return updated_user
 
 @app.post("/api/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.get_user_by_username(db, username=form_data.username)
-    if not user or not crud.pwd_context.verify(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await crud.authenticate_user(db, username=form_data.username, password=form_data.password)
+    if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -111,34 +206,104 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/api/images/", response_model=schemas.Image)
-def create_image(image: schemas.ImageCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    return crud.create_image(db=db, image=image, user_id=current_user.id)
+async def create_image(image: schemas.ImageCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return await crud.create_image(db=db, image=image, user_id=current_user.id)
+
+async def read_ndjson_images(request: Request):
+    # One image per line: a JSON string URL or {"url": ..., "description": ...}
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_ndjson_image(line)
+    if buffer.strip():
+        yield parse_ndjson_image(buffer)
+
+def parse_ndjson_image(line: bytes):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid NDJSON line: {line[:200]!r}")
+    if isinstance(entry, str):
+        return entry, None
+    if isinstance(entry, dict) and isinstance(entry.get("url"), str):
+        return entry["url"], entry.get("description")
+    raise HTTPException(status_code=400, detail=f"Invalid NDJSON line: {line[:200]!r}")
+
+class BulkImportResult(schemas.BaseModel):
+    created: int
+    # URLs that already existed, or repeated within the body
+    skipped: int
+
+@app.post(
+    "/api/images/bulk",
+    response_model=Union[List[schemas.Image], BulkImportResult],
+    openapi_extra={"requestBody": {"content": {
+        "application/json": {"schema": schemas.ImageBulkCreate.model_json_schema()},
+        "application/x-ndjson": {"schema": {"type": "string"}},
+    }}},
+)
+async def create_bulk_images(request: Request, tags: List[str] = Query([]), db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # Large imports can stream an NDJSON body instead of one JSON array;
+    # tags for NDJSON imports come from the query string, and the response
+    # only counts the images, so it stays small however big the body is.
+    # Each chunk of 500 lines commits as it arrives; a bad line fails the
+    # request but keeps the chunks before it.
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        created = received = 0
+        async for images, entries in crud.import_images(db, read_ndjson_images(request), tags=tags, user_id=current_user.id):
+            created += len(images)
+            received += entries
+        return BulkImportResult(created=created, skipped=received - created)
 
-@app.post("/api/images/bulk", response_model=List[schemas.Image])
-def create_bulk_images(bulk_data: schemas.ImageBulkCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    return crud.create_bulk_images(db=db, bulk_data=bulk_data, user_id=current_user.id)
+    try:
+        bulk_data = schemas.ImageBulkCreate.model_validate_json(await request.body())
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+    return await crud.create_bulk_images(db=db, bulk_data=bulk_data, user_id=current_user.id)
 
 class PaginatedImages(schemas.BaseModel):
-    total: int
+    # None when requested with total=none
+    total: Optional[int]
     images: List[schemas.Image]
+    # Pass back as ?cursor= to fetch the next page without OFFSET
+    next_cursor: Optional[str] = None
 
 @app.get("/api/images/", response_model=PaginatedImages)
-def read_images(
+async def read_images(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 10,
     tags: Optional[List[str]] = Query(None),
     sort_by: str = 'created_at',
     sort_order: str = 'desc',
     filename_like: Optional[str] = Query(None),
-    db: Session = Depends(get_db),
+    # Substring search over filename and description; combine with
+    # sort_by=relevance for ranked results
+    search: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    total: str = Query("exact", pattern="^(exact|estimate|none)$"),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    result = crud.get_images(db, user_id=current_user.id, skip=skip, limit=limit, tags=tags, sort_by=sort_by, sort_order=sort_order, filename_like=filename_like)
+    # The version is read before querying: a write that lands mid-query only
+    # makes the next request miss, never pins a stale page
+    headers = http_cache.listing_headers(request, current_user.id, http_cache.image_versions.get(current_user.id))
+    if http_cache.not_modified(request, headers):
+        return http_cache.not_modified_response(headers)
+    try:
+        result = await crud.get_images(db, user_id=current_user.id, skip=skip, limit=limit, tags=tags, sort_by=sort_by, sort_order=sort_order, filename_like=filename_like, cursor=cursor, total=total, search=search)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    response.headers.update(headers)
     return result
 
 @app.delete("/api/images/{image_id}", response_model=schemas.Image)
-def delete_image(image_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    db_image = crud.delete_image(db, image_id=image_id, user_id=current_user.id)
+async def delete_image(image_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    db_image = await crud.delete_image(db, image_id=image_id, user_id=current_user.id)
     if db_image is None:
         raise HTTPException(status_code=404, detail="Image not found")
     return db_image
@@ -147,15 +312,15 @@ class BulkDeleteImages(schemas.BaseModel):
     image_ids: List[int]
 
 @app.post("/api/images/bulk-delete")
-def delete_images_bulk(data: BulkDeleteImages, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    return crud.delete_images_bulk(db, image_ids=data.image_ids, user_id=current_user.id)
+async def delete_images_bulk(data: BulkDeleteImages, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return await crud.delete_images_bulk(db, image_ids=data.image_ids, user_id=current_user.id)
 
 class ImageUpdateTags(schemas.BaseModel):
     tags: List[str]
 
 @app.put("/api/images/{image_id}/tags", response_model=schemas.Image)
-def update_image_tags(image_id: int, tags_data: ImageUpdateTags, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    db_image = crud.update_image_tags(db, image_id=image_id, tags=tags_data.tags, user_id=current_user.id)
+async def update_image_tags(image_id: int, tags_data: ImageUpdateTags, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    db_image = await crud.update_image_tags(db, image_id=image_id, tags=tags_data.tags, user_id=current_user.id)
     if db_image is None:
         raise HTTPException(status_code=404, detail="Image not found")
     return db_image
@@ -164,66 +329,333 @@ class BulkAddTags(schemas.BaseModel):
     image_ids: List[int]
     tags: List[str]
 
-@app.post("/api/images/bulk-add-tags", response_model=List[schemas.Image])
-def add_tags_to_images_bulk(data: BulkAddTags, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    images = crud.add_tags_to_images_bulk(db, image_ids=data.image_ids, tags=data.tags, user_id=current_user.id)
-    if images is None:
+class BulkTagsResult(schemas.BaseModel):
+    images: int
+    added: int
+    removed: int
+
+async def retag_images_bulk(data: BulkAddTags, mode: str, full: bool, db: AsyncSession, current_user: models.User):
+    result = await crud.retag_images_bulk(db, image_ids=data.image_ids, tags=data.tags, user_id=current_user.id, mode=mode)
+    if result is None:
         raise HTTPException(status_code=404, detail="One or more images not found")
-    return images
+    # Serializing every image is expensive for large selections, so the
+    # affected counts are returned unless the caller asks for the images
+    if full:
+        return await crud.get_images_by_ids(db, result["image_ids"])
+    return BulkTagsResult(**result)
+
+@app.post("/api/images/bulk-add-tags", response_model=Union[BulkTagsResult, List[schemas.Image]])
+async def add_tags_to_images_bulk(data: BulkAddTags, full: bool = False, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return await retag_images_bulk(data, "add", full, db, current_user)
+
+@app.post("/api/images/bulk-remove-tags", response_model=Union[BulkTagsResult, List[schemas.Image]])
+async def remove_tags_from_images_bulk(data: BulkAddTags, full: bool = False, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return await retag_images_bulk(data, "remove", full, db, current_user)
+
+@app.post("/api/images/bulk-replace-tags", response_model=Union[BulkTagsResult, List[schemas.Image]])
+async def replace_tags_on_images_bulk(data: BulkAddTags, full: bool = False, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return await retag_images_bulk(data, "replace", full, db, current_user)
 
 @app.put("/api/images/{image_id}/rename", response_model=schemas.Image)
-def rename_image(image_id: int, image_update: schemas.ImageUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    db_image = crud.update_image_filename(db, image_id=image_id, filename=image_update.filename, user_id=current_user.id)
+async def rename_image(image_id: int, image_update: schemas.ImageUpdate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    db_image = await crud.update_image_filename(db, image_id=image_id, filename=image_update.filename, user_id=current_user.id)
     if db_image is None:
         raise HTTPException(status_code=404, detail="Image not found")
     return db_image
 
 @app.get("/api/random/")
-def get_random_image_url(tag: Optional[str] = None, db: Session = Depends(get_db)):
-    random_image = crud.get_random_image(db, tag_name=tag)
+async def get_random_image_url(response: Response, tag: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    random_image = await crud.get_random_image(db, tag_name=tag)
     if random_image is None:
         raise HTTPException(status_code=404, detail="No images found")
+    response.headers["Cache-Control"] = http_cache.RANDOM_CACHE_CONTROL
     return {"url": random_image.url}
 
 @app.post("/api/keys/", response_model=schemas.ApiKey)
-def create_api_key(api_key: schemas.ApiKeyCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    return crud.create_api_key(db=db, api_key=api_key, user_id=current_user.id)
+async def create_api_key(api_key: schemas.ApiKeyCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return await crud.create_api_key(db=db, api_key=api_key, user_id=current_user.id)
 
 @app.get("/api/keys/", response_model=List[schemas.ApiKey])
-def read_api_keys(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    api_keys = crud.get_api_keys(db, user_id=current_user.id, skip=skip, limit=limit)
+async def read_api_keys(request: Request, response: Response, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    headers = http_cache.listing_headers(request, current_user.id, http_cache.api_key_versions.get(current_user.id))
+    if http_cache.not_modified(request, headers):
+        return http_cache.not_modified_response(headers)
+    api_keys = await crud.get_api_keys(db, user_id=current_user.id, skip=skip, limit=limit)
+    response.headers.update(headers)
     return api_keys
 
 @app.delete("/api/keys/{api_key_id}", response_model=schemas.ApiKey)
-def delete_api_key(api_key_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    db_api_key = crud.delete_api_key(db, api_key_id=api_key_id, user_id=current_user.id)
+async def delete_api_key(api_key_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    db_api_key = await crud.delete_api_key(db, api_key_id=api_key_id, user_id=current_user.id)
     if db_api_key is None:
         raise HTTPException(status_code=404, detail="API Key not found")
     return db_api_key
 
-@app.get("/api/v1/random/{key}")
-async def get_random_image_by_key(key: str, db: Session = Depends(get_db)):
-    random_image = crud.get_random_image_by_api_key(db, key=key)
-    if random_image is None:
-        raise HTTPException(status_code=404, detail="No images found for this key")
+@app.put("/api/keys/{api_key_id}/mode", response_model=schemas.ApiKey)
+async def update_api_key_mode(api_key_id: int, mode_data: schemas.ApiKeyUpdateMode, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    db_api_key = await crud.update_api_key(db, api_key_id=api_key_id, user_id=current_user.id, mode=mode_data.mode)
+    if db_api_key is None:
+        raise HTTPException(status_code=404, detail="API Key not found")
+    return db_api_key
 
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.get(random_image.url, follow_redirects=True)
-            resp.raise_for_status()
+@app.put("/api/keys/{api_key_id}/prefetch", response_model=schemas.ApiKey)
+async def update_api_key_prefetch(api_key_id: int, prefetch_data: schemas.ApiKeyUpdatePrefetch, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    db_api_key = await crud.update_api_key(db, api_key_id=api_key_id, user_id=current_user.id, prefetch_depth=prefetch_data.prefetch_depth)
+    if db_api_key is None:
+        raise HTTPException(status_code=404, detail="API Key not found")
+    return db_api_key
+
+def crawl_job_response(db_job: models.CrawlJob):
+    job = schemas.CrawlJob.model_validate(db_job)
+    progress = app.state.crawler.progress(db_job.id)
+    if progress is not None:
+        job.progress = progress
+    return job
+
+async def get_crawl_job_or_404(db: AsyncSession, job_id: int, user_id: int):
+    db_job = await crud.get_crawl_job(db, job_id=job_id, user_id=user_id)
+    if db_job is None:
+        raise HTTPException(status_code=404, detail="Crawl not found")
+    return db_job
+
+@app.post("/api/crawls/", response_model=schemas.CrawlJob)
+async def create_crawl(crawl: schemas.CrawlJobCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # Imports every image under an AList directory into the user's library,
+    # in the background; poll the job for progress
+    if not crawl.base_url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="base_url must be an http(s) URL of the AList server")
+    db_job = await crud.create_crawl_job(db, crawl=crawl, user_id=current_user.id)
+    await app.state.crawler.start(db_job.id)
+    await db.refresh(db_job)
+    return crawl_job_response(db_job)
+
+@app.get("/api/crawls/", response_model=List[schemas.CrawlJob])
+async def read_crawls(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return [crawl_job_response(db_job) for db_job in await crud.get_crawl_jobs(db, user_id=current_user.id)]
+
+@app.get("/api/crawls/{job_id}", response_model=schemas.CrawlJob)
+async def read_crawl(job_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    return crawl_job_response(await get_crawl_job_or_404(db, job_id, current_user.id))
+
+@app.post("/api/crawls/{job_id}/sync", response_model=schemas.CrawlJob)
+async def sync_crawl(job_id: int, full: bool = False, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # Resumes an unfinished pass, or starts an incremental one; full=true
+    # starts over and looks at every file
+    db_job = await get_crawl_job_or_404(db, job_id, current_user.id)
+    if not await app.state.crawler.start(db_job.id, full=full):
+        raise HTTPException(status_code=409, detail="Crawl is already running")
+    await db.refresh(db_job)
+    return crawl_job_response(db_job)
+
+@app.post("/api/crawls/{job_id}/cancel", response_model=schemas.CrawlJob)
+async def cancel_crawl(job_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # Keeps the checkpoint, so a later sync resumes the pass
+    db_job = await get_crawl_job_or_404(db, job_id, current_user.id)
+    if db_job.status != "running":
+        raise HTTPException(status_code=409, detail="Crawl is not running")
+    await app.state.crawler.cancel(db_job.id)
+    await db.refresh(db_job)
+    return crawl_job_response(db_job)
+
+@app.delete("/api/crawls/{job_id}", response_model=schemas.CrawlJob)
+async def delete_crawl(job_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # Imported images stay
+    db_job = await get_crawl_job_or_404(db, job_id, current_user.id)
+    if db_job.status in ("running", "cancelling"):
+        raise HTTPException(status_code=409, detail="Cancel the crawl before deleting it")
+    response = crawl_job_response(db_job)
+    await crud.delete_crawl_job(db, db_job)
+    return response
+
+@app.get("/api/admin/pools")
+async def read_candidate_pools(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    pools = candidate_pools.memory_report()
+    return {"total_bytes": sum(pool["bytes"] for pool in pools), "pools": pools}
 
-            # Force content type to a common image type to prevent download
-            content_type = resp.headers.get("Content-Type", "image/png")
-            if "application" in content_type:
-                content_type = "image/png" # Fallback for incorrect server headers
+@app.get("/api/admin/tag-index")
+async def read_tag_index_stats(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return tag_index.stats()
 
-            return StreamingResponse(resp.iter_bytes(), media_type=content_type)
-        except httpx.RequestError as exc:
-            raise HTTPException(status_code=500, detail=f"Error fetching image from source: {exc}")
+@app.post("/api/admin/tag-index/check")
+async def check_tag_index(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    differences = await tag_index.check(db)
+    if differences is None:
+        raise HTTPException(status_code=409, detail="Tag index is not loaded")
+    consistent = not differences["images"] and not differences["tags"] and not differences["owners"]
+    return {"consistent": consistent, **differences}
+
+@app.post("/api/admin/tag-index/rebuild")
+async def rebuild_tag_index(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    if not tag_index.enabled:
+        raise HTTPException(status_code=409, detail="Tag index is disabled")
+    await tag_index.build(db)
+    return tag_index.stats()
 
-from dotenv import load_dotenv
+@app.get("/api/admin/password-pool")
+async def read_password_pool_stats(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return password_hasher.stats()
 
-load_dotenv(dotenv_path=".env")
+@app.get("/api/admin/delivery")
+async def read_delivery_stats(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return delivery_stats.report()
+
+@app.get("/api/admin/prefetch")
+async def read_prefetch_stats(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return app.state.prefetcher.stats()
+
+@app.get("/api/admin/cache")
+async def read_image_cache_stats(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    cache = app.state.image_cache
+    stats = cache.stats() if cache else {"enabled": False}
+    return {**stats, "upstream": app.state.upstream_flights.stats(), "tags": tag_cache.stats(), "counts": image_counts.stats(), "users": user_cache.stats()}
+
+@app.get("/api/admin/workers")
+async def read_workers(current_user: models.User = Depends(auth.get_current_user)):
+    # Live worker processes, from their heartbeats, with their own stats
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return {"worker": shared_state.worker_id, "shared": shared_state.enabled, "workers": await shared_state.workers()}
+
+@app.get("/api/admin/queries")
+async def read_query_profile(current_user: models.User = Depends(auth.get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return profiling.query_profiler.stats()
+
+@app.post("/api/admin/profile")
+async def profile_live_traffic(
+    seconds: float = Query(10, gt=0, le=60),
+    interval_ms: float = Query(5, ge=1, le=100),
+    all_threads: bool = False,
+    current_user: models.User = Depends(auth.get_current_user),
+):
+    # Samples the server for the given time and returns folded stacks for
+    # flamegraph.pl or speedscope
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    try:
+        stacks = await profiling.sampling_profiler.profile(seconds, interval_ms / 1000, all_threads)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return Response(stacks, media_type="text/plain")
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics(request: Request):
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not metrics.authorized(request.headers.get("Authorization")):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+@app.get("/api/v1/random/{key}")
+async def get_random_image_by_key(
+    key: str,
+    request: Request,
+    # Overrides the key's own mode. With redirect and json the client fetches
+    # the image from AList itself, so its bytes never pass through here
+    mode: Optional[str] = Query(None, pattern="^(proxy|redirect|json)$"),
+    db: AsyncSession = Depends(get_db),
+):
+    started = time.perf_counter()
+    pool = await crud.get_api_key_pool(db, key=key)
+    if pool is None:
+        raise HTTPException(status_code=404, detail="No images found for this key")
+    mode = mode or pool.mode
+
+    # Proxied requests take a pick whose bytes were downloaded ahead of time
+    # when the key's prefetch buffer has one ready
+    prefetched = app.state.prefetcher.take(key, pool) if mode == "proxy" else None
+    if prefetched is not None:
+        response = await proxy_image(prefetched.url, request, prefetched)
+    else:
+        random_image = await crud.get_random_image_from_pool(db, pool)
+        if random_image is None:
+            raise HTTPException(status_code=404, detail="No images found for this key")
+        if mode != "proxy":
+            delivery_stats.record(pool.api_key_id, pool.name, mode)
+            headers = {"Cache-Control": http_cache.RANDOM_CACHE_CONTROL}
+            if mode == "redirect":
+                return RedirectResponse(random_image.url, status_code=status.HTTP_302_FOUND, headers=headers)
+            return JSONResponse({"url": random_image.url}, headers=headers)
+        response = await proxy_image(random_image.url, request)
+    app.state.prefetcher.record_latency(prefetched is not None, time.perf_counter() - started)
+    return CountedResponse(response, lambda sent: delivery_stats.record(pool.api_key_id, pool.name, mode, sent))
+
+async def proxy_image(url: str, request: Request, prefetched: Optional[prefetch.Prefetched] = None):
+    # Conditional requests are answered against the validators AList sent
+    # for whichever image was picked, so a CDN revalidating its copy gets a
+    # 304 only when the pick is the image it already holds
+    if prefetched is not None and prefetched.body is not None and not upstream.range_headers(request.headers):
+        # Held in memory because the disk cache is off
+        headers = {**prefetched.headers, "Cache-Control": http_cache.RANDOM_CACHE_CONTROL}
+        if http_cache.not_modified(request, headers):
+            return http_cache.not_modified_response(headers)
+        return Response(prefetched.body, media_type=prefetched.content_type, headers=headers)
+
+    cache = app.state.image_cache
+    cached = cache.get(url) if cache else None
+    if cached:
+        path, headers = cached
+        headers["Cache-Control"] = http_cache.RANDOM_CACHE_CONTROL
+        if http_cache.not_modified(request, headers):
+            return http_cache.not_modified_response(headers)
+        # FileResponse serves Range and If-Range itself
+        return FileResponse(path, media_type=headers.pop("Content-Type"), headers=headers)
+
+    range_headers = upstream.range_headers(request.headers)
+    if range_headers:
+        return await proxy_range(url, range_headers)
+
+    # Concurrent requests for the same URL share one upstream download
+    flight = app.state.upstream_flights.join(app.state.http_client, url, cache)
+    try:
+        await flight.wait_ready()
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Error fetching image from source: {exc}")
+
+    headers = {**flight.headers, "Cache-Control": http_cache.RANDOM_CACHE_CONTROL}
+    if http_cache.not_modified(request, headers):
+        # The download carries on in the background and still fills the cache
+        flight.close()
+        return http_cache.not_modified_response(headers)
+    # Relay upstream chunks as they arrive instead of buffering the whole image
+    return StreamingResponse(flight.stream(), media_type=flight.content_type, headers=headers)
+
+async def proxy_range(url: str, range_headers: dict[str, str]):
+    # Partial fetches go straight to AList, bypassing the shared download and
+    # the cache, and AList's 206 or 200 is relayed as-is
+    try:
+        resp = await upstream.open_stream(app.state.http_client, url, headers=range_headers)
+    except httpx.HTTPStatusError as exc:
+        if exc.response.status_code == 416:
+            content_range = exc.response.headers.get("Content-Range")
+            raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": content_range} if content_range else None)
+        raise HTTPException(status_code=500, detail=f"Error fetching image from source: {exc}")
+    except (httpx.HTTPError, httpx.InvalidURL) as exc:
+        raise HTTPException(status_code=500, detail=f"Error fetching image from source: {exc}")
+    headers = {**upstream.passthrough_headers(resp), "Cache-Control": http_cache.RANDOM_CACHE_CONTROL}
+    return StreamingResponse(metrics.count_upstream_bytes(resp.aiter_raw()), status_code=resp.status_code, media_type=upstream.media_type(resp), headers=headers, background=BackgroundTask(resp.aclose))
 
 # --- Static files and SPA hosting ---
 # This must be at the end of the file to ensure API routes are matched first.
@@ -0,0 +1,207 @@
+import os
+import secrets
+import time
+from contextvars import ContextVar
+
+import anyio.to_thread
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+from sqlalchemy import event
+
+# Prometheus metrics, served on /metrics.
+#
+# Requests are timed by an ASGI middleware, labelled with the route template
+# rather than the raw path so keys and ids do not explode the label set. Each
+# request carries a RequestStats in a context variable that the SQLAlchemy
+# cursor events add to, so a route's database time and query count can be
+# told apart from upstream and streaming time. Everything the caches and
+# pools already count is read from their stats() at scrape time instead of
+# being tracked twice on the hot path.
+
+# Off unless asked for: the numbers show traffic per route and the size of
+# every cache and pool. METRICS_TOKEN, when set, is required as a bearer
+# token, which scrapers can send without logging in.
+ENABLED = os.getenv("METRICS_ENABLED", "false").lower() not in ("0", "false", "no")
+TOKEN = os.getenv("METRICS_TOKEN") or None
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time from request to the last body byte, streaming included",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+FIRST_BYTE_SECONDS = Histogram(
+    "http_time_to_first_byte_seconds", "Time from request to response headers",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries run by one request", ["route"], buckets=COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Database time spent by one request", ["route"], buckets=LATENCY_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Duration of single database statements", ["operation"], buckets=QUERY_BUCKETS,
+)
+UPSTREAM_FIRST_BYTE_SECONDS = Histogram(
+    "upstream_time_to_first_byte_seconds", "Time until AList answered with response headers", buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_BYTES = Counter("upstream_bytes", "Image bytes received from AList")
+UPSTREAM_ERRORS = Counter("upstream_errors", "Failed fetches from AList")
+
+
+class RequestStats:
+    __slots__ = ("db_queries", "db_seconds")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+
+request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+
+# labels() takes a lock and builds a key on every call, so the labelled
+# children are looked up once and kept
+_query_children = {}
+_route_children = {}
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    operation = statement.lstrip()[:6].upper()
+    child = _query_children.get(operation)
+    if child is None:
+        child = _query_children[operation] = DB_QUERY_SECONDS.labels(operation)
+    child.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_seconds += elapsed
+
+def instrument_engine(engine):
+    # Takes a sync Engine; pass async_engine.sync_engine for the async one
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def observe_upstream_first_byte(seconds: float):
+    UPSTREAM_FIRST_BYTE_SECONDS.observe(seconds)
+
+
+async def count_upstream_bytes(chunks):
+    # Counted once per response rather than once per chunk
+    received = 0
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            yield chunk
+    finally:
+        UPSTREAM_BYTES.inc(received)
+
+
+class MetricsMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware, which would buffer every
+    # streamed body through an extra task
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+
+        async def send_and_time(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                _children(scope, status)[0].observe(time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_time)
+        finally:
+            request_stats.reset(token)
+            _, duration, db_queries, db_seconds = _children(scope, status)
+            duration.observe(time.perf_counter() - started)
+            db_queries.observe(stats.db_queries)
+            db_seconds.observe(stats.db_seconds)
+
+
+def _children(scope, status: int):
+    # The router stores the matched route in the scope; static files and
+    # unmatched paths share one label
+    method, route = scope["method"], getattr(scope.get("route"), "path", None) or "other"
+    key = (method, route, status)
+    children = _route_children.get(key)
+    if children is None:
+        children = _route_children[key] = (
+            FIRST_BYTE_SECONDS.labels(method, route),
+            REQUEST_SECONDS.labels(method, route, str(status)),
+            REQUEST_DB_QUERIES.labels(route),
+            REQUEST_DB_SECONDS.labels(route),
+        )
+    return children
+
+
+# Reads counters and gauges at scrape time from the stats() dicts that the
+# caches, pools and executors already keep
+class StatsCollector:
+    def __init__(self):
+        self._caches = {}
+        self._gauges = {}
+
+    def add_cache(self, name: str, stats):
+        # stats() returns a dict with hits and misses
+        self._caches[name] = stats
+
+    def add_gauges(self, name: str, stats):
+        # stats() returns a dict of numbers, each exported as name_key
+        self._gauges[name] = stats
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Cache lookups that hit", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache lookups that missed", labels=["cache"])
+        for name, stats in self._caches.items():
+            values = stats()
+            if values is None:
+                continue
+            hits.add_metric([name], values.get("hits", 0))
+            misses.add_metric([name], values.get("misses", 0))
+        yield hits
+        yield misses
+        for name, stats in self._gauges.items():
+            for key, value in (stats() or {}).items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield GaugeMetricFamily(f"{name}_{key}", f"{key} from {name}", value=value)
+
+
+def threadpool_stats():
+    # Starlette runs sync dependencies and file I/O on anyio's default
+    # limiter; borrowed == total means requests are queueing for a thread
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {"borrowed": limiter.borrowed_tokens, "total": limiter.total_tokens}
+
+
+collector = StatsCollector()
+if ENABLED:
+    REGISTRY.register(collector)
+
+
+def authorized(authorization: str | None) -> bool:
+    if TOKEN is None:
+        return True
+    scheme, _, credentials = (authorization or "").partition(" ")
+    return scheme.lower() == "bearer" and secrets.compare_digest(credentials.strip().encode(), TOKEN.encode())
+
+
+def render():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,76 @@
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select
+
+from . import models, search
+from .database import Base
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema upgrades, applied in order at startup. The applied versions
+# are recorded in schema_version.
+#
+# A fresh database gets the current models from the first migration, so every
+# later migration also runs against a schema that already has its changes and
+# must be idempotent: IF NOT EXISTS, checkfirst, or an inspector check.
+
+schema_version = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+def _create_tables(conn):
+    Base.metadata.create_all(bind=conn)
+
+def _create_model_indexes(conn):
+    # Indexes declared in models.py, for databases created before them
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+def _add_api_key_mode(conn):
+    if "mode" not in {column["name"] for column in inspect(conn).get_columns("api_keys")}:
+        conn.exec_driver_sql("ALTER TABLE api_keys ADD COLUMN mode VARCHAR DEFAULT 'proxy' NOT NULL")
+
+def _add_api_key_prefetch_depth(conn):
+    if "prefetch_depth" not in {column["name"] for column in inspect(conn).get_columns("api_keys")}:
+        conn.exec_driver_sql("ALTER TABLE api_keys ADD COLUMN prefetch_depth INTEGER")
+
+def _create_crawl_jobs(conn):
+    models.CrawlJob.__table__.create(bind=conn, checkfirst=True)
+
+MIGRATIONS = [
+    (1, "create tables", _create_tables),
+    (2, "filename search index", search.create_schema),
+    (3, "listing, tag and api key indexes", _create_model_indexes),
+    (4, "api key delivery mode", _add_api_key_mode),
+    (5, "api key prefetch depth", _add_api_key_prefetch_depth),
+    (6, "alist crawl jobs", _create_crawl_jobs),
+]
+
+def current_version(conn) -> int:
+    schema_version.create(bind=conn, checkfirst=True)
+    return conn.scalar(select(func.max(schema_version.c.version))) or 0
+
+def upgrade(engine):
+    # Each migration commits on its own, so a failure keeps earlier ones
+    with engine.begin() as conn:
+        version = current_version(conn)
+        # Databases from before migrations existed have tables but no versions
+        upgrading = version > 0 or inspect(conn).has_table("images")
+    for number, name, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info("Applying migration %d: %s", number, name)
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(schema_version.insert().values(version=number, name=name))
+    with engine.connect() as conn:
+        search.detect(conn)
+        # Refresh planner statistics so the new indexes get picked on an
+        # upgraded database; a fresh one has nothing to measure yet
+        if upgrading and version < MIGRATIONS[-1][0] and conn.dialect.name in ("sqlite", "postgresql"):
+            conn.exec_driver_sql("ANALYZE")
+            conn.commit()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Table, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Table, ForeignKey, Boolean, Index, Float, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -6,11 +6,20 @@ from .database import Base
 ImageTagAssociation = Table(
     'image_tag_association', Base.metadata,
     Column('image_id', Integer, ForeignKey('images.id'), primary_key=True),
-    Column('tag_id', Integer, ForeignKey('tags.id'), primary_key=True)
+    Column('tag_id', Integer, ForeignKey('tags.id'), primary_key=True),
+    # The primary key leads with image_id; tag filters need tag -> images
+    Index('ix_image_tag_association_tag_image', 'tag_id', 'image_id')
 )
 
 class Image(Base):
     __tablename__ = "images"
+    __mapper_args__ = {"eager_defaults": True}
+    # Per-user listings filter on owner_id and sort by one of these
+    __table_args__ = (
+        Index("ix_images_owner_created_at", "owner_id", "created_at", "id"),
+        Index("ix_images_owner_filename", "owner_id", "filename", "id"),
+        Index("ix_images_owner_filetype", "owner_id", "filetype", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     url = Column(String, unique=True, index=True, nullable=False)
@@ -34,23 +43,30 @@ class Tag(Base):
 ApiKeyTagAssociationAnd = Table(
     'api_key_tag_association_and', Base.metadata,
     Column('api_key_id', Integer, ForeignKey('api_keys.id'), primary_key=True),
-    Column('tag_id', Integer, ForeignKey('tags.id'), primary_key=True)
+    Column('tag_id', Integer, ForeignKey('tags.id'), primary_key=True),
+    Index('ix_api_key_tag_association_and_tag', 'tag_id', 'api_key_id')
 )
 
 ApiKeyTagAssociationOr = Table(
     'api_key_tag_association_or', Base.metadata,
     Column('api_key_id', Integer, ForeignKey('api_keys.id'), primary_key=True),
-    Column('tag_id', Integer, ForeignKey('tags.id'), primary_key=True)
+    Column('tag_id', Integer, ForeignKey('tags.id'), primary_key=True),
+    Index('ix_api_key_tag_association_or_tag', 'tag_id', 'api_key_id')
 )
 
 class ApiKey(Base):
     __tablename__ = "api_keys"
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     key = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, unique=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    # How /api/v1/random/{key} delivers an image unless ?mode= says otherwise
+    mode = Column(String, nullable=False, default="proxy", server_default="proxy")
+    # Proxied picks to download ahead of time; NULL uses PREFETCH_DEPTH
+    prefetch_depth = Column(Integer, nullable=True)
 
     owner = relationship("User", back_populates="api_keys")
     tags_and = relationship("Tag", secondary=ApiKeyTagAssociationAnd)
@@ -65,4 +81,32 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
 
     images = relationship("Image", back_populates="owner")
-    api_keys = relationship("ApiKey", back_populates="owner")
\ No newline at end of file
+    api_keys = relationship("ApiKey", back_populates="owner")
+
+class CrawlJob(Base):
+    __tablename__ = "crawl_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    base_url = Column(String, nullable=False)
+    root = Column(String, nullable=False, default="/")
+    token = Column(String, nullable=True)
+    password = Column(String, nullable=True)
+    tags = Column(JSON, nullable=False, default=list)
+    # Also tag each image with the names of its directories below root
+    path_tags = Column(Boolean, nullable=False, default=False)
+    concurrency = Column(Integer, nullable=True)
+    # pending, running, interrupted, cancelled, failed or completed
+    status = Column(String, nullable=False, default="pending")
+    # The unfinished pass: directories left to list and its counters
+    checkpoint = Column(JSON, nullable=True)
+    progress = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    # The worker running the job, and when it last saved a checkpoint
+    runner = Column(String, nullable=True)
+    heartbeat_at = Column(Float, nullable=True)
+    # Start of the last completed pass; the next one only imports entries
+    # modified after it. Times are epoch seconds, like AList's.
+    synced_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
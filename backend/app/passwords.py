@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+# bcrypt runs in its own small pool instead of the default executor that sync
+# routes and file responses share. At most workers + queue operations are
+# admitted at once; anything beyond that fails fast with PasswordPoolBusy
+# (a 429) rather than piling up behind a login storm.
+
+_contexts: dict[int, CryptContext] = {}
+
+def _context(rounds: int) -> CryptContext:
+    context = _contexts.get(rounds)
+    if context is None:
+        context = _contexts[rounds] = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+    return context
+
+# Top-level so they can also run in worker processes
+def _hash(rounds: int, password: str):
+    started = time.perf_counter()
+    return _context(rounds).hash(password), time.perf_counter() - started
+
+def _verify_and_update(rounds: int, password: str, hashed_password: str):
+    started = time.perf_counter()
+    return _context(rounds).verify_and_update(password, hashed_password), time.perf_counter() - started
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, queue: int, rounds: int, use_processes: bool = False):
+        self.workers = workers
+        self.queue = queue
+        self.rounds = rounds
+        self.use_processes = use_processes
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.work_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, function, *args):
+        # in_flight is only touched on the event loop, so it needs no lock
+        if self.in_flight >= self.workers + self.queue:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        future = self.executor.submit(function, self.rounds, *args)
+        # A cancelled request stops waiting, but bcrypt keeps its worker until
+        # it finishes, so the slot is freed when the work is, not the request
+        future.add_done_callback(lambda future: loop.call_soon_threadsafe(self._finished, future, submitted))
+        result, _ = await asyncio.wrap_future(future)
+        return result
+
+    def _finished(self, future, submitted: float):
+        self.in_flight -= 1
+        if future.cancelled() or future.exception() is not None:
+            return
+        work_seconds = future.result()[1]
+        self.completed += 1
+        self.work_seconds += work_seconds
+        self.wait_seconds += max(0.0, time.perf_counter() - submitted - work_seconds)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    def hash_now(self, password: str) -> str:
+        # Blocking, for startup code that runs before the event loop
+        return _hash(self.rounds, password)[0]
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        # Returns (valid, new hash or None). A new hash comes back when the
+        # stored one used a different work factor than BCRYPT_ROUNDS.
+        return await self._run(_verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue": self.queue,
+            "processes": self.use_processes,
+            "rounds": self.rounds,
+            "in_flight": self.in_flight,
+            "running": min(self.in_flight, self.workers),
+            "waiting": max(0, self.in_flight - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_work_ms": self.work_seconds / self.completed * 1000 if self.completed else None,
+            "avg_wait_ms": self.wait_seconds / self.completed * 1000 if self.completed else None,
+        }
+
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1))),
+    queue=int(os.getenv("PASSWORD_HASH_QUEUE", 32)),
+    rounds=int(os.getenv("BCRYPT_ROUNDS", 12)),
+    use_processes=os.getenv("PASSWORD_HASH_PROCESSES", "false").lower() in ("1", "true", "yes"),
+)
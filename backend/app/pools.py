@@ -0,0 +1,162 @@
+import random
+import sys
+import threading
+import time
+from array import array
+
+
+# Ids of the images an API key can serve, plus the tag ids it filters on.
+#
+# Removing an id from the middle of image_ids means rewriting the array, so
+# removed ids are only recorded in a set and skipped by pick; the array is
+# compacted once they make up half of it, which keeps a removal O(1)
+# amortized and a pick under two tries on average. removals counts the
+# updates that took ids out, so a holder of an id picked earlier knows
+# whether it still needs checking.
+class CandidatePool:
+    __slots__ = ("api_key_id", "name", "mode", "prefetch_depth", "tags_and", "tags_or", "image_ids", "removed", "removals", "built_at")
+
+    def __init__(self, api_key_id: int, name: str, mode: str, prefetch_depth: int | None, tags_and: set[int], tags_or: set[int], image_ids):
+        self.api_key_id = api_key_id
+        self.name = name
+        self.mode = mode
+        self.prefetch_depth = prefetch_depth
+        self.tags_and = frozenset(tags_and)
+        self.tags_or = frozenset(tags_or)
+        self.image_ids = array("q", image_ids)
+        self.removed: set[int] = set()
+        self.removals = 0
+        self.built_at = time.time()
+
+    def matches(self, tag_ids: set[int]) -> bool:
+        if not self.tags_and <= tag_ids:
+            return False
+        return not self.tags_or or not self.tags_or.isdisjoint(tag_ids)
+
+    def depends_on(self, tag_ids: set[int]) -> bool:
+        # A key without tags serves every image, so any change can affect it
+        if not self.tags_and and not self.tags_or:
+            return True
+        return not self.tags_and.isdisjoint(tag_ids) or not self.tags_or.isdisjoint(tag_ids)
+
+    def __len__(self) -> int:
+        return len(self.image_ids) - len(self.removed)
+
+    def add(self, image_id: int):
+        if image_id in self.removed:
+            # Still in image_ids
+            self.removed.discard(image_id)
+        else:
+            self.image_ids.append(image_id)
+
+    def remove(self, image_ids):
+        # Callers only pass ids that are members
+        self.removed.update(image_ids)
+        self.removals += 1
+        if len(self.removed) * 2 >= len(self.image_ids):
+            self.image_ids = array("q", (i for i in self.image_ids if i not in self.removed))
+            self.removed = set()
+
+    def pick(self):
+        if not len(self):
+            return None
+        while True:
+            image_id = self.image_ids[random.randrange(len(self.image_ids))]
+            if image_id not in self.removed:
+                return image_id
+
+    def memory_bytes(self) -> int:
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.image_ids)
+            + sys.getsizeof(self.removed)
+            + sys.getsizeof(self.tags_and)
+            + sys.getsizeof(self.tags_or)
+        )
+
+
+# In-process map of API key -> CandidatePool. Pools are built lazily on the
+# first request for a key and kept up to date by the crud mutation functions.
+# Every mutation bumps a generation counter so a pool built from a query that
+# raced with a mutation is never cached.
+class CandidatePoolIndex:
+    def __init__(self):
+        self._pools: dict[str, CandidatePool] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, key: str):
+        return self._pools.get(key)
+
+    def store(self, key: str, pool: CandidatePool, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._pools[key] = pool
+        return pool
+
+    def discard(self, key: str):
+        with self._lock:
+            self._generation += 1
+            self._pools.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._pools.clear()
+
+    def image_added(self, image_id: int, tag_ids: set[int]):
+        with self._lock:
+            self._generation += 1
+            for pool in self._pools.values():
+                if pool.matches(tag_ids):
+                    pool.add(image_id)
+
+    def image_retagged(self, image_id: int, old_tag_ids: set[int], new_tag_ids: set[int]):
+        with self._lock:
+            self._generation += 1
+            for pool in self._pools.values():
+                was_member, is_member = pool.matches(old_tag_ids), pool.matches(new_tag_ids)
+                if is_member and not was_member:
+                    pool.add(image_id)
+                elif was_member and not is_member:
+                    pool.remove((image_id,))
+
+    def images_removed(self, image_tags: dict[int, set[int]]):
+        # image_tags maps each deleted image to its tag ids, which decide
+        # the pools it was in
+        with self._lock:
+            self._generation += 1
+            for pool in self._pools.values():
+                members = [image_id for image_id, tag_ids in image_tags.items() if pool.matches(tag_ids)]
+                if members:
+                    pool.remove(members)
+
+    def tags_changed(self, tag_ids: set[int]):
+        # Bulk retagging touches too many images to patch pools one by one,
+        # so drop the affected pools and let the next request rebuild them.
+        with self._lock:
+            self._generation += 1
+            for key in [key for key, pool in self._pools.items() if pool.depends_on(tag_ids)]:
+                del self._pools[key]
+
+    def memory_report(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        return [
+            {
+                "api_key_id": pool.api_key_id,
+                "name": pool.name,
+                "mode": pool.mode,
+                "images": len(pool),
+                "bytes": pool.memory_bytes(),
+                "built_at": pool.built_at,
+            }
+            for pool in pools
+        ]
+
+
+candidate_pools = CandidatePoolIndex()
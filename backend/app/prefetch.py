@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import httpx
+
+from . import crud
+from .database import AsyncSessionLocal
+from .pools import CandidatePool
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 64
+
+# Random picks for proxied API keys, chosen and downloaded ahead of time.
+#
+# Each key that has served a proxied request keeps a buffer of up to depth
+# images whose bytes are already local: in the disk cache, or held in
+# memory when the disk cache is off. A request takes the oldest ready pick
+# and schedules a refill, so it never waits on AList. Picks are drawn from
+# the key's candidate pool exactly like request-time picks. Each one
+# remembers the pool and its removal count at the time, and is checked
+# against the current pool only once ids have left it (or it was rebuilt),
+# so images deleted or retagged since are skipped rather than served.
+class Prefetched:
+    __slots__ = ("image_id", "url", "content_type", "headers", "body", "pool", "removals")
+
+    def __init__(self, image_id: int, url: str, content_type=None, headers=None, body: bytes | None = None):
+        self.image_id = image_id
+        self.url = url
+        self.content_type = content_type
+        self.headers = headers
+        self.body = body
+        self.pool: CandidatePool | None = None
+        self.removals = 0
+
+
+class KeyBuffer:
+    __slots__ = ("ready", "depth", "task", "last_used")
+
+    def __init__(self, depth: int):
+        self.ready: deque[Prefetched] = deque()
+        self.depth = depth
+        self.task: asyncio.Task | None = None
+        self.last_used = time.monotonic()
+
+
+class Prefetcher:
+    def __init__(self, client: httpx.AsyncClient, flights, cache, default_depth: int, idle_seconds: float):
+        self.client = client
+        self.flights = flights
+        self.cache = cache
+        self.default_depth = default_depth
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.fetched = 0
+        self.errors = 0
+        # Handler time of proxied requests, split by whether a pick was ready
+        self.latencies = {"hit": deque(maxlen=2000), "miss": deque(maxlen=2000)}
+        self._buffers: dict[str, KeyBuffer] = {}
+        self._last_sweep = time.monotonic()
+
+    def depth(self, pool: CandidatePool) -> int:
+        return self.default_depth if pool.prefetch_depth is None else pool.prefetch_depth
+
+    def take(self, key: str, pool: CandidatePool):
+        # The next ready pick for key, or None; either way the buffer is
+        # topped up in the background
+        depth = self.depth(pool)
+        self._sweep()
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            if depth <= 0:
+                return None
+            buffer = self._buffers[key] = KeyBuffer(depth)
+        buffer.depth = depth
+        buffer.last_used = time.monotonic()
+        self._recheck(buffer, pool)
+        entry = buffer.ready.popleft() if buffer.ready else None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if depth <= 0:
+            del self._buffers[key]
+        elif buffer.task is None:
+            buffer.task = asyncio.create_task(self._fill(key, buffer))
+        return entry
+
+    def _recheck(self, buffer: KeyBuffer, pool: CandidatePool):
+        if all(entry.pool is pool and entry.removals == pool.removals for entry in buffer.ready):
+            return
+        # One pass over the pool settles every ready pick, which then counts
+        # as checked until ids leave the pool again
+        present = {entry.image_id for entry in buffer.ready}.intersection(pool.image_ids) - pool.removed
+        ready = deque()
+        for entry in buffer.ready:
+            if entry.image_id in present:
+                entry.pool, entry.removals = pool, pool.removals
+                ready.append(entry)
+            else:
+                self.stale += 1
+        buffer.ready = ready
+
+    def record_latency(self, hit: bool, seconds: float):
+        self.latencies["hit" if hit else "miss"].append(seconds)
+
+    async def _fill(self, key: str, buffer: KeyBuffer):
+        try:
+            while len(buffer.ready) < buffer.depth and self._buffers.get(key) is buffer:
+                missing = buffer.depth - len(buffer.ready)
+                async with AsyncSessionLocal() as db:
+                    pool = await crud.get_api_key_pool(db, key)
+                    removals = pool.removals if pool else 0
+                    images = [await crud.get_random_image_from_pool(db, pool) for _ in range(missing)] if pool else []
+                images = [image for image in images if image is not None]
+                if not images:
+                    return
+                # Downloads for one round run side by side
+                entries = await asyncio.gather(*(self._fetch(image.id, image.url) for image in images))
+                for entry in entries:
+                    if entry is not None:
+                        entry.pool, entry.removals = pool, removals
+                buffer.ready.extend(entry for entry in entries if entry is not None)
+                if None in entries:
+                    # Leave the rest to the next request rather than hammer a
+                    # failing origin
+                    return
+        except Exception:
+            logger.exception("Prefetching for an API key failed")
+        finally:
+            buffer.task = None
+
+    async def _fetch(self, image_id: int, url: str):
+        if self.cache and self.cache.contains(url):
+            return Prefetched(image_id, url)
+        flight = self.flights.join(self.client, url, self.cache)
+        chunks = []
+        try:
+            await flight.wait_ready()
+            async for chunk in flight.stream():
+                # With the disk cache on, the download fills it on its way
+                # through and nothing needs holding here
+                if not self.cache:
+                    chunks.append(chunk)
+        except Exception:
+            self.errors += 1
+            return None
+        self.fetched += 1
+        if self.cache:
+            return Prefetched(image_id, url)
+        return Prefetched(image_id, url, flight.content_type, dict(flight.headers), b"".join(chunks))
+
+    def _sweep(self):
+        # Drop the buffers of keys nobody has asked for in a while
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_seconds:
+            return
+        self._last_sweep = now
+        for key in [key for key, buffer in self._buffers.items() if now - buffer.last_used > self.idle_seconds]:
+            self._drop(key)
+
+    def _drop(self, key: str):
+        buffer = self._buffers.pop(key)
+        if buffer.task is not None:
+            buffer.task.cancel()
+
+    def close(self):
+        for key in list(self._buffers):
+            self._drop(key)
+
+    def stats(self):
+        def percentiles(samples):
+            ordered = sorted(samples)
+            if not ordered:
+                return None
+            pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+            return {"count": len(ordered), "p50_ms": pick(0.5), "p99_ms": pick(0.99)}
+
+        lookups = self.hits + self.misses
+        return {
+            "default_depth": self.default_depth,
+            "keys": len(self._buffers),
+            "ready": sum(len(buffer.ready) for buffer in self._buffers.values()),
+            "memory_bytes": sum(len(entry.body) for buffer in self._buffers.values() for entry in buffer.ready if entry.body),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "stale": self.stale,
+            "fetched": self.fetched,
+            "errors": self.errors,
+            "latency": {outcome: percentiles(samples) for outcome, samples in self.latencies.items()},
+        }
+
+
+def create_prefetcher(client: httpx.AsyncClient, flights, cache):
+    return Prefetcher(
+        client,
+        flights,
+        cache,
+        default_depth=min(MAX_DEPTH, int(os.getenv("PREFETCH_DEPTH", 4))),
+        idle_seconds=float(os.getenv("PREFETCH_IDLE_SECONDS", 300)),
+    )
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+import greenlet
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Opt-in query diagnostics, plus an on-demand sampling profiler.
+#
+# SLOW_QUERY_MS logs every statement slower than the threshold with its
+# bound parameters, the app function that ran it and its query plan. The
+# plan is fetched afterwards on a separate connection from a background
+# thread, so the slow request is not held up further.
+#
+# QUERY_PROFILING counts statements per request and flags any statement run
+# N_PLUS_ONE_THRESHOLD or more times in one request, which is what a lazy
+# load or a per-item query in a loop looks like.
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))
+QUERY_PROFILING = os.getenv("QUERY_PROFILING", "false").lower() in ("1", "true", "yes")
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 5))
+
+PACKAGE = __name__.rpartition(".")[0]
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def _app_frame(frame):
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith(PACKAGE + ".") and module not in (__name__, f"{PACKAGE}.database"):
+            return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return None
+
+
+def caller():
+    # The first app function on the stack. Async sessions run statements in
+    # a child greenlet, so the awaiting coroutines are on the parent's stack.
+    found = _app_frame(sys._getframe(1))
+    if found is None:
+        parent = greenlet.getcurrent().parent
+        if parent is not None:
+            found = _app_frame(parent.gr_frame)
+    return found or "unknown"
+
+
+class RequestQueries:
+    __slots__ = ("counts", "callers")
+
+    def __init__(self):
+        self.counts: Counter[str] = Counter()
+        self.callers: dict[str, str] = {}
+
+
+request_queries: ContextVar[RequestQueries | None] = ContextVar("request_queries", default=None)
+
+
+class QueryProfiler:
+    def __init__(self, slow_ms: float, track_requests: bool, n_plus_one_threshold: int):
+        self.slow_ms = slow_ms
+        self.track_requests = track_requests
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.slow_queries = deque(maxlen=50)
+        self.n_plus_one: dict[tuple[str, str], dict] = {}
+        self._explain_engine = None
+        self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.slow_ms > 0 or self.track_requests
+
+    def instrument(self, engine, explain_engine):
+        # Hooks a sync Engine (async_engine.sync_engine for the async one).
+        # explain_engine is a sync engine on the same database for the plans.
+        self._explain_engine = explain_engine
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._profiling_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - context._profiling_started) * 1000
+        queries = request_queries.get()
+        source = None
+        if queries is not None:
+            queries.counts[statement] += 1
+            if statement not in queries.callers:
+                source = queries.callers[statement] = caller()
+        if self.slow_ms and elapsed_ms >= self.slow_ms and not statement.startswith("EXPLAIN"):
+            entry = {
+                "at": time.time(),
+                "ms": round(elapsed_ms, 3),
+                "statement": statement,
+                "parameters": repr(parameters)[:2000],
+                "caller": source or caller(),
+                "plan": None,
+            }
+            with self._lock:
+                self.slow_queries.append(entry)
+            explain = None if executemany else self._explain_statement(conn, statement)
+            self._explainer.submit(self._log_slow_query, entry, explain, parameters)
+
+    def _explain_statement(self, conn, statement: str):
+        # Only when the explaining engine binds parameters the same way
+        engine = self._explain_engine
+        if engine is None or engine.dialect.paramstyle != conn.dialect.paramstyle:
+            return None
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return None
+        if engine.dialect.name == "sqlite":
+            return f"EXPLAIN QUERY PLAN {statement}"
+        if engine.dialect.name == "postgresql":
+            return f"EXPLAIN {statement}"
+        return None
+
+    def _log_slow_query(self, entry: dict, explain: str | None, parameters):
+        if explain is not None:
+            try:
+                with self._explain_engine.connect() as conn:
+                    rows = conn.exec_driver_sql(explain, parameters).all()
+                entry["plan"] = "\n".join(str(row[-1]) for row in rows)
+            except Exception as exc:
+                entry["plan"] = f"EXPLAIN failed: {exc}"
+        logger.warning(
+            "Slow query (%.1f ms) from %s:\n%s\nparameters: %s\nplan:\n%s",
+            entry["ms"], entry["caller"], entry["statement"], entry["parameters"], entry["plan"],
+        )
+
+    def finish_request(self, route: str, queries: RequestQueries):
+        for statement, count in queries.counts.items():
+            if count < self.n_plus_one_threshold:
+                continue
+            source = queries.callers.get(statement, "unknown")
+            logger.warning("Possible N+1 on %s: %d runs of one statement from %s:\n%s", route, count, source, statement)
+            with self._lock:
+                report = self.n_plus_one.setdefault((route, statement), {
+                    "route": route, "statement": statement, "caller": source, "requests": 0, "max_runs": 0,
+                })
+                report["requests"] += 1
+                report["max_runs"] = max(report["max_runs"], count)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "slow_query_ms": self.slow_ms,
+                "query_profiling": self.track_requests,
+                "n_plus_one_threshold": self.n_plus_one_threshold,
+                "slow_queries": list(self.slow_queries),
+                "n_plus_one": sorted(self.n_plus_one.values(), key=lambda report: -report["requests"]),
+            }
+
+
+class QueryProfilingMiddleware:
+    # Counts statements per request, flags repeats once the response is
+    # done, and reports the count so far in an X-Query-Count header
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        queries = RequestQueries()
+        token = request_queries.set(queries)
+
+        async def send_with_count(message):
+            if message["type"] == "http.response.start":
+                count = str(sum(queries.counts.values())).encode()
+                message = {**message, "headers": [*message.get("headers", []), (b"x-query-count", count)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_count)
+        finally:
+            request_queries.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "other"
+            query_profiler.finish_request(route, queries)
+
+
+query_profiler = QueryProfiler(SLOW_QUERY_MS, QUERY_PROFILING, N_PLUS_ONE_THRESHOLD)
+
+
+# Wall-clock stack sampler for live traffic. Stacks are returned in the
+# folded format ("outer;inner;leaf count") that flamegraph.pl and speedscope
+# read. Only code running on a thread shows up: coroutines parked on an
+# await cost nothing and are not sampled, and the event loop waiting for
+# I/O appears as its select() call.
+class SamplingProfiler:
+    def __init__(self):
+        self._running = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._running.locked()
+
+    async def profile(self, seconds: float, interval: float, all_threads: bool = False) -> str:
+        if not self._running.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            loop_thread = threading.get_ident()
+            return await asyncio.to_thread(self._sample, seconds, interval, None if all_threads else loop_thread)
+        finally:
+            self._running.release()
+
+    def _sample(self, seconds: float, interval: float, only_thread: int | None) -> str:
+        me = threading.get_ident()
+        stacks: Counter[str] = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (only_thread is not None and ident != only_thread):
+                    continue
+                calls = []
+                while frame is not None:
+                    calls.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}")
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(calls))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+sampling_profiler = SamplingProfiler()
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 # Tag Schemas
 class TagBase(BaseModel):
@@ -42,13 +42,26 @@ class Image(ImageBase):
         from_attributes = True
 
 # ApiKey Schemas
+# proxy streams the image through this server, redirect sends the client to
+# the AList URL, json returns {"url": ...}
+DeliveryMode = Literal["proxy", "redirect", "json"]
+
 class ApiKeyBase(BaseModel):
     name: str
+    mode: DeliveryMode = "proxy"
+    # None uses the server's PREFETCH_DEPTH, 0 turns prefetching off
+    prefetch_depth: Optional[int] = Field(None, ge=0, le=64)
 
 class ApiKeyCreate(ApiKeyBase):
     tags_and: List[str] = []
     tags_or: List[str] = []
 
+class ApiKeyUpdateMode(BaseModel):
+    mode: DeliveryMode
+
+class ApiKeyUpdatePrefetch(BaseModel):
+    prefetch_depth: Optional[int] = Field(None, ge=0, le=64)
+
 class ApiKey(ApiKeyBase):
     id: int
     key: str
@@ -60,6 +73,38 @@ class ApiKey(ApiKeyBase):
     class Config:
         from_attributes = True
 
+# Crawl Schemas
+class CrawlJobCreate(BaseModel):
+    base_url: str
+    root: str = "/"
+    # An AList token and the folder password, if the tree needs them
+    token: Optional[str] = None
+    password: Optional[str] = None
+    tags: List[str] = []
+    path_tags: bool = False
+    # None uses the server's CRAWL_CONCURRENCY
+    concurrency: Optional[int] = Field(None, ge=1, le=32)
+
+class CrawlJob(BaseModel):
+    id: int
+    base_url: str
+    root: str
+    tags: List[str] = []
+    path_tags: bool
+    concurrency: Optional[int] = None
+    status: str
+    progress: Optional[dict] = None
+    error: Optional[str] = None
+    runner: Optional[str] = None
+    heartbeat_at: Optional[float] = None
+    synced_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    created_at: datetime
+    owner_id: int
+
+    class Config:
+        from_attributes = True
+
 # User Schemas
 class UserBase(BaseModel):
     username: str
@@ -0,0 +1,117 @@
+import logging
+
+from sqlalchemy import column, func, literal_column, or_, select, table, text
+from sqlalchemy.exc import DBAPIError
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Substring search over image filenames and descriptions.
+#
+# On SQLite this is an FTS5 table with the trigram tokenizer, using images as
+# external content so only the index is stored twice. Triggers keep it in step
+# with every insert, rename and delete, including the bulk Core statements.
+# Trigram indexes answer LIKE '%abc%' for any pattern with three or more
+# consecutive literal characters and MATCH queries ranked with bm25. On
+# PostgreSQL pg_trgm GIN indexes make the plain ILIKE filter indexable.
+#
+# Without FTS5 or pg_trgm everything falls back to ILIKE on images. The
+# schema is created by a migration, see migrations.py.
+
+MIN_TRIGRAM_LENGTH = 3
+
+images_fts = table("images_fts", column("rowid"), column("filename"), column("description"))
+
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5("
+    "filename, description, content='images', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN "
+    "INSERT INTO images_fts(rowid, filename, description) VALUES (new.id, new.filename, new.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN "
+    "INSERT INTO images_fts(images_fts, rowid, filename, description) VALUES ('delete', old.id, old.filename, old.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS images_fts_update AFTER UPDATE OF filename, description ON images BEGIN "
+    "INSERT INTO images_fts(images_fts, rowid, filename, description) VALUES ('delete', old.id, old.filename, old.description); "
+    "INSERT INTO images_fts(rowid, filename, description) VALUES (new.id, new.filename, new.description); "
+    "END",
+]
+
+POSTGRESQL_SCHEMA = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_images_filename_trgm ON images USING gin (filename gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_images_description_trgm ON images USING gin (description gin_trgm_ops)",
+]
+
+# Dialect name -> whether the search index exists, filled in by detect
+available: dict[str, bool] = {}
+
+def create_schema(conn):
+    # Migration step: creates the index, and fills a new FTS table from the
+    # existing images. Databases without FTS5 or pg_trgm keep using ILIKE.
+    dialect = conn.dialect.name
+    statements = {"sqlite": SQLITE_SCHEMA, "postgresql": POSTGRESQL_SCHEMA}.get(dialect)
+    if statements is None:
+        return
+    try:
+        with conn.begin_nested():
+            for statement in statements:
+                conn.execute(text(statement))
+            if dialect == "sqlite":
+                conn.execute(text("INSERT INTO images_fts(images_fts) VALUES ('rebuild')"))
+    except DBAPIError as exc:
+        logger.warning("Filename search index unavailable, using ILIKE: %s", exc)
+
+def detect(conn):
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        found = conn.scalar(text("SELECT count(*) FROM sqlite_master WHERE name = 'images_fts'"))
+    elif dialect == "postgresql":
+        found = conn.scalar(text("SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'"))
+    else:
+        found = 0
+    available[dialect] = bool(found)
+    return available[dialect]
+
+def _fts_ids(condition):
+    return select(images_fts.c.rowid).where(condition)
+
+def filename_filter(dialect: str, term: str):
+    # Same matches as filename ILIKE '%term%', through the index if possible
+    if dialect == "sqlite" and available.get(dialect) and len(term) >= MIN_TRIGRAM_LENGTH:
+        return models.Image.id.in_(_fts_ids(images_fts.c.filename.like(f"%{term}%")))
+    return models.Image.filename.ilike(f"%{term}%")
+
+def _match_phrase(term: str):
+    # One quoted phrase, so the search text is never parsed as FTS5 syntax
+    return '"' + term.replace('"', '""') + '"'
+
+def search_filter(dialect: str, term: str):
+    # Substring match on filename or description
+    if dialect == "sqlite" and available.get(dialect):
+        if len(term) >= MIN_TRIGRAM_LENGTH:
+            return models.Image.id.in_(_fts_ids(literal_column("images_fts").match(_match_phrase(term))))
+        return models.Image.id.in_(_fts_ids(or_(
+            images_fts.c.filename.like(f"%{term}%"), images_fts.c.description.like(f"%{term}%")
+        )))
+    return or_(models.Image.filename.ilike(f"%{term}%"), models.Image.description.ilike(f"%{term}%"))
+
+def ranked_search(query, dialect: str, term: str):
+    # Orders search results best match first; filename hits weigh more than
+    # description hits
+    if dialect == "sqlite" and available.get(dialect) and len(term) >= MIN_TRIGRAM_LENGTH:
+        fts = literal_column("images_fts")
+        scores = (
+            select(images_fts.c.rowid.label("image_id"), func.bm25(fts, 10.0, 1.0).label("score"))
+            .where(fts.match(_match_phrase(term)))
+            .subquery()
+        )
+        return query.join(scores, scores.c.image_id == models.Image.id).order_by(scores.c.score, models.Image.id)
+    if dialect == "postgresql" and available.get(dialect):
+        score = func.greatest(
+            func.similarity(func.coalesce(models.Image.filename, ""), term),
+            func.similarity(func.coalesce(models.Image.description, ""), term) * 0.1,
+        )
+        return query.where(search_filter(dialect, term)).order_by(score.desc(), models.Image.id)
+    return query.where(search_filter(dialect, term)).order_by(models.Image.created_at.desc(), models.Image.id.desc())
@@ -0,0 +1,48 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=".env")
+
+import uvicorn
+from sqlalchemy.engine import make_url
+
+# Production entry point: python -m app.serve
+#
+# Runs WORKERS uvicorn worker processes without the reloader. Workers
+# coordinate their startup through bootstrap.py and follow each other's
+# writes through the shared state in shared.py. With more than one worker
+# and no SHARED_CACHE_URL, a SQLite file next to the database is used,
+# which covers every worker on this host; workers on several hosts need
+# PostgreSQL and a Redis SHARED_CACHE_URL.
+
+
+def default_shared_cache_url() -> str:
+    url = make_url(os.getenv("SQLALCHEMY_DATABASE_URL", "sqlite:///../alist_images.db"))
+    directory = ".."
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        directory = os.path.dirname(url.database) or "."
+    return f"sqlite:///{os.path.join(directory, 'alist_shared.db')}"
+
+
+def main():
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1:
+        if not os.getenv("SHARED_CACHE_URL"):
+            # Worker processes inherit the environment
+            os.environ["SHARED_CACHE_URL"] = default_shared_cache_url()
+        elif os.environ["SHARED_CACHE_URL"].startswith("memory:"):
+            raise SystemExit("WORKERS > 1 needs a shared SHARED_CACHE_URL, not memory://")
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("BACKEND_HOST", "0.0.0.0"),
+        port=int(os.getenv("BACKEND_PORT", 5235)),
+        workers=workers,
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        log_level=os.getenv("LOG_LEVEL", "info"),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+# State shared by worker processes, for running more than one.
+#
+# Each worker keeps its caches and indexes in memory and patches them after
+# its own writes (see changes.py). The same changes go on a shared feed, and
+# every worker replays the ones made by the others when it next polls, so
+# another worker's view trails a write by at most SHARED_POLL_SECONDS. A
+# worker that falls so far behind that changes were pruned before it read
+# them drops its caches and rebuilds them from the database instead.
+#
+# The backend is chosen by SHARED_CACHE_URL:
+#   memory://              one process, nothing is shared (the default)
+#   sqlite:///shared.db    a SQLite file the workers on one host open
+#   redis://host:6379/0    Redis, or a server that speaks its protocol
+# Backends also keep expiring entries, used for worker heartbeats carrying
+# each worker's stats.
+
+EVENT_RETENTION_SECONDS = 600
+EVENT_BATCH = 1000
+
+
+class MemoryBackend:
+    # A single process has nobody to tell about its changes
+    shared = False
+
+    def __init__(self):
+        self._entries: dict[str, tuple[str, float]] = {}
+
+    async def publish(self, origin: str, name: str, payload: dict):
+        # Returns the event's position on the feed; positions only grow
+        return None
+
+    async def read(self, after):
+        # Returns (cursor, [(position, origin, name, payload)], gap);
+        # after=None only asks for the current end of the feed
+        return 0, [], False
+
+    async def put(self, key: str, value: str, ttl: float):
+        self._entries[key] = (value, time.time() + ttl)
+
+    async def scan(self, prefix: str) -> dict[str, str]:
+        now = time.time()
+        return {key: value for key, (value, expires_at) in self._entries.items() if key.startswith(prefix) and expires_at > now}
+
+    async def close(self):
+        pass
+
+
+class SQLiteBackend:
+    shared = True
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, "
+        "name TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)",
+    ]
+
+    def __init__(self, path: str):
+        self.path = path
+        # One connection, used from worker threads one call at a time
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+
+    def _run(self, function, *args):
+        def call():
+            with self._lock:
+                return function(*args)
+        return asyncio.to_thread(call)
+
+    async def publish(self, origin: str, name: str, payload: dict):
+        return await self._run(self._publish, origin, name, json.dumps(payload))
+
+    def _publish(self, origin: str, name: str, payload: str):
+        now = time.time()
+        position = self._conn.execute(
+            "INSERT INTO events (origin, name, payload, created_at) VALUES (?, ?, ?, ?)", (origin, name, payload, now)
+        ).lastrowid
+        if now - self._pruned_at > 60:
+            self._pruned_at = now
+            self._conn.execute("DELETE FROM events WHERE created_at < ?", (now - EVENT_RETENTION_SECONDS,))
+            self._conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        return position
+
+    async def read(self, after):
+        return await self._run(self._read, after)
+
+    def _read(self, after):
+        if after is None:
+            # The last id handed out, which pruning leaves in sqlite_sequence
+            row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+            return (row[0] if row else 0), [], False
+        rows = self._conn.execute(
+            "SELECT id, origin, name, payload FROM events WHERE id > ? ORDER BY id LIMIT ?", (after, EVENT_BATCH)
+        ).fetchall()
+        # AUTOINCREMENT ids have no holes, so a jump means pruned events
+        gap = bool(rows) and rows[0][0] > after + 1
+        cursor = rows[-1][0] if rows else after
+        return cursor, [(position, origin, name, json.loads(payload)) for position, origin, name, payload in rows], gap
+
+    async def put(self, key: str, value: str, ttl: float):
+        await self._run(lambda: self._conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)", (key, value, time.time() + ttl)
+        ))
+
+    async def scan(self, prefix: str) -> dict[str, str]:
+        rows = await self._run(lambda: self._conn.execute(
+            "SELECT key, value FROM entries WHERE key >= ? AND key < ? AND expires_at > ?",
+            (prefix, prefix + "\uffff", time.time()),
+        ).fetchall())
+        return dict(rows)
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url: str, namespace: str = "alist-image-api"):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("SHARED_CACHE_URL=redis://... needs the redis package (pip install redis)")
+        self._redis = redis.asyncio.from_url(url, decode_responses=True)
+        self._namespace = namespace
+        self._stream = f"{namespace}:events"
+
+    @staticmethod
+    def _id(stream_id: str):
+        milliseconds, _, sequence = stream_id.partition("-")
+        return int(milliseconds), int(sequence or 0)
+
+    async def publish(self, origin: str, name: str, payload: dict):
+        # Trimmed by length; a worker that falls further behind resyncs
+        stream_id = await self._redis.xadd(self._stream, {"origin": origin, "name": name, "payload": json.dumps(payload)},
+                                           maxlen=100000, approximate=True)
+        return self._id(stream_id)
+
+    async def read(self, after):
+        if after is None:
+            last = await self._redis.xrevrange(self._stream, count=1)
+            return (last[0][0] if last else "0-0"), [], False
+        gap = False
+        if after != "0-0":
+            first = await self._redis.xrange(self._stream, count=1)
+            gap = bool(first) and self._id(first[0][0]) > self._id(after)
+        response = await self._redis.xread({self._stream: after}, count=EVENT_BATCH)
+        entries = response[0][1] if response else []
+        cursor = entries[-1][0] if entries else after
+        return cursor, [
+            (self._id(stream_id), fields["origin"], fields["name"], json.loads(fields["payload"])) for stream_id, fields in entries
+        ], gap
+
+    async def put(self, key: str, value: str, ttl: float):
+        await self._redis.set(f"{self._namespace}:{key}", value, px=int(ttl * 1000))
+
+    async def scan(self, prefix: str) -> dict[str, str]:
+        keys = [key async for key in self._redis.scan_iter(match=f"{self._namespace}:{prefix}*")]
+        if not keys:
+            return {}
+        values = await self._redis.mget(keys)
+        start = len(self._namespace) + 1
+        return {key[start:]: value for key, value in zip(keys, values) if value is not None}
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def create_backend(url: str):
+    scheme = url.partition("://")[0]
+    if scheme == "memory":
+        return MemoryBackend()
+    if scheme == "sqlite":
+        return SQLiteBackend(make_url(url).database)
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported SHARED_CACHE_URL: {url}")
+
+
+class SharedState:
+    def __init__(self, backend, poll_seconds: float, heartbeat_seconds: float):
+        self.backend = backend
+        self.poll_seconds = poll_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.started_at = time.time()
+        self.published = 0
+        self.applied = 0
+        self.resyncs = 0
+        self.errors = 0
+        self._handlers = {}
+        self._stats = {}
+        self._cursor = None
+        # Feed position of the change being applied, or of the end of the
+        # feed when this worker started or last resynced
+        self.position = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend.shared
+
+    def handler(self, name: str):
+        # Decorator for the function that applies another worker's change;
+        # it gets the published payload as keyword arguments
+        def register(function):
+            self._handlers[name] = function
+            return function
+        return register
+
+    def add_stats(self, name: str, stats):
+        # stats() is included in this worker's heartbeat
+        self._stats[name] = stats
+
+    async def publish(self, name: str, **payload):
+        # Returns the change's feed position, or None when it is not on a feed
+        if not self.enabled:
+            return None
+        try:
+            position = await self.backend.publish(self.worker_id, name, payload)
+            self.published += 1
+            return position
+        except Exception:
+            # The write itself is committed; other workers catch up when
+            # their cached entries are next rebuilt
+            self.errors += 1
+            logger.exception("Publishing the %s change failed", name)
+
+    async def start(self):
+        # Called before caches load, so no change made while they load is missed
+        if not self.enabled:
+            return
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._cursor, _, _ = await self.backend.read(None)
+        self.position = self._cursor
+        self._task = asyncio.create_task(self._poll())
+
+    async def _poll(self):
+        heartbeat_at = 0.0
+        while True:
+            try:
+                caught_up = await self.sync()
+                if time.monotonic() - heartbeat_at >= self.heartbeat_seconds:
+                    heartbeat_at = time.monotonic()
+                    await self._heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                caught_up = True
+                logger.exception("Reading shared changes failed")
+            if caught_up:
+                await asyncio.sleep(self.poll_seconds)
+
+    async def sync(self) -> bool:
+        # Applies the next batch of other workers' changes; False when more
+        # are waiting
+        cursor, events, gap = await self.backend.read(self._cursor)
+        if gap:
+            self.position = cursor
+            self.resync()
+        for position, origin, name, payload in events:
+            if origin == self.worker_id:
+                continue
+            self.position = position
+            handler = self._handlers.get(name)
+            if handler is None:
+                logger.warning("No handler for shared change %s", name)
+                continue
+            handler(**payload)
+            self.applied += 1
+        self._cursor = cursor
+        return len(events) < EVENT_BATCH
+
+    def resync(self):
+        logger.warning("Missed shared changes; dropping cached state")
+        self.resyncs += 1
+        handler = self._handlers.get("resync")
+        if handler is not None:
+            handler()
+
+    def _report(self):
+        return {
+            "worker": self.worker_id,
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "seen_at": time.time(),
+            "published": self.published,
+            "applied": self.applied,
+            "resyncs": self.resyncs,
+            "errors": self.errors,
+            "stats": {name: stats() for name, stats in self._stats.items()},
+        }
+
+    async def _heartbeat(self):
+        await self.backend.put(f"workers:{self.worker_id}", json.dumps(self._report()), ttl=self.heartbeat_seconds * 3)
+
+    async def workers(self):
+        if not self.enabled:
+            return [self._report()]
+        entries = await self.backend.scan("workers:")
+        return sorted((json.loads(value) for value in entries.values()), key=lambda worker: worker["started_at"])
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.backend.close()
+
+
+shared_state = SharedState(
+    create_backend(os.getenv("SHARED_CACHE_URL", "memory://")),
+    poll_seconds=float(os.getenv("SHARED_POLL_SECONDS", 0.5)),
+    heartbeat_seconds=float(os.getenv("SHARED_HEARTBEAT_SECONDS", 5)),
+)
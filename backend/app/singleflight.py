@@ -0,0 +1,216 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import httpx
+
+from . import image_cache, metrics, upstream
+
+# One upstream download shared by every request that asked for the same URL
+# while it was in flight, each reading it through its own FlightReader.
+#
+# While the body is at most replay_bytes it is kept whole, so a request that
+# joins late still replays it from the first byte. Past that the flight
+# takes no new readers (they start a download of their own), drops the
+# chunks every reader has passed, and waits for the slowest reader once it
+# is replay_bytes behind, so a large image costs bounded memory as it does
+# when streamed on its own. A reader that makes no progress for
+# stall_seconds, or joined and never started reading, is cut loose instead
+# of holding up the others and the cache fill.
+class Flight:
+    def __init__(self, replay_bytes: int, stall_seconds: float):
+        self.replay_bytes = replay_bytes
+        self.stall_seconds = stall_seconds
+        self.content_type = None
+        self.headers: dict[str, str] = {}
+        self.error: Exception | None = None
+        self.joinable = True
+        self.dropped_readers = 0
+        self._chunks: deque[bytes] = deque()
+        # Index of _chunks[0] among all chunks of the body
+        self._first = 0
+        self._received = 0
+        self._readers: set[FlightReader] = set()
+        self._done = False
+        self._ready = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._progress = asyncio.Event()
+
+    def reader(self) -> "FlightReader":
+        reader = FlightReader(self)
+        self._readers.add(reader)
+        return reader
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _trim(self):
+        keep_from = min((reader.index for reader in self._readers), default=self._first + len(self._chunks))
+        while self._first < keep_from:
+            self._chunks.popleft()
+            self._first += 1
+
+    async def _throttle(self):
+        while True:
+            self._progress.clear()
+            self._trim()
+            slowest = min(self._readers, key=lambda reader: reader.offset, default=None)
+            if slowest is None or self._received - slowest.offset <= self.replay_bytes:
+                return
+            waited = time.monotonic() - slowest.touched
+            if waited >= self.stall_seconds:
+                slowest.drop()
+                continue
+            try:
+                await asyncio.wait_for(self._progress.wait(), self.stall_seconds - waited)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, client: httpx.AsyncClient, url: str, cache):
+        resp = None
+        completed = False
+        try:
+            resp = await upstream.open_stream(client, url)
+            self.content_type = upstream.media_type(resp)
+            self.headers = upstream.passthrough_headers(resp)
+            self._ready.set()
+            chunks = metrics.count_upstream_bytes(resp.aiter_raw())
+            if cache:
+                chunks = image_cache.tee(chunks, cache.writer(url, {"Content-Type": self.content_type, **self.headers}))
+            async for chunk in chunks:
+                self._chunks.append(chunk)
+                self._received += len(chunk)
+                if self.joinable and self._received > self.replay_bytes:
+                    self.joinable = False
+                self._notify()
+                if not self.joinable:
+                    await self._throttle()
+            completed = True
+        except Exception as exc:
+            # Anything from an unparseable URL to a failed cache write; the
+            # waiters get it rather than hanging or ending a body early
+            self.error = exc
+        finally:
+            if not completed and self.error is None:
+                self.error = RuntimeError("Upstream fetch was cancelled")
+            self._done = True
+            self._ready.set()
+            self._notify()
+            if resp is not None:
+                await resp.aclose()
+
+
+class FlightReader:
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        # Next chunk to read, and the bytes read so far
+        self.index = 0
+        self.offset = 0
+        self.dropped = False
+        self.touched = time.monotonic()
+
+    @property
+    def content_type(self):
+        return self.flight.content_type
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return self.flight.headers
+
+    async def wait_ready(self):
+        # Raises the error if the fetch failed, before or after the first byte
+        await self.flight._ready.wait()
+        if self.flight.error:
+            self.close()
+            raise self.flight.error
+
+    async def stream(self):
+        flight = self.flight
+        try:
+            while True:
+                changed = flight._changed
+                while self.index < flight._first + len(flight._chunks):
+                    if self.dropped:
+                        raise RuntimeError("Fell too far behind the upstream download")
+                    chunk = flight._chunks[self.index - flight._first]
+                    self.index += 1
+                    self.offset += len(chunk)
+                    self.touched = time.monotonic()
+                    flight._progress.set()
+                    yield chunk
+                if self.dropped:
+                    raise RuntimeError("Fell too far behind the upstream download")
+                if flight.error:
+                    raise flight.error
+                if flight._done:
+                    return
+                await changed.wait()
+        finally:
+            self.close()
+
+    def drop(self):
+        self.dropped = True
+        self.flight.dropped_readers += 1
+        self.close()
+        self.flight._notify()
+
+    def close(self):
+        # For a request that will not read the body, e.g. a 304
+        self.flight._readers.discard(self)
+        self.flight._progress.set()
+
+
+# Coalesces concurrent fetches of the same URL into a single upstream request
+class SingleFlight:
+    def __init__(self, replay_bytes: int = 4 * 1024 * 1024, stall_seconds: float = 30):
+        self.replay_bytes = replay_bytes
+        self.stall_seconds = stall_seconds
+        self.fetches = 0
+        self.coalesced = 0
+        self.dropped_readers = 0
+        self._flights: dict[str, Flight] = {}
+        # Includes flights past replay_bytes, which new requests no longer join
+        self._running: set[Flight] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def join(self, client: httpx.AsyncClient, url: str, cache=None) -> FlightReader:
+        flight = self._flights.get(url)
+        if flight is not None and flight.joinable:
+            self.coalesced += 1
+            return flight.reader()
+
+        flight = self._flights[url] = Flight(self.replay_bytes, self.stall_seconds)
+        self._running.add(flight)
+        self.fetches += 1
+        reader = flight.reader()
+        # The download runs as its own task so it finishes (and fills the
+        # cache) even if the request that started it disconnects
+        task = asyncio.create_task(flight.run(client, url, cache))
+        self._tasks.add(task)
+        task.add_done_callback(lambda _: self._finish(url, flight, task))
+        return reader
+
+    def _finish(self, url: str, flight: Flight, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._running.discard(flight)
+        self.dropped_readers += flight.dropped_readers
+        if self._flights.get(url) is flight:
+            del self._flights[url]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._running),
+            "fetches": self.fetches,
+            "coalesced": self.coalesced,
+            "dropped_readers": self.dropped_readers,
+            "buffered_bytes": sum(len(chunk) for flight in self._running for chunk in flight._chunks),
+        }
+
+
+def create_single_flight():
+    return SingleFlight(
+        replay_bytes=int(os.getenv("UPSTREAM_REPLAY_BYTES", 4 * 1024 * 1024)),
+        stall_seconds=float(os.getenv("UPSTREAM_STALL_SECONDS", 30)),
+    )
@@ -0,0 +1,403 @@
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+
+CHUNK_BITS = 16
+CHUNK_BYTES = (1 << CHUNK_BITS) // 8
+LOW_MASK = (1 << CHUNK_BITS) - 1
+# Chunks with fewer ids than this are sorted arrays of their low 16 bits,
+# which take 2 bytes an id instead of the 8 KB of a full bitset
+ARRAY_MAX = 4096
+
+
+def _bits(container) -> int:
+    if isinstance(container, int):
+        return container
+    buffer = bytearray(CHUNK_BYTES)
+    for low in container:
+        buffer[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def _words(bits: int):
+    # The bitset as 64-bit words, with the low bits of each word's lowest bit
+    words = memoryview(bits.to_bytes(CHUNK_BYTES, "little")).cast("Q")
+    for index, word in enumerate(words):
+        if word:
+            yield index * 64, word
+
+
+def _lows(container):
+    if not isinstance(container, int):
+        yield from container
+        return
+    for base, word in _words(container):
+        while word:
+            lowest = word & -word
+            yield base + lowest.bit_length() - 1
+            word ^= lowest
+
+
+def _having(lows, bits: int, present: bool = True):
+    # The lows whose bit in bits is set (or clear), probed through the bytes
+    # rather than by shifting an 8 KB int for each one
+    data = bits.to_bytes(CHUNK_BYTES, "little")
+    return [low for low in lows if bool(data[low >> 3] >> (low & 7) & 1) is present]
+
+
+def _intersect(small, large):
+    # Both sorted arrays; probe the larger one when the other is much smaller
+    if len(small) * 8 < len(large):
+        found = []
+        for low in small:
+            position = bisect_left(large, low)
+            if position < len(large) and large[position] == low:
+                found.append(low)
+        return found
+    return sorted(set(small).intersection(large))
+
+
+def _size(container) -> int:
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def _container(bits: int):
+    # A bitset result in its canonical form, or None when it is empty
+    count = bits.bit_count()
+    if not count:
+        return None
+    return bits if count >= ARRAY_MAX else array("H", _lows(bits))
+
+
+def _from_lows(lows):
+    # lows is a sorted list without duplicates
+    if not lows:
+        return None
+    return _bits(lows) if len(lows) >= ARRAY_MAX else array("H", lows)
+
+
+# Set of image ids as a roaring-style bitmap: ids are split into 64K chunks by
+# their high bits. A chunk holding at least ARRAY_MAX ids is a Python int used
+# as a bitset, so intersections and unions of dense chunks run in C; a
+# sparser one is a sorted array('H'). Stored bitmaps keep to that, while an
+# intersection of two bitsets stays a bitset however few ids it has: it is a
+# short-lived query result, and converting it would cost a Python loop per
+# id. Containers are never changed in place, so copies can share them.
+class Bitmap:
+    __slots__ = ("chunks",)
+
+    def __init__(self, chunks: dict | None = None):
+        self.chunks = chunks or {}
+
+    @classmethod
+    def from_ids(cls, ids):
+        lows: dict[int, list[int]] = {}
+        for image_id in ids:
+            lows.setdefault(image_id >> CHUNK_BITS, []).append(image_id & LOW_MASK)
+        return cls({
+            high: _container(_bits(values)) if len(values) >= ARRAY_MAX else _from_lows(sorted(set(values)))
+            for high, values in lows.items()
+        })
+
+    def add(self, image_id: int):
+        high, low = image_id >> CHUNK_BITS, image_id & LOW_MASK
+        container = self.chunks.get(high)
+        if container is None:
+            self.chunks[high] = array("H", (low,))
+        elif isinstance(container, int):
+            self.chunks[high] = container | (1 << low)
+        else:
+            position = bisect_left(container, low)
+            if position == len(container) or container[position] != low:
+                self.chunks[high] = _from_lows([*container[:position], low, *container[position:]])
+
+    def update(self, other: "Bitmap"):
+        for high, theirs in other.chunks.items():
+            ours = self.chunks.get(high)
+            if ours is None:
+                self.chunks[high] = theirs
+            elif isinstance(ours, int) or isinstance(theirs, int):
+                self.chunks[high] = _bits(ours) | _bits(theirs)
+            else:
+                self.chunks[high] = _from_lows(sorted(set(ours).union(theirs)))
+
+    def difference_update(self, other: "Bitmap"):
+        for high, theirs in other.chunks.items():
+            ours = self.chunks.get(high)
+            if ours is None:
+                continue
+            if isinstance(ours, int):
+                remaining = _container(ours & ~_bits(theirs))
+            elif isinstance(theirs, int):
+                remaining = _from_lows(_having(ours, theirs, present=False))
+            else:
+                removed = set(theirs)
+                remaining = _from_lows([low for low in ours if low not in removed])
+            if remaining is None:
+                del self.chunks[high]
+            else:
+                self.chunks[high] = remaining
+
+    def __and__(self, other: "Bitmap"):
+        small, large = sorted((self.chunks, other.chunks), key=len)
+        chunks = {}
+        for high, ours in small.items():
+            theirs = large.get(high)
+            if theirs is None:
+                continue
+            if isinstance(ours, int) and isinstance(theirs, int):
+                common = (ours & theirs) or None
+            elif isinstance(ours, int) or isinstance(theirs, int):
+                bits, lows = (ours, theirs) if isinstance(ours, int) else (theirs, ours)
+                common = _from_lows(_having(lows, bits))
+            else:
+                common = _from_lows(_intersect(*sorted((ours, theirs), key=len)))
+            if common is not None:
+                chunks[high] = common
+        return Bitmap(chunks)
+
+    def __or__(self, other: "Bitmap"):
+        result = Bitmap(dict(self.chunks))
+        result.update(other)
+        return result
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap) or self.chunks.keys() != other.chunks.keys():
+            return False
+        for high, ours in self.chunks.items():
+            theirs = other.chunks[high]
+            if type(ours) is not type(theirs):
+                ours, theirs = _bits(ours), _bits(theirs)
+            if ours != theirs:
+                return False
+        return True
+
+    def __contains__(self, image_id: int):
+        container = self.chunks.get(image_id >> CHUNK_BITS)
+        if container is None:
+            return False
+        low = image_id & LOW_MASK
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    def __len__(self):
+        return sum(_size(container) for container in self.chunks.values())
+
+    def __iter__(self):
+        for high in sorted(self.chunks):
+            base = high << CHUNK_BITS
+            for low in _lows(self.chunks[high]):
+                yield base + low
+
+    def nth(self, position: int):
+        # The id at position in ascending order, for uniform random picks
+        for high in sorted(self.chunks):
+            container = self.chunks[high]
+            count = _size(container)
+            if position >= count:
+                position -= count
+                continue
+            base = high << CHUNK_BITS
+            if not isinstance(container, int):
+                return base + container[position]
+            for low, word in _words(container):
+                count = word.bit_count()
+                if position >= count:
+                    position -= count
+                    continue
+                for _ in range(position):
+                    word &= word - 1
+                return base + low + (word & -word).bit_length() - 1
+        raise IndexError(position)
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self.chunks) + sum(sys.getsizeof(container) for container in self.chunks.values())
+
+
+class TagBitmaps:
+    def __init__(self, tags=None, owners=None, images=None):
+        self.tags: dict[int, Bitmap] = tags or {}
+        self.owners: dict[int, Bitmap] = owners or {}
+        self.images: Bitmap = images or Bitmap()
+
+    @classmethod
+    async def load(cls, db: AsyncSession):
+        # The two reads are separate statements, and pysqlite starts no
+        # transaction for a SELECT, so they can see different commits. A
+        # write landing between them is covered by TagIndex.build, which
+        # replays every mutation made during the load on the result.
+        owners: dict[int, list[int]] = {}
+        result = await db.stream(select(models.Image.id, models.Image.owner_id).execution_options(yield_per=50000))
+        async for partition in result.partitions():
+            for image_id, owner_id in partition:
+                owners.setdefault(owner_id, []).append(image_id)
+        tags: dict[int, list[int]] = {}
+        association = models.ImageTagAssociation
+        result = await db.stream(
+            select(association.c.tag_id, association.c.image_id)
+            .join(models.Image, models.Image.id == association.c.image_id)
+            .execution_options(yield_per=50000)
+        )
+        async for partition in result.partitions():
+            for tag_id, image_id in partition:
+                tags.setdefault(tag_id, []).append(image_id)
+        return cls(
+            {tag_id: Bitmap.from_ids(ids) for tag_id, ids in tags.items()},
+            {owner_id: Bitmap.from_ids(ids) for owner_id, ids in owners.items() if owner_id is not None},
+            Bitmap.from_ids(image_id for ids in owners.values() for image_id in ids),
+        )
+
+    def add(self, image_ids: Bitmap, owner_id: int | None, tag_ids):
+        self.images.update(image_ids)
+        if owner_id is not None:
+            self.owners.setdefault(owner_id, Bitmap()).update(image_ids)
+        for tag_id in tag_ids:
+            self.tags.setdefault(tag_id, Bitmap()).update(image_ids)
+
+    def remove(self, image_ids: Bitmap, owner_id: int | None, tag_ids):
+        # Only the owner's and the images' tags' bitmaps can hold them
+        self.images.difference_update(image_ids)
+        if owner_id in self.owners:
+            self.owners[owner_id].difference_update(image_ids)
+        for tag_id in tag_ids:
+            if tag_id in self.tags:
+                self.tags[tag_id].difference_update(image_ids)
+
+    def retag(self, image_ids: Bitmap, removed_tag_ids, added_tag_ids):
+        for tag_id in removed_tag_ids:
+            if tag_id in self.tags:
+                self.tags[tag_id].difference_update(image_ids)
+        for tag_id in added_tag_ids:
+            self.tags.setdefault(tag_id, Bitmap()).update(image_ids)
+
+    def memory_bytes(self) -> int:
+        return self.images.memory_bytes() + sum(
+            bitmap.memory_bytes() for bitmap in (*self.owners.values(), *self.tags.values())
+        )
+
+
+# In-memory inverted index of tag id -> image ids (plus owner -> image ids)
+# used to answer AND/OR tag filters, their counts and random picks without
+# per-tag EXISTS subqueries. The database stays the source of truth: the index
+# is loaded at startup, patched by the crud mutation functions, and can be
+# checked against and rebuilt from the database.
+#
+# Mutations that land while a load is running are logged and replayed on the
+# loaded bitmaps. Every operation sets memberships, so replaying one that the
+# load already saw is harmless.
+class TagIndex:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.built_at = None
+        self.build_seconds = None
+        self._bitmaps: TagBitmaps | None = None
+        self._pending: list | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._bitmaps is not None
+
+    async def build(self, db: AsyncSession):
+        if not self.enabled:
+            return
+        started = time.perf_counter()
+        with self._lock:
+            self._pending = []
+        try:
+            bitmaps = await TagBitmaps.load(db)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for operation in self._pending:
+                operation(bitmaps)
+            self._pending = None
+            self._bitmaps = bitmaps
+        self.built_at = time.time()
+        self.build_seconds = time.perf_counter() - started
+
+    async def check(self, db: AsyncSession):
+        # Compares the live index with a fresh load and lists what differs
+        if not self.ready:
+            return None
+        expected = await TagBitmaps.load(db)
+        with self._lock:
+            live = self._bitmaps
+            return {
+                "images": live.images != expected.images,
+                "tags": sorted(tag_id for tag_id in set(live.tags) | set(expected.tags)
+                               if live.tags.get(tag_id, Bitmap()) != expected.tags.get(tag_id, Bitmap())),
+                "owners": sorted(owner_id for owner_id in set(live.owners) | set(expected.owners)
+                                 if live.owners.get(owner_id, Bitmap()) != expected.owners.get(owner_id, Bitmap())),
+            }
+
+    def _apply(self, operation):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(operation)
+            if self._bitmaps is not None:
+                operation(self._bitmaps)
+
+    def images_added(self, image_ids, owner_id: int, tag_ids):
+        image_ids, tag_ids = Bitmap.from_ids(image_ids), set(tag_ids)
+        self._apply(lambda bitmaps: bitmaps.add(image_ids, owner_id, tag_ids))
+
+    def images_removed(self, image_ids, owner_id: int, tag_ids):
+        image_ids, tag_ids = Bitmap.from_ids(image_ids), set(tag_ids)
+        self._apply(lambda bitmaps: bitmaps.remove(image_ids, owner_id, tag_ids))
+
+    def images_retagged(self, image_ids, removed_tag_ids, added_tag_ids):
+        # Removals are applied first, so a tag in both sets ends up linked
+        image_ids = Bitmap.from_ids(image_ids)
+        removed_tag_ids, added_tag_ids = set(removed_tag_ids), set(added_tag_ids)
+        self._apply(lambda bitmaps: bitmaps.retag(image_ids, removed_tag_ids, added_tag_ids))
+
+    def match(self, tags_and=(), tags_or=(), owner_id: int | None = None):
+        # Images with every tag in tags_and and at least one in tags_or, or
+        # None while the index is not loaded
+        with self._lock:
+            bitmaps = self._bitmaps
+            if bitmaps is None:
+                return None
+            result = bitmaps.owners.get(owner_id, Bitmap()) if owner_id is not None else bitmaps.images
+            # Smallest first, so the running intersection shrinks fastest
+            for tag_id in sorted(tags_and, key=lambda tag_id: len(bitmaps.tags.get(tag_id, ()))):
+                result = result & bitmaps.tags.get(tag_id, Bitmap())
+            if tags_or:
+                union = Bitmap()
+                for tag_id in tags_or:
+                    union.update(bitmaps.tags.get(tag_id, Bitmap()))
+                result = result & union
+            if not tags_and and not tags_or:
+                # Callers get a copy rather than the live bitmap
+                result = Bitmap(dict(result.chunks))
+            return result
+
+    def stats(self):
+        with self._lock:
+            bitmaps = self._bitmaps
+            return {
+                "enabled": self.enabled,
+                "ready": bitmaps is not None,
+                "loading": self._pending is not None,
+                "images": len(bitmaps.images) if bitmaps else 0,
+                "tags": len(bitmaps.tags) if bitmaps else 0,
+                "bytes": bitmaps.memory_bytes() if bitmaps else 0,
+                "built_at": self.built_at,
+                "build_seconds": self.build_seconds,
+            }
+
+
+tag_index = TagIndex(enabled=os.getenv("TAG_INDEX_ENABLED", "true").lower() not in ("0", "false", "no"))
@@ -0,0 +1,95 @@
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .database import insert_ignore
+
+# Bounded name -> id cache for tags. Only ids read back from the database
+# before this call's insert are cached, so an id created by a transaction
+# that later rolls back never ends up in the cache.
+class TagCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._ids: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, names: list[str]) -> dict[str, int]:
+        found = {}
+        with self._lock:
+            for name in names:
+                tag_id = self._ids.get(name)
+                if tag_id is not None:
+                    self._ids.move_to_end(name)
+                    found[name] = tag_id
+            self.hits += len(found)
+            self.misses += len(names) - len(found)
+        return found
+
+    def put_many(self, ids: dict[str, int]):
+        with self._lock:
+            self._ids.update(ids)
+            for name in ids:
+                self._ids.move_to_end(name)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self):
+        return {"size": len(self._ids), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+tag_cache = TagCache(int(os.getenv("TAG_CACHE_SIZE", 10000)))
+
+async def resolve_tags(db: AsyncSession, names: list[str]) -> dict[str, int]:
+    # Returns {name: id} in the order of names. Cache misses cost one SELECT,
+    # and missing tags are created with one INSERT ... ON CONFLICT DO NOTHING
+    # followed by a re-read, so concurrent creates of a name agree on its id.
+    # Nothing is committed here; the caller's transaction owns the inserts.
+    names = list(dict.fromkeys(names))
+    ids = tag_cache.get_many(names)
+    missing = [name for name in names if name not in ids]
+    if missing:
+        existing = dict((await db.execute(
+            select(models.Tag.name, models.Tag.id).where(models.Tag.name.in_(missing))
+        )).all())
+        tag_cache.put_many(existing)
+        ids.update(existing)
+
+        created = [name for name in missing if name not in existing]
+        if created:
+            await db.execute(insert_ignore(db, models.Tag.__table__), [{"name": name} for name in created])
+            ids.update((await db.execute(
+                select(models.Tag.name, models.Tag.id).where(models.Tag.name.in_(created))
+            )).all())
+    return {name: ids[name] for name in names}
+
+async def get_tags(db: AsyncSession, names: list[str]) -> list[models.Tag]:
+    # ORM Tag objects for relationship collections, in the order of names
+    ids = await resolve_tags(db, names)
+    if not ids:
+        return []
+    tags = {tag.id: tag for tag in await db.scalars(select(models.Tag).where(models.Tag.id.in_(ids.values())))}
+    return [tags[tag_id] for tag_id in ids.values()]
+
+async def lookup_tags(db: AsyncSession, names: list[str]) -> dict[str, int]:
+    # Like resolve_tags for filters: tags that do not exist are left out
+    # instead of being created
+    names = list(dict.fromkeys(names))
+    ids = tag_cache.get_many(names)
+    missing = [name for name in names if name not in ids]
+    if missing:
+        existing = dict((await db.execute(
+            select(models.Tag.name, models.Tag.id).where(models.Tag.name.in_(missing))
+        )).all())
+        tag_cache.put_many(existing)
+        ids.update(existing)
+    return {name: ids[name] for name in names if name in ids}
@@ -0,0 +1,57 @@
+import os
+import time
+
+import httpx
+
+from . import metrics
+
+# Headers relayed from AList to the client as-is
+PASSTHROUGH_HEADERS = ("Content-Length", "Content-Encoding", "ETag", "Last-Modified", "Accept-Ranges", "Content-Range")
+
+# Client headers forwarded to AList for a partial fetch
+RANGE_HEADERS = ("Range", "If-Range")
+
+def create_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 20)),
+        keepalive_expiry=float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 30)),
+    )
+    timeout = httpx.Timeout(
+        float(os.getenv("UPSTREAM_TIMEOUT", 30)),
+        connect=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5)),
+    )
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=timeout,
+        http2=os.getenv("UPSTREAM_HTTP2", "true").lower() == "true",
+        follow_redirects=True,
+    )
+
+async def open_stream(client: httpx.AsyncClient, url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    # The caller owns the returned response and must aclose() it
+    started = time.perf_counter()
+    try:
+        resp = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    except httpx.HTTPError:
+        metrics.UPSTREAM_ERRORS.inc()
+        raise
+    metrics.observe_upstream_first_byte(time.perf_counter() - started)
+    if resp.is_error:
+        metrics.UPSTREAM_ERRORS.inc()
+        await resp.aclose()
+        resp.raise_for_status()
+    return resp
+
+def media_type(resp: httpx.Response) -> str:
+    # Force content type to a common image type to prevent download
+    content_type = resp.headers.get("Content-Type", "image/png")
+    if "application" in content_type:
+        content_type = "image/png" # Fallback for incorrect server headers
+    return content_type
+
+def passthrough_headers(resp: httpx.Response) -> dict[str, str]:
+    return {name: resp.headers[name] for name in PASSTHROUGH_HEADERS if name in resp.headers}
+
+def range_headers(request_headers) -> dict[str, str]:
+    return {name: request_headers[name] for name in RANGE_HEADERS if name in request_headers}
@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from . import models
+
+# Short-lived LRU of bearer token -> authenticated user, so browsing the
+# gallery does not decode the JWT and look the user up on every request.
+# Entries live at most ttl seconds and never past the token's own expiry.
+# update_user and delete_user_by_id drop every entry for the user at once,
+# and other worker processes do the same when the change reaches them.
+class UserCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users: OrderedDict[str, tuple[float, models.User]] = OrderedDict()
+        self._tokens: dict[int, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._users.get(token)
+            if entry is not None:
+                expires_at, user = entry
+                if expires_at > time.monotonic():
+                    self._users.move_to_end(token)
+                    self.hits += 1
+                    return user
+                self._drop(token)
+            self.misses += 1
+            return None
+
+    def put(self, token: str, user: models.User, token_expires_at: float | None = None):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, time.monotonic() + token_expires_at - time.time())
+        # A detached copy, so the cached user never belongs to a request's
+        # session and sees nothing that session does to its own instance
+        cached = models.User(id=user.id, username=user.username, hashed_password=user.hashed_password, is_admin=user.is_admin)
+        make_transient_to_detached(cached)
+        with self._lock:
+            self._drop(token)
+            self._users[token] = (expires_at, cached)
+            self._tokens.setdefault(cached.id, set()).add(token)
+            while len(self._users) > self.maxsize:
+                self._drop(next(iter(self._users)))
+
+    def _drop(self, token: str):
+        entry = self._users.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens.get(entry[1].id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens[entry[1].id]
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            for token in list(self._tokens.get(user_id, ())):
+                self._drop(token)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._tokens.clear()
+
+    def stats(self):
+        return {"size": len(self._users), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache(int(os.getenv("AUTH_CACHE_SIZE", 1024)), float(os.getenv("AUTH_CACHE_TTL_SECONDS", 30)))
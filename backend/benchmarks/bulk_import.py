@@ -0,0 +1,47 @@
+"""Throughput of the set-based bulk import behind /api/images/bulk.
+
+    python -m benchmarks.bulk_import --urls 50000 --tags 3
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import crud, migrations, schemas
+from app.database import create_engines
+
+
+async def run(path: str, args):
+    engine, async_engine = create_engines(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    statements = 0
+
+    def count(*_):
+        nonlocal statements
+        statements += 1
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+
+    urls = [f"https://alist.example/d/photos/{i // 1000}/IMG_{i:06d}.jpg" for i in range(args.urls)]
+    tags = [f"tag{i}" for i in range(args.tags)]
+    async with async_sessionmaker(async_engine, expire_on_commit=False)() as db:
+        for label in ("first import", "re-import"):
+            statements = 0
+            start = time.perf_counter()
+            created = await crud.create_bulk_images(db, schemas.ImageBulkCreate(urls=urls, tags=tags), user_id=1)
+            elapsed = time.perf_counter() - start
+            print(f"{label:<13} {len(created):>7} created  {elapsed:6.2f} s  {args.urls / elapsed:8.0f} urls/s  {statements} statements")
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--urls", type=int, default=50000)
+    parser.add_argument("--tags", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(os.path.join(tmp, "bench.db"), args))
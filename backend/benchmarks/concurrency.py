@@ -0,0 +1,68 @@
+"""p50/p99 latency of the API under many concurrent clients.
+
+Point it at a running server (run it once on the commit before the async
+data layer and once after to compare):
+
+    python -m benchmarks.concurrency --url http://localhost:5235 --clients 500
+
+When 500 clients saturate the server, uvicorn's default 5 s keep-alive can
+expire before it reads a queued request and drop the connection; start it
+with --timeout-keep-alive 60 so those show up as latency, not errors.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(url: str, path: str, headers: dict[str, str], clients: int, requests: int):
+    latencies: list[float] = []
+    errors = 0
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, headers=headers, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for _ in range(requests):
+                start = time.perf_counter()
+                try:
+                    resp = await client.get(path)
+                    errors += resp.status_code >= 500
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{path:<32} {len(latencies) / elapsed:8.0f} req/s  "
+        f"p50 {statistics.median(latencies):7.1f} ms  p99 {percentile(latencies, 0.99):7.1f} ms  errors {errors}"
+    )
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url) as client:
+        resp = await client.post("/api/token", data={"username": args.username, "password": args.password})
+        resp.raise_for_status()
+        headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+    for path in ("/api/images/?limit=20", "/api/random/", "/api/users/me"):
+        await run(args.url, path, headers, args.clients, args.requests)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5235")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=10, help="requests per client")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,161 @@
+"""AList crawl throughput against a stub AList server, by crawler concurrency.
+
+Builds a synthetic directory tree in benchmarks.origin.StubAList, with a
+simulated per-request latency, then crawls a copy of it at each concurrency
+through the real app. Afterwards it interrupts a crawl and resumes it from
+its checkpoint, and runs an incremental re-sync after adding and changing a
+few files, checking that each imports exactly what it should:
+
+    python -m benchmarks.crawl --directories 200 --files 50 --latency-ms 20 --concurrency 1,4,16
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.origin import StubAList
+
+
+def build_tree(alist: StubAList, root: str, directories: int, files: int, fanout: int, modified: float):
+    # A tree `fanout` wide, each directory holding `files` images and a
+    # text file the crawler should ignore
+    paths = [root]
+    for index in range(1, directories):
+        paths.append(f"{paths[(index - 1) // fanout]}/album{index}")
+    for path in paths:
+        alist.add_directory(path, modified)
+        for number in range(files):
+            alist.add_file(f"{path}/img{number:05}.jpg", modified)
+        alist.add_file(f"{path}/notes.txt", modified)
+    return paths
+
+
+async def wait_for(client: httpx.AsyncClient, job_id: int, statuses=("completed", "failed", "cancelled"), condition=None):
+    while True:
+        job = (await client.get(f"/api/crawls/{job_id}")).json()
+        if job["status"] in statuses or (condition and condition(job)):
+            return job
+        await asyncio.sleep(0.02)
+
+
+async def crawl(client: httpx.AsyncClient, body: dict):
+    started = time.perf_counter()
+    job = (await client.post("/api/crawls/", json=body)).json()
+    job = await wait_for(client, job["id"])
+    return job, time.perf_counter() - started
+
+
+async def run(args, tmp: str):
+    os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+    os.environ["IMAGE_CACHE_DIR"] = os.path.join(tmp, "image_cache")
+    os.environ["PREFETCH_DEPTH"] = "0"
+    os.environ["CRAWL_PAGE_SIZE"] = str(args.page_size)
+    os.environ.setdefault("CRAWL_CHECKPOINT_SECONDS", "0.2")
+    from app.main import app
+
+    alist = StubAList(token="bench-token", delay=args.latency_ms / 1000).start()
+    old = time.time() - 86400
+    output = {"parameters": {name: value for name, value in vars(args).items() if name != "output"}, "results": []}
+    try:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                token = (await client.post("/api/token", data={"username": "admin", "password": "admin"})).json()["access_token"]
+                client.headers["Authorization"] = f"Bearer {token}"
+                expected = args.directories * args.files
+
+                for concurrency in args.concurrency:
+                    root = f"/c{concurrency}"
+                    build_tree(alist, root, args.directories, args.files, args.fanout, old)
+                    alist.list_requests = 0
+                    job, elapsed = await crawl(client, {"base_url": alist.base_url, "root": root, "token": alist.token, "concurrency": concurrency})
+                    progress = job["progress"]
+                    result = {
+                        "concurrency": concurrency,
+                        "status": job["status"],
+                        "seconds": round(elapsed, 3),
+                        "images_per_second": round(progress["imported"] / elapsed, 1),
+                        "directories_per_second": round(progress["directories"] / elapsed, 1),
+                        "list_requests": alist.list_requests,
+                        "imported": progress["imported"],
+                        "ok": job["status"] == "completed" and progress["imported"] == expected,
+                    }
+                    output["results"].append(result)
+                    print(f"concurrency {concurrency:>3}  {elapsed:7.2f} s  {result['images_per_second']:9.1f} images/s  "
+                          f"{result['list_requests']} listings" + ("" if result["ok"] else f"  MISMATCH {job}"))
+
+                # Interrupt a crawl halfway and resume it from its checkpoint
+                concurrency = args.concurrency[-1]
+                root = "/resume"
+                build_tree(alist, root, args.directories, args.files, args.fanout, old)
+                alist.list_requests = 0
+                job = (await client.post("/api/crawls/", json={"base_url": alist.base_url, "root": root, "token": alist.token, "concurrency": concurrency})).json()
+                await wait_for(client, job["id"], condition=lambda job: job["progress"]["imported"] >= expected // 2)
+                cancelled = (await client.post(f"/api/crawls/{job['id']}/cancel")).json()
+                (await client.post(f"/api/crawls/{job['id']}/sync")).raise_for_status()
+                job = await wait_for(client, job["id"])
+                full_listings = args.directories * -(-(args.files + 1) // args.page_size)
+                output["resume"] = {
+                    "imported_before_cancel": cancelled["progress"]["imported"],
+                    "imported": job["progress"]["imported"],
+                    "list_requests": alist.list_requests,
+                    "extra_list_requests": alist.list_requests - full_listings,
+                    "ok": job["status"] == "completed" and job["progress"]["imported"] == expected,
+                }
+                print(f"resume: cancelled at {cancelled['progress']['imported']} images, "
+                      f"finished with {job['progress']['imported']} of {expected}; "
+                      f"{output['resume']['extra_list_requests']} listings repeated")
+
+                # Incremental re-sync: new files in old directories, changed
+                # files, and a new directory
+                rng = random.Random(args.seed)
+                directories = sorted(path for path in alist.tree if path.startswith(root))
+                added = [f"{path}/new{index}.jpg" for index, path in enumerate(rng.sample(directories, min(10, len(directories))))]
+                for path in added:
+                    alist.add_file(path)
+                for path in rng.sample(directories, min(5, len(directories))):
+                    alist.add_file(f"{path}/img00000.jpg")
+                for number in range(args.files):
+                    alist.add_file(f"{root}/fresh/img{number:05}.jpg", old)
+                alist.list_requests = 0
+                started = time.perf_counter()
+                (await client.post(f"/api/crawls/{job['id']}/sync")).raise_for_status()
+                job = await wait_for(client, job["id"])
+                elapsed = time.perf_counter() - started
+                progress = job["progress"]
+                output["incremental"] = {
+                    "seconds": round(elapsed, 3),
+                    "list_requests": alist.list_requests,
+                    "imported": progress["imported"],
+                    "changed": progress["changed"],
+                    "skipped": progress["skipped"],
+                    "ok": job["status"] == "completed" and progress["imported"] == len(added) + args.files and progress["changed"] == min(5, len(directories)),
+                }
+                print(f"incremental: {elapsed:.2f} s, imported {progress['imported']} (expected {len(added) + args.files}), "
+                      f"changed {progress['changed']}, skipped {progress['skipped']}")
+    finally:
+        alist.stop()
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--directories", type=int, default=200)
+    parser.add_argument("--files", type=int, default=50, help="images per directory")
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=20, help="simulated AList response time")
+    parser.add_argument("--concurrency", type=lambda value: [int(n) for n in value.split(",")], default=[1, 4, 16])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        output = asyncio.run(run(args, tmp))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
@@ -0,0 +1,191 @@
+"""Generate a synthetic image library straight into the models schema.
+
+Users own images whose URLs look like AList download links, tagged from a
+vocabulary whose popularity follows a Zipf curve, plus API keys with AND/OR
+tag sets drawn the same way. A given seed always produces the same library:
+
+    python -m benchmarks.dataset --db library.db --users 5 --images 100000 --tags 500
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from passlib.context import CryptContext
+from sqlalchemy import insert
+
+from app.passwords import password_hasher
+
+BATCH = 20000
+
+STORAGES = ["local", "onedrive", "aliyun", "115", "s3"]
+ALBUMS = ["wallpapers", "camera", "screenshots", "pixiv", "travel", "memes", "scans", "avatars"]
+EXTENSIONS = [".jpg", ".png", ".webp", ".gif", ".jpeg"]
+EXTENSION_WEIGHTS = [60, 20, 12, 5, 3]
+WORDS = [
+    "landscape", "portrait", "anime", "cat", "dog", "sunset", "city", "night", "sea", "mountain",
+    "flower", "snow", "forest", "street", "food", "car", "sky", "rain", "art", "retro",
+]
+# Passwords are hashed once and shared by every generated user
+PASSWORD = "bench"
+
+
+class Library:
+    def __init__(self, users, tags, api_keys, images: int, base_url: str):
+        # users: [{"id", "username"}], all with PASSWORD
+        self.users = users
+        # Tag names, most popular first
+        self.tags = tags
+        # [{"key", "owner_id", "tags_and", "tags_or"}]
+        self.api_keys = api_keys
+        self.images = images
+        self.base_url = base_url
+
+    def summary(self):
+        return {"users": len(self.users), "images": self.images, "tags": len(self.tags), "api_keys": len(self.api_keys)}
+
+
+def tag_names(count: int):
+    return [WORDS[rank % len(WORDS)] + (str(rank // len(WORDS)) if rank >= len(WORDS) else "") for rank in range(count)]
+
+
+def zipf_weights(count: int, exponent: float):
+    # Cumulative, for random.choices(cum_weights=...)
+    weights, total = [], 0.0
+    for rank in range(count):
+        total += 1 / (rank + 1) ** exponent
+        weights.append(total)
+    return weights
+
+
+def image_row(rng: random.Random, number: int, owner_id: int, base_url: str, start: datetime):
+    taken = start + timedelta(seconds=number * 37 + rng.randrange(37))
+    extension = rng.choices(EXTENSIONS, EXTENSION_WEIGHTS)[0]
+    filename = f"IMG_{taken:%Y%m%d_%H%M%S}_{number:07d}{extension}"
+    path = f"{rng.choice(STORAGES)}/{rng.choice(ALBUMS)}/{taken:%Y}/{taken:%m}/{filename}"
+    return {
+        "id": number + 1,
+        "url": f"{base_url}/d/{path}",
+        # About a fifth of images carry a caption for search to find
+        "description": " ".join(rng.sample(WORDS, 3)) if rng.random() < 0.2 else None,
+        "filename": filename,
+        "filetype": extension,
+        "created_at": taken,
+        "owner_id": owner_id,
+    }
+
+
+def generate(
+    engine,
+    users: int = 3,
+    images: int = 10000,
+    tags: int = 200,
+    tags_per_image: int = 3,
+    keys_per_user: int = 3,
+    zipf: float = 1.0,
+    seed: int = 1,
+    base_url: str = "http://127.0.0.1:5244",
+) -> Library:
+    # Expects an empty, migrated database. app.models is imported here
+    # because app.database reads SQLALCHEMY_DATABASE_URL on import, which
+    # callers may still have to set.
+    from app import models
+
+    rng = random.Random(seed)
+    names = tag_names(tags)
+    weights = zipf_weights(tags, zipf)
+    hashed = CryptContext(schemes=["bcrypt"], bcrypt__rounds=password_hasher.rounds).hash(PASSWORD)
+    user_rows = [{"id": i + 1, "username": f"user{i}", "hashed_password": hashed, "is_admin": False} for i in range(users)]
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), user_rows)
+        conn.execute(insert(models.Tag), [{"id": i + 1, "name": name} for i, name in enumerate(names)])
+        for offset in range(0, images, BATCH):
+            rows = [image_row(rng, number, rng.randrange(users) + 1, base_url, start) for number in range(offset, min(offset + BATCH, images))]
+            conn.execute(insert(models.Image), rows)
+            conn.execute(insert(models.ImageTagAssociation), [
+                {"image_id": row["id"], "tag_id": tag + 1}
+                for row in rows for tag in set(rng.choices(range(tags), cum_weights=weights, k=tags_per_image))
+            ])
+
+        api_keys = []
+        for user in user_rows:
+            for k in range(keys_per_user):
+                # One common tag to require, and a few rarer alternatives
+                tags_and = sorted(set(rng.choices(range(min(tags, 20)), k=1)))
+                tags_or = sorted(set(rng.choices(range(tags), cum_weights=weights, k=rng.randrange(4))) - set(tags_and))
+                api_keys.append({
+                    "id": len(api_keys) + 1,
+                    "key": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    "name": f"{user['username']}-key{k}",
+                    "owner_id": user["id"],
+                    "tags_and": tags_and,
+                    "tags_or": tags_or,
+                })
+        if api_keys:
+            conn.execute(insert(models.ApiKey), [{name: key[name] for name in ("id", "key", "name", "owner_id")} for key in api_keys])
+            links = {
+                models.ApiKeyTagAssociationAnd: [{"api_key_id": key["id"], "tag_id": tag + 1} for key in api_keys for tag in key["tags_and"]],
+                models.ApiKeyTagAssociationOr: [{"api_key_id": key["id"], "tag_id": tag + 1} for key in api_keys for tag in key["tags_or"]],
+            }
+            for association, rows in links.items():
+                if rows:
+                    conn.execute(insert(association), rows)
+        if conn.dialect.name in ("sqlite", "postgresql"):
+            conn.exec_driver_sql("ANALYZE")
+
+    return Library(
+        users=[{"id": user["id"], "username": user["username"]} for user in user_rows],
+        tags=names,
+        api_keys=[{
+            "key": key["key"],
+            "owner_id": key["owner_id"],
+            "tags_and": [names[tag] for tag in key["tags_and"]],
+            "tags_or": [names[tag] for tag in key["tags_or"]],
+        } for key in api_keys],
+        images=images,
+        base_url=base_url,
+    )
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--images", type=int, default=10000)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--tags-per-image", type=int, default=3)
+    parser.add_argument("--keys-per-user", type=int, default=3)
+    parser.add_argument("--zipf", type=float, default=1.0, help="tag popularity exponent")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def generate_from_args(engine, args, base_url: str) -> Library:
+    return generate(
+        engine,
+        users=args.users,
+        images=args.images,
+        tags=args.tags,
+        tags_per_image=args.tags_per_image,
+        keys_per_user=args.keys_per_user,
+        zipf=args.zipf,
+        seed=args.seed,
+        base_url=base_url,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True, help="SQLite file to create")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5244", help="AList address used in image URLs")
+    add_arguments(parser)
+    args = parser.parse_args()
+    from app import migrations
+    from app.database import create_engines
+
+    engine, async_engine = create_engines(f"sqlite:///{args.db}")
+    migrations.upgrade(engine)
+    started = time.perf_counter()
+    library = generate_from_args(engine, args, args.base_url)
+    print(f"{library.summary()} in {time.perf_counter() - started:.1f} s; users log in with password {PASSWORD!r}")
+    engine.dispose()
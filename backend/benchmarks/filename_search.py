@@ -0,0 +1,78 @@
+"""Filename/description search latency, ILIKE scan vs the trigram index.
+
+    python -m benchmarks.filename_search --images 1000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import crud, migrations, search
+from app.database import create_engines
+
+WORDS = ["sunset", "beach", "forest", "city", "night", "portrait", "snow", "river", "mountain", "street"]
+EXTENSIONS = [".jpg", ".png", ".webp"]
+
+
+def seed(engine, images: int):
+    rng = random.Random(1)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO users (id, username, hashed_password) VALUES (1, 'bench', 'x')")
+        for offset in range(0, images, 50000):
+            rows = []
+            for i in range(offset, min(offset + 50000, images)):
+                word = rng.choice(WORDS)
+                filename = f"{word}_{i:07d}{rng.choice(EXTENSIONS)}"
+                description = f"{rng.choice(WORDS)} and {rng.choice(WORDS)}" if i % 4 == 0 else None
+                rows.append((i + 1, f"https://alist.example/d/{filename}", description, filename, filename[-4:], 1))
+            conn.exec_driver_sql(
+                "INSERT INTO images (id, url, description, filename, filetype, owner_id) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+
+async def run(path: str, args):
+    engine, async_engine = create_engines(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    begin = time.perf_counter()
+    seed(engine, args.images)
+    print(f"seeded {args.images} images (index kept by triggers) in {time.perf_counter() - begin:.1f} s")
+
+    cases = [
+        ("substring, 1 match", {"filename_like": f"_{args.images // 2:07d}."}),
+        ("substring, ~10%", {"filename_like": "mountain"}),
+        ("prefix", {"filename_like": "river_00012"}),
+        ("search", {"search": "snow and"}),
+        ("search, relevance", {"search": "snow and", "sort_by": "relevance"}),
+    ]
+    async with async_sessionmaker(async_engine, expire_on_commit=False)() as db:
+        for indexed in (False, True):
+            search.available["sqlite"] = indexed
+            print("trigram index" if indexed else "ILIKE scan")
+            for label, kwargs in cases:
+                for total in ("none", "exact"):
+                    timings = []
+                    for _ in range(args.repeat):
+                        crud.image_counts.forget_user(1)
+                        start = time.perf_counter()
+                        result = await crud.get_images(db, user_id=1, limit=args.limit, total=total, **kwargs)
+                        timings.append(time.perf_counter() - start)
+                        db.expunge_all()
+                    print(f"  {label:<20} total={total:<6} {statistics.median(timings) * 1000:9.2f} ms  "
+                          f"{len(result['images'])} images  total {result['total']}")
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=1000000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(os.path.join(tmp, "bench.db"), args))
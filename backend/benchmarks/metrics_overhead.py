@@ -0,0 +1,64 @@
+"""Per-request cost of the metrics middleware and the query hooks.
+
+Whole-request timings vary by far more than the instrumentation costs, so
+this times the instrumentation itself: a trivial ASGI app with and without
+MetricsMiddleware, and one query's pair of cursor hooks.
+
+    python -m benchmarks.metrics_overhead --requests 100000
+"""
+import argparse
+import asyncio
+import time
+
+from app import metrics
+
+
+class Route:
+    path = "/api/v1/random/{key}"
+
+
+async def endpoint(scope, receive, send):
+    scope["route"] = Route
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def drive(app, requests: int):
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app({"type": "http", "method": "GET", "path": "/api/v1/random/abc"}, receive, send)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+class Context:
+    pass
+
+
+def hooks(queries: int):
+    context = Context()
+    started = time.perf_counter()
+    for _ in range(queries):
+        metrics._before_cursor_execute(None, None, "SELECT 1", (), context, False)
+        metrics._after_cursor_execute(None, None, "SELECT 1", (), context, False)
+    return (time.perf_counter() - started) / queries * 1e6
+
+
+async def run(args):
+    bare = await drive(endpoint, args.requests)
+    instrumented = await drive(metrics.MetricsMiddleware(endpoint), args.requests)
+    print(f"request without middleware {bare:6.2f} us, with {instrumented:6.2f} us (+{instrumented - bare:.2f} us)")
+    token = metrics.request_stats.set(metrics.RequestStats())
+    print(f"query hooks                {hooks(args.requests):6.2f} us per query")
+    metrics.request_stats.reset(token)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000)
+    asyncio.run(run(parser.parse_args()))
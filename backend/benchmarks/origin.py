@@ -0,0 +1,162 @@
+"""A tiny keep-alive HTTP/1.1 server that stands in for an AList origin.
+
+It serves the same payload for every GET path and counts TCP connections
+and requests, so benchmarks can show how many upstream fetches and
+handshakes a code path costs. StubAList adds the fs/list API over an
+in-memory directory tree.
+"""
+import asyncio
+import hashlib
+import json
+import posixpath
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class StubOrigin:
+    def __init__(self, payload_size: int = 256 * 1024, delay: float = 0.0):
+        self.payload = bytes(range(256)) * (payload_size // 256) + bytes(payload_size % 256)
+        self.etag = '"%s"' % hashlib.md5(self.payload).hexdigest()
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.paths: list[str] = []
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def reset(self):
+        self.connections = 0
+        self.requests = 0
+        self.paths.clear()
+
+    def start(self):
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(asyncio.start_server(self._handle, "127.0.0.1", 0), self._loop)
+        self._server = future.result()
+        return self
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def respond(self, method: str, path: str, headers: dict[str, str]):
+        # Returns (status line, headers, body); subclasses add routes
+        return "200 OK", {
+            "Content-Type": "image/jpeg",
+            "ETag": self.etag,
+            "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+        }, self.payload
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                headers["_body"] = body.decode()
+                self.requests += 1
+                self.paths.append(path)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                status, response_headers, payload = self.respond(method, path, headers)
+                response_headers["Content-Length"] = str(len(payload))
+                head = f"HTTP/1.1 {status}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in response_headers.items())
+                writer.write(head.encode("latin-1") + b"\r\n" + (payload if method != "HEAD" else b""))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class StubAList(StubOrigin):
+    # Also answers AList's fs/list API from an in-memory directory tree, so
+    # the crawler can walk it; /d/... downloads get the payload
+    def __init__(self, token: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.token = token
+        self.tree: dict[str, dict[str, dict]] = {"/": {}}
+        self.list_requests = 0
+
+    @staticmethod
+    def timestamp(modified: float) -> str:
+        return datetime.fromtimestamp(modified, timezone.utc).isoformat().replace("+00:00", "Z")
+
+    def add_directory(self, path: str, modified: float | None = None):
+        path = "/" + path.strip("/")
+        if path in self.tree:
+            return
+        parent, name = posixpath.split(path)
+        self.add_directory(parent, modified)
+        self.tree[path] = {}
+        self._put(parent, {"name": name, "size": 0, "is_dir": True, "type": 1, "sign": ""}, modified)
+
+    def add_file(self, path: str, modified: float | None = None, sign: str = ""):
+        # Adding or changing a file also changes its directory's modified
+        # time, as on a real filesystem
+        parent, name = posixpath.split("/" + path.strip("/"))
+        self.add_directory(parent, modified)
+        image = name.rsplit(".", 1)[-1].lower() in ("jpg", "jpeg", "png", "gif", "webp")
+        self._put(parent, {"name": name, "size": len(self.payload), "is_dir": False, "type": 5 if image else 0, "sign": sign}, modified)
+        self.touch(parent, modified)
+
+    def touch(self, path: str, modified: float | None = None):
+        parent, name = posixpath.split(path)
+        if name and name in self.tree.get(parent, {}):
+            self.tree[parent][name]["modified"] = self.timestamp(modified or time.time())
+
+    def _put(self, parent: str, entry: dict, modified: float | None):
+        entry["modified"] = self.timestamp(modified or time.time())
+        self.tree[parent][entry["name"]] = entry
+
+    def files(self) -> int:
+        return sum(not entry["is_dir"] for entries in self.tree.values() for entry in entries.values())
+
+    def respond(self, method: str, path: str, headers: dict[str, str]):
+        if path != "/api/fs/list":
+            return super().respond(method, path, headers)
+        self.list_requests += 1
+        if self.token and headers.get("authorization") != self.token:
+            return self._json({"code": 401, "message": "token is invalidated", "data": None})
+        request = json.loads(headers["_body"] or "{}")
+        entries = self.tree.get("/" + request.get("path", "/").strip("/"))
+        if entries is None:
+            return self._json({"code": 500, "message": "object not found", "data": None})
+        content = [entries[name] for name in sorted(entries)]
+        page, per_page = request.get("page", 1), request.get("per_page", 0)
+        if per_page:
+            content = content[(page - 1) * per_page:page * per_page]
+        return self._json({"code": 200, "message": "success", "data": {
+            "content": content, "total": len(entries), "readme": "", "header": "", "write": False, "provider": "Local",
+        }})
+
+    @staticmethod
+    def _json(body: dict):
+        return "200 OK", {"Content-Type": "application/json; charset=utf-8"}, json.dumps(body).encode()
@@ -0,0 +1,87 @@
+"""Latency and statement count of image listing pages, OFFSET vs cursor.
+
+    python -m benchmarks.pagination --images 100000 --limit 20 --page 5000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import crud, migrations, models
+from app.database import create_engines
+
+
+def seed(engine, images: int, tags: int):
+    start = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": 1, "username": "bench", "hashed_password": "x"}])
+        conn.execute(insert(models.Tag), [{"id": i + 1, "name": f"tag{i}"} for i in range(tags)])
+        for offset in range(0, images, 10000):
+            batch = range(offset, min(offset + 10000, images))
+            conn.execute(insert(models.Image), [{
+                "id": i + 1,
+                "url": f"https://alist.example/d/photos/IMG_{i:07d}.jpg",
+                "filename": f"IMG_{i:07d}.jpg",
+                "filetype": "jpg",
+                # Bulk imports share timestamps, so keep plenty of ties
+                "created_at": start + timedelta(seconds=i // 10),
+                "owner_id": 1,
+            } for i in batch])
+            conn.execute(insert(models.ImageTagAssociation), [
+                {"image_id": i + 1, "tag_id": (i + k) % tags + 1} for i in batch for k in range(min(3, tags))
+            ])
+
+
+async def run(path: str, args):
+    engine, async_engine = create_engines(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    seed(engine, args.images, args.tags)
+    statements = 0
+
+    def count(*_):
+        nonlocal statements
+        statements += 1
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+
+    async with async_sessionmaker(async_engine, expire_on_commit=False)() as db:
+        async def measure(label, **kwargs):
+            nonlocal statements
+            timings = []
+            for _ in range(args.repeat):
+                statements = 0
+                begin = time.perf_counter()
+                result = await crud.get_images(db, user_id=1, limit=args.limit, sort_by=args.sort_by, sort_order=args.sort_order, total=args.total, **kwargs)
+                timings.append(time.perf_counter() - begin)
+                db.expunge_all()
+            print(f"{label:<24} {statistics.median(timings) * 1000:8.2f} ms  {statements} statements  {len(result['images'])} images")
+            return result
+
+        first = await measure("page 1")
+        await measure("page 2 (cursor)", cursor=first["next_cursor"])
+        skip = (args.page - 1) * args.limit
+        previous = await crud.get_images(db, user_id=1, skip=skip - args.limit, limit=args.limit, sort_by=args.sort_by, sort_order=args.sort_order)
+        await measure(f"page {args.page} (offset)", skip=skip)
+        await measure(f"page {args.page} (cursor)", cursor=previous["next_cursor"])
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--page", type=int, default=5000)
+    parser.add_argument("--sort-by", default="created_at")
+    parser.add_argument("--sort-order", default="desc")
+    parser.add_argument("--total", default="exact", choices=["exact", "estimate", "none"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(os.path.join(tmp, "bench.db"), args))
@@ -0,0 +1,55 @@
+"""Login storm against the bcrypt pool: admitted vs rejected logins and how
+long other work waits for the shared default executor meanwhile.
+
+    python -m benchmarks.password_pool --logins 200 --workers 2 --queue 8
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app.passwords import PasswordHasher, PasswordPoolBusy, _context
+
+
+async def probe_default_executor(stop: asyncio.Event, delays: list[float]):
+    # What a sync route or file response waits for a default-executor thread
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = time.perf_counter()
+        await loop.run_in_executor(None, lambda: None)
+        delays.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+
+
+async def storm(label: str, verify, logins: int):
+    stop, delays = asyncio.Event(), []
+    probe = asyncio.create_task(probe_default_executor(stop, delays))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(verify() for _ in range(logins)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    rejected = sum(isinstance(result, PasswordPoolBusy) for result in results)
+    print(f"{label:<22} {logins - rejected:>5} verified  {rejected:>5} rejected (429)  {elapsed:6.2f} s  "
+          f"default executor wait p50 {statistics.median(delays) * 1000:7.2f} ms  max {max(delays) * 1000:8.2f} ms")
+
+
+async def run(args):
+    hashed = _context(args.rounds).hash("secret")
+    # Before: every verify went through asyncio.to_thread
+    await storm("default executor", lambda: asyncio.to_thread(_context(args.rounds).verify, "secret", hashed), args.logins)
+    hasher = PasswordHasher(args.workers, args.queue, args.rounds, use_processes=args.processes)
+    await storm("bounded bcrypt pool", lambda: hasher.verify_and_update("secret", hashed), args.logins)
+    print(hasher.stats())
+    hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--processes", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args))
@@ -0,0 +1,69 @@
+"""Latency of /api/v1/random/{key} with and without the prefetch buffer.
+
+Runs the app in-process against a slow stand-in origin. Each run uses its
+own key and image set, so neither benefits from the other's disk cache:
+
+    python -m benchmarks.prefetch --images 500 --requests 300 --origin-delay 0.05 --depth 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.origin import StubOrigin
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+
+async def run(args):
+    from app.main import app
+
+    with StubOrigin(payload_size=args.payload, delay=args.origin_delay) as origin:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                token = (await client.post("/api/token", data={"username": "admin", "password": "admin"})).json()["access_token"]
+                headers = {"Authorization": f"Bearer {token}"}
+                for label, depth in (("no prefetch", 0), (f"prefetch depth {args.depth}", args.depth)):
+                    tag = f"set{depth}"
+                    urls = [origin.url(f"d/{tag}/{i}.jpg") for i in range(args.images)]
+                    await client.post("/api/images/bulk", json={"urls": urls, "tags": [tag]}, headers=headers)
+                    key = (await client.post("/api/keys/", json={"name": tag, "tags_and": [tag], "prefetch_depth": depth}, headers=headers)).json()["key"]
+                    origin.reset()
+                    timings = []
+                    for _ in range(args.requests):
+                        started = time.perf_counter()
+                        resp = await client.get(f"/api/v1/random/{key}")
+                        timings.append(time.perf_counter() - started)
+                        assert resp.status_code == 200 and len(resp.content) == args.payload, resp.status_code
+                        # Embeds arrive spread out rather than back to back
+                        await asyncio.sleep(args.interval)
+                    print(f"{label:<20} p50 {statistics.median(timings) * 1000:7.2f} ms  p99 {percentile(timings, 0.99):7.2f} ms  "
+                          f"{origin.requests} upstream requests")
+                stats = (await client.get("/api/admin/prefetch", headers=headers)).json()
+                print({name: stats[name] for name in ("hits", "misses", "hit_ratio", "stale", "fetched", "errors")})
+                # Let the last refills finish before the origin goes away
+                await asyncio.sleep(args.origin_delay * 4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--payload", type=int, default=64 * 1024)
+    parser.add_argument("--origin-delay", type=float, default=0.05)
+    parser.add_argument("--interval", type=float, default=0.02)
+    parser.add_argument("--depth", type=int, default=8)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app reads these at import time
+        os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ["IMAGE_CACHE_DIR"] = os.path.join(tmp, "image_cache")
+        asyncio.run(run(args))
@@ -0,0 +1,67 @@
+"""Load test of the upstream fetch used by /api/v1/random/{key}.
+
+Compares the previous behaviour (a new httpx.AsyncClient per request and a
+fully buffered body) with the shared, pooled, streaming client against a
+local stand-in origin:
+
+    python -m benchmarks.proxy_load --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from app import upstream
+from benchmarks.origin import StubOrigin
+
+
+async def per_request_client(url: str):
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(url, follow_redirects=True)
+        resp.raise_for_status()
+        return len(resp.content)
+
+
+async def shared_client(client: httpx.AsyncClient, url: str):
+    resp = await upstream.open_stream(client, url)
+    try:
+        size = 0
+        async for chunk in resp.aiter_raw():
+            size += len(chunk)
+        return size
+    finally:
+        await resp.aclose()
+
+
+async def drive(fetch, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await fetch()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return time.perf_counter() - start
+
+
+async def main(args):
+    with StubOrigin(payload_size=args.payload) as origin:
+        url = origin.url("d/bench/image.jpg")
+
+        elapsed = await drive(lambda: per_request_client(url), args.requests, args.concurrency)
+        print(f"per-request client: {args.requests / elapsed:8.0f} req/s, {origin.connections} upstream connections")
+        origin.reset()
+
+        async with upstream.create_client() as client:
+            elapsed = await drive(lambda: shared_client(client, url), args.requests, args.concurrency)
+        print(f"shared client:      {args.requests / elapsed:8.0f} req/s, {origin.connections} upstream connections")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--payload", type=int, default=256 * 1024)
+    asyncio.run(main(parser.parse_args()))
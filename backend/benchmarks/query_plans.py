@@ -0,0 +1,100 @@
+"""Checks with EXPLAIN QUERY PLAN that the hot queries use an index.
+
+Runs the crud functions behind the gallery, tag filters, search, random
+endpoints and API keys against a seeded SQLite database, captures the
+SELECTs they issue and fails if any plan scans a whole table or sorts
+a listing in a temporary b-tree.
+
+    python -m benchmarks.query_plans --images 20000
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import crud, migrations, schemas
+from app.database import create_engines
+from benchmarks.pagination import seed
+
+FULL_SCAN = re.compile(r"^SCAN (images|tags|users|api_keys|image_tag_association|api_key_tag_association_\w+)\b")
+SORT = "USE TEMP B-TREE FOR ORDER BY"
+
+
+def problems(plan: list[str], sorted_listing: bool):
+    for detail in plan:
+        if FULL_SCAN.match(detail):
+            yield f"full scan: {detail}"
+        if sorted_listing and detail == SORT:
+            yield "sort without an index"
+
+
+async def run(path: str, args):
+    engine, async_engine = create_engines(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    seed(engine, args.images, args.tags)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE")
+        conn.commit()
+
+    statements = []
+    event.listen(
+        async_engine.sync_engine, "before_cursor_execute",
+        lambda conn, cursor, statement, parameters, context, executemany: statements.append((statement, parameters)),
+    )
+
+    async with async_sessionmaker(async_engine, expire_on_commit=False)() as db:
+        api_key = await crud.create_api_key(db, schemas.ApiKeyCreate(name="bench", tags_and=["tag1"], tags_or=["tag2", "tag3"]), user_id=1)
+        second_page = (await crud.get_images(db, user_id=1, limit=20))["next_cursor"]
+        # (name, call, whether its listing must come out of an index in order)
+        cases = [
+            ("list by created_at", lambda: crud.get_images(db, user_id=1, limit=20), True),
+            ("list by created_at, cursor", lambda: crud.get_images(db, user_id=1, limit=20, cursor=second_page), True),
+            ("list by filename", lambda: crud.get_images(db, user_id=1, limit=20, sort_by="filename", sort_order="asc"), True),
+            ("list by filetype", lambda: crud.get_images(db, user_id=1, limit=20, sort_by="filetype"), True),
+            ("list with tag filter", lambda: crud.get_images(db, user_id=1, limit=20, tags=["tag3"]), True),
+            ("list with filename_like", lambda: crud.get_images(db, user_id=1, limit=20, filename_like="IMG_0001"), False),
+            ("random image by tag", lambda: crud.get_random_image(db, "tag3"), False),
+            ("candidate pool build", lambda: crud._build_candidate_pool(db, api_key), False),
+            ("api key lookup", lambda: crud.get_api_key_by_key(db, api_key.key), False),
+            ("api keys of user", lambda: crud.get_api_keys(db, user_id=1), False),
+            ("user by username", lambda: crud.get_user_by_username(db, "bench"), False),
+        ]
+        failures = 0
+        for name, call, sorted_listing in cases:
+            statements.clear()
+            crud.image_counts.forget_user(1)
+            await call()
+            db.expunge_all()
+            found = []
+            for statement, parameters in list(statements):
+                if not statement.lstrip().upper().startswith("SELECT"):
+                    continue
+                with engine.connect() as conn:
+                    plan = [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+                found += problems(plan, sorted_listing and "LIMIT" in statement)
+                if args.verbose:
+                    print(f"  {' '.join(statement.split())[:120]}")
+                    for detail in plan:
+                        print(f"      {detail}")
+            print(f"{'FAIL' if found else 'ok  '} {name}")
+            for problem in found:
+                print(f"       {problem}")
+            failures += bool(found)
+    await async_engine.dispose()
+    engine.dispose()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20000)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        sys.exit(1 if asyncio.run(run(os.path.join(tmp, "bench.db"), args)) else 0)
@@ -0,0 +1,105 @@
+"""Latency of the random-image selection as the images table grows.
+
+Run from the backend directory:
+
+    python -m benchmarks.random_selection --sizes 1000 10000 100000 200000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, or_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, migrations, models
+
+
+def populate(db, size: int, tag_names: list[str]):
+    tags = [models.Tag(name=name) for name in tag_names]
+    db.add_all(tags)
+    db.flush()
+    db.execute(insert(models.Image), [
+        {"url": f"https://alist.example/d/bench/{i}.jpg", "filename": f"{i}.jpg", "filetype": ".jpg", "owner_id": 1}
+        for i in range(1, size + 1)
+    ])
+    db.execute(insert(models.ImageTagAssociation), [
+        {"image_id": i, "tag_id": tags[i % len(tags)].id}
+        for i in range(1, size + 1)
+    ])
+    api_key = models.ApiKey(key="bench", name="bench", owner_id=1)
+    api_key.tags_or = tags[:2]
+    db.add(api_key)
+    db.commit()
+
+
+def load_all(db, key: str):
+    # The previous implementation: materialize every candidate, then choose.
+    api_key = db.query(models.ApiKey).filter(models.ApiKey.key == key).first()
+    query = db.query(models.Image).filter(or_(*[models.Image.tags.any(name=tag.name) for tag in api_key.tags_or]))
+    return random.choice(query.distinct().all())
+
+
+def timed(fn, rounds: int):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def timed_async(fn, rounds: int):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def probe(path: str, rounds: int):
+    # Times the selection query itself, bypassing the per-key candidate pools
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+        async def pick():
+            await crud._pick_random_image(db, select_ids())
+            db.expunge_all()
+        result = await timed_async(pick, rounds)
+    await engine.dispose()
+    return result
+
+
+def select_ids():
+    return select(models.Image.id).where(
+        or_(*[models.Image.tags.any(name=name) for name in ("tag0", "tag1")])
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 200000])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'images':>10} {'load-all ms':>12} {'probe ms':>12}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            engine = create_engine(f"sqlite:///{path}")
+            migrations.upgrade(engine)
+            db = sessionmaker(bind=engine)()
+            populate(db, size, [f"tag{i}" for i in range(8)])
+            before = timed(lambda: (load_all(db, "bench"), db.expunge_all()), args.rounds)
+            db.close()
+            engine.dispose()
+            after = asyncio.run(probe(path, args.rounds))
+        print(f"{size:>10} {before:>12.2f} {after:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
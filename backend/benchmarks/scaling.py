@@ -0,0 +1,164 @@
+"""Throughput of a real server as the number of worker processes grows.
+
+Generates a synthetic library (see benchmarks.dataset), then for each worker
+count starts python -m app.serve with WORKERS=n and loads it from separate
+client processes for a fixed time. Needs a machine with spare cores for
+the load generators:
+
+    python -m benchmarks.scaling --workers 1,2,4,8 --clients 4 --seconds 10 --output scaling.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import dataset
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(base_url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/api/config").status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000 if ordered else None
+
+
+async def load(base_url: str, requests: list, concurrency: int, seconds: float, seed: int):
+    rng = random.Random(seed)
+    timings, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        deadline = time.monotonic() + seconds
+
+        async def worker():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                url, params, headers = rng.choice(requests)
+                started = time.perf_counter()
+                try:
+                    resp = await client.get(url, params=params, headers=headers)
+                    ok = resp.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                timings.append(time.perf_counter() - started)
+                errors += not ok
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return timings, errors
+
+
+def client_process(args):
+    return asyncio.run(load(*args))
+
+
+def requests_for(library: dataset.Library, token: str, path: str):
+    headers = {"Authorization": f"Bearer {token}"}
+    keys = [key["key"] for key in library.api_keys]
+    random_picks = [(f"/api/v1/random/{key}", {"mode": "json"}, {}) for key in keys]
+    listings = [("/api/images/", {"limit": 20, "tags": [tag]}, headers) for tag in library.tags[:20]]
+    listings += [("/api/images/", {"limit": 20, "skip": skip}, headers) for skip in (0, 20, 40)]
+    return {"random": random_picks, "listing": listings, "mixed": random_picks * 3 + listings}[path]
+
+
+def run(args, tmp: str):
+    database_url = f"sqlite:///{tmp}/bench.db"
+    os.environ["SQLALCHEMY_DATABASE_URL"] = database_url
+    from app import migrations
+    from app.database import create_engines
+
+    engine, _ = create_engines(database_url)
+    migrations.upgrade(engine)
+    library = dataset.generate_from_args(engine, args, "http://127.0.0.1:5244")
+    engine.dispose()
+    print(f"dataset {library.summary()}")
+
+    results = []
+    for workers in args.workers:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        env = {
+            **os.environ,
+            "WORKERS": str(workers),
+            "BACKEND_PORT": str(port),
+            "BACKEND_HOST": "127.0.0.1",
+            "LOG_LEVEL": "warning",
+            "IMAGE_CACHE_DIR": os.path.join(tmp, "image_cache"),
+            "SHARED_CACHE_URL": f"sqlite:///{tmp}/shared-{workers}.db" if workers > 1 else "memory://",
+            "METRICS_ENABLED": os.getenv("METRICS_ENABLED", "true"),
+        }
+        server = subprocess.Popen([sys.executable, "-m", "app.serve"], env=env)
+        try:
+            wait_ready(base_url)
+            token = httpx.post(f"{base_url}/api/token", data={"username": library.users[0]["username"], "password": dataset.PASSWORD}).json()["access_token"]
+            requests = requests_for(library, token, args.path)
+            jobs = [(base_url, requests, args.concurrency, args.seconds, args.seed + i) for i in range(args.clients)]
+            with multiprocessing.Pool(args.clients) as pool:
+                # A short warm-up fills every worker's pools and caches
+                pool.map(client_process, [(base_url, requests, args.concurrency, min(2.0, args.seconds), i) for i in range(args.clients)])
+                started = time.perf_counter()
+                outcomes = pool.map(client_process, jobs)
+                elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+        timings = [timing for samples, _ in outcomes for timing in samples]
+        result = {
+            "workers": workers,
+            "requests": len(timings),
+            "requests_per_second": round(len(timings) / elapsed, 1),
+            "p50_ms": round(percentile(timings, 0.5), 3),
+            "p99_ms": round(percentile(timings, 0.99), 3),
+            "errors": sum(errors for _, errors in outcomes),
+        }
+        result["speedup"] = round(result["requests_per_second"] / results[0]["requests_per_second"], 2) if results else 1.0
+        results.append(result)
+        print(f"{workers:>3} workers {result['requests_per_second']:9.1f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+              f"p99 {result['p99_ms']:7.2f} ms  x{result['speedup']:.2f}" + (f"  {result['errors']} errors" if result["errors"] else ""))
+    return {
+        "cpus": os.cpu_count(),
+        "parameters": {name: value for name, value in vars(args).items() if name != "output"},
+        "dataset": library.summary(),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    dataset.add_arguments(parser)
+    parser.add_argument("--workers", type=lambda value: [int(n) for n in value.split(",")],
+                        default=[n for n in (1, 2, 4, 8, 16) if n <= (os.cpu_count() or 1)])
+    parser.add_argument("--path", choices=("random", "listing", "mixed"), default="mixed")
+    parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="load generator processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="connections per client process")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        output = run(args, tmp)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
@@ -0,0 +1,42 @@
+"""Checks that concurrent fetches of one URL cost a single upstream request.
+
+Fires N concurrent joins for the same image at a slow local stand-in origin
+and asserts the origin saw exactly one fetch while every waiter received
+the full body:
+
+    python -m benchmarks.single_flight --concurrency 200
+"""
+import argparse
+import asyncio
+import time
+
+from app import upstream
+from app.singleflight import SingleFlight
+from benchmarks.origin import StubOrigin
+
+
+async def read(flight):
+    await flight.wait_ready()
+    return b"".join([chunk async for chunk in flight.stream()])
+
+
+async def main(args):
+    with StubOrigin(payload_size=args.payload, delay=0.05) as origin:
+        url = origin.url("d/bench/popular.jpg")
+        flights = SingleFlight()
+        async with upstream.create_client() as client:
+            start = time.perf_counter()
+            bodies = await asyncio.gather(*(read(flights.join(client, url)) for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+
+        assert origin.requests == 1, f"expected one upstream fetch, origin saw {origin.requests}"
+        assert all(body == origin.payload for body in bodies), "a waiter received a different body"
+        print(f"{args.concurrency} concurrent requests, {origin.requests} upstream fetch, {elapsed * 1000:.1f} ms")
+        print(flights.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--payload", type=int, default=512 * 1024)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,86 @@
+"""Mixed read/write load against SQLite with the default and tuned engines.
+
+Writer threads insert images in batches (like a bulk import) while reader
+threads run the random-image lookups. Reports reads/s, rows written/s and
+"database is locked" failures for each profile:
+
+    python -m benchmarks.sqlite_tuning --seconds 5 --readers 8 --writers 2
+"""
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import OperationalError
+
+from app import migrations, models
+from app.database import create_engines
+
+
+def run_profile(path: str, tuned: bool, args):
+    engine, _ = create_engines(f"sqlite:///{path}", tuned=tuned)
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Image), [{"url": f"seed/{i}", "owner_id": 1} for i in range(args.seed)])
+
+    counter = itertools.count()
+    stop = time.perf_counter() + args.seconds
+    stats = {"reads": 0, "rows": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def reader():
+        while time.perf_counter() < stop:
+            try:
+                with engine.connect() as conn:
+                    high = conn.execute(select(func.max(models.Image.id))).scalar()
+                    conn.execute(select(models.Image).where(models.Image.id == random.randint(1, high))).first()
+                with lock:
+                    stats["reads"] += 1
+            except OperationalError:
+                with lock:
+                    stats["locked"] += 1
+
+    def writer():
+        while time.perf_counter() < stop:
+            batch = [{"url": f"bulk/{next(counter)}", "owner_id": 1} for _ in range(args.batch)]
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(models.Image), batch)
+                with lock:
+                    stats["rows"] += len(batch)
+            except OperationalError:
+                with lock:
+                    stats["locked"] += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return {name: value / args.seconds if name != "locked" else value for name, value in stats.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{'profile':<10} {'reads/s':>10} {'rows/s':>10} {'locked':>8}")
+    for name, tuned in (("default", False), ("tuned", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run_profile(os.path.join(tmp, "bench.db"), tuned, args)
+        print(f"{name:<10} {result['reads']:>10.0f} {result['rows']:>10.0f} {result['locked']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Throughput, latency and query counts for the main API paths.
+
+Generates a synthetic library (see benchmarks.dataset), then drives the app
+in-process against a stub AList origin: listing, search, random, proxy,
+bulk import and bulk tagging. Results can be written as JSON and compared
+with a run from another commit:
+
+    python -m benchmarks.suite --images 50000 --output before.json
+    python -m benchmarks.suite --images 50000 --compare before.json
+
+Prefetching is turned off so the proxy scenario measures the request path
+and background refills do not add to query counts.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+
+import httpx
+import sqlalchemy
+from sqlalchemy import event, select
+
+from benchmarks import dataset
+from benchmarks.origin import StubOrigin
+
+SCENARIOS = ["listing", "search", "random", "proxy", "bulk_import", "bulk_tag"]
+
+queries: ContextVar[list[int] | None] = ContextVar("queries", default=None)
+
+
+def count_query(*_):
+    counter = queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+class Scenario:
+    # make_request(rng) returns (method, url, kwargs, items): items is how
+    # many images the request handles, for bulk throughput
+    def __init__(self, name: str, make_request, expected=(200,)):
+        self.name = name
+        self.make_request = make_request
+        self.expected = expected
+
+
+def build_scenarios(library: dataset.Library, owned_images: list[int], headers, args):
+    # Requests are made as the first user, with its keys and images
+    tags = library.tags
+    weights = dataset.zipf_weights(len(tags), args.zipf)
+    owned_keys = [key["key"] for key in library.api_keys if key["owner_id"] == 1]
+    imported = iter(range(sys.maxsize))
+
+    def popular_tag(rng):
+        return rng.choices(tags, cum_weights=weights)[0]
+
+    def listing(rng):
+        params = {"limit": 20, "skip": rng.choice((0, 0, 20, 40, 200))}
+        if rng.random() < 0.5:
+            params["tags"] = [popular_tag(rng)]
+        params["sort_by"] = rng.choice(("created_at", "filename"))
+        return "GET", "/api/images/", {"params": params, "headers": headers}, 0
+
+    def search(rng):
+        term = rng.choice((rng.choice(dataset.WORDS), f"IMG_20{rng.randrange(20, 24)}", rng.choice(dataset.ALBUMS)))
+        return "GET", "/api/images/", {"params": {"search": term, "limit": 20}, "headers": headers}, 0
+
+    def random_pick(rng):
+        return "GET", f"/api/v1/random/{rng.choice(owned_keys)}", {"params": {"mode": "json"}}, 0
+
+    def proxy(rng):
+        return "GET", f"/api/v1/random/{rng.choice(owned_keys)}", {"params": {"mode": "proxy"}}, 0
+
+    def bulk_import(rng):
+        urls = [f"{library.base_url}/d/local/import/{next(imported):09d}.jpg" for _ in range(args.batch)]
+        return "POST", "/api/images/bulk", {"json": {"urls": urls, "tags": [popular_tag(rng)]}, "headers": headers}, len(urls)
+
+    def bulk_tag(rng):
+        ids = rng.sample(owned_images, min(args.batch, len(owned_images)))
+        body = {"image_ids": ids, "tags": [popular_tag(rng), f"bench{rng.randrange(10)}"]}
+        return "POST", "/api/images/bulk-add-tags", {"json": body, "headers": headers}, len(ids)
+
+    return {
+        "listing": Scenario("listing", listing),
+        "search": Scenario("search", search),
+        "random": Scenario("random", random_pick, expected=(200, 404)),
+        "proxy": Scenario("proxy", proxy, expected=(200, 404)),
+        "bulk_import": Scenario("bulk_import", bulk_import),
+        "bulk_tag": Scenario("bulk_tag", bulk_tag),
+    }
+
+
+async def measure(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int, seed: int):
+    rng = random.Random(seed)
+    timings, query_counts, errors, items = [], [], 0, 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, items
+        for _ in remaining:
+            method, url, kwargs, count = scenario.make_request(rng)
+            counter = [0]
+            token = queries.set(counter)
+            started = time.perf_counter()
+            try:
+                resp = await client.request(method, url, **kwargs)
+                # Proxied bodies stream; time until the last byte
+                await resp.aread()
+            finally:
+                elapsed = time.perf_counter() - started
+                queries.reset(token)
+            timings.append(elapsed)
+            query_counts.append(counter[0])
+            if resp.status_code not in scenario.expected:
+                errors += 1
+            elif resp.status_code == 200:
+                items += count
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(requests / seconds, 1),
+        "p50_ms": round(percentile(timings, 0.5), 3),
+        "p99_ms": round(percentile(timings, 0.99), 3),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 3),
+        "queries_per_request": round(statistics.fmean(query_counts), 2),
+        "errors": errors,
+    }
+    if items:
+        result["items_per_second"] = round(items / seconds, 1)
+    return result
+
+
+async def run(args):
+    results = {}
+    with StubOrigin(payload_size=args.payload, delay=args.origin_delay) as origin:
+        from app import migrations, models
+        from app.database import create_engines
+
+        engine, async_engine = create_engines(os.environ["SQLALCHEMY_DATABASE_URL"])
+        migrations.upgrade(engine)
+        started = time.perf_counter()
+        library = dataset.generate_from_args(engine, args, origin.base_url)
+        generate_seconds = time.perf_counter() - started
+        with engine.connect() as conn:
+            owned_images = list(conn.scalars(select(models.Image.id).where(models.Image.owner_id == 1)))
+        engine.dispose()
+        print(f"dataset {library.summary()} generated in {generate_seconds:.1f} s")
+
+        from app.main import app
+        from app.database import async_engine as app_engine
+        event.listen(app_engine.sync_engine, "after_cursor_execute", count_query)
+
+        async with app.router.lifespan_context(app):
+            # Measure with the tag index loaded, as a long-running server has it
+            await app.state.tag_index_task
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                login = await client.post("/api/token", data={"username": library.users[0]["username"], "password": dataset.PASSWORD})
+                headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+                scenarios = build_scenarios(library, owned_images, headers, args)
+                for name in args.scenarios:
+                    scenario = scenarios[name]
+                    bulk = name.startswith("bulk")
+                    requests = args.bulk_requests if bulk else args.requests
+                    if args.warmup and not bulk:
+                        await measure(client, scenario, args.warmup, args.concurrency, args.seed + 1)
+                    origin.reset()
+                    result = await measure(client, scenario, requests, args.concurrency, args.seed)
+                    if name == "proxy":
+                        result["upstream_requests"] = origin.requests
+                    results[name] = result
+                    report(name, result)
+
+    commit, dirty = git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "platform": platform.platform(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "dataset": {**library.summary(), "generate_seconds": round(generate_seconds, 2)},
+        "results": results,
+    }
+
+
+def report(name: str, result: dict):
+    line = (f"{name:<12} {result['requests_per_second']:9.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+            f"p99 {result['p99_ms']:8.2f} ms  {result['queries_per_request']:5.1f} queries/req")
+    if "items_per_second" in result:
+        line += f"  {result['items_per_second']:.0f} images/s"
+    if result["errors"]:
+        line += f"  {result['errors']} errors"
+    print(line)
+
+
+def compare(baseline: dict, current: dict):
+    print(f"\ncompared with {(baseline.get('commit') or 'unknown')[:12]}")
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric in ("requests_per_second", "p50_ms", "p99_ms", "queries_per_request"):
+            if before.get(metric):
+                changes.append(f"{metric} {(result[metric] / before[metric] - 1) * 100:+6.1f}%")
+        print(f"{name:<12} " + "  ".join(changes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    dataset.add_arguments(parser)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=SCENARIOS,
+                        help="comma separated, from " + ",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--bulk-requests", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=500, help="images per bulk request")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--payload", type=int, default=64 * 1024)
+    parser.add_argument("--origin-delay", type=float, default=0.005)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app reads these at import time
+        os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ["IMAGE_CACHE_DIR"] = os.path.join(tmp, "image_cache")
+        os.environ["PREFETCH_DEPTH"] = "0"
+        output = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if baseline:
+        compare(baseline, output)
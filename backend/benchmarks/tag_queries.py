@@ -0,0 +1,90 @@
+"""Tag-filtered listings, counts and random picks: SQL vs the bitmap tag index.
+
+    python -m benchmarks.tag_queries --images 200000 --tags 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import crud, migrations, models, schemas
+from app.database import create_engines
+from app.tag_index import tag_index
+
+
+def seed(engine, images: int, tags: int, per_image: int):
+    # Tag popularity follows a Zipf-like curve, like real libraries
+    rng = random.Random(1)
+    weights = [1 / (rank + 1) for rank in range(tags)]
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": 1, "username": "bench", "hashed_password": "x"}])
+        conn.execute(insert(models.Tag), [{"id": i + 1, "name": f"tag{i}"} for i in range(tags)])
+        for offset in range(0, images, 20000):
+            batch = range(offset, min(offset + 20000, images))
+            conn.execute(insert(models.Image), [
+                {"id": i + 1, "url": f"https://alist.example/d/IMG_{i:07d}.jpg", "filename": f"IMG_{i:07d}.jpg", "owner_id": 1}
+                for i in batch
+            ])
+            conn.execute(insert(models.ImageTagAssociation), [
+                {"image_id": i + 1, "tag_id": tag_id + 1}
+                for i in batch for tag_id in set(rng.choices(range(tags), weights, k=per_image))
+            ])
+
+
+async def timed(call, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def run(path: str, args):
+    engine, async_engine = create_engines(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    seed(engine, args.images, args.tags, args.per_image)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE")
+        conn.commit()
+
+    filters = [["tag0"], ["tag0", "tag1"], ["tag5", "tag20"], ["tag3", "tag40", "tag90"], [f"tag{args.tags - 1}"]]
+    async with async_sessionmaker(async_engine, expire_on_commit=False)() as db:
+        api_key = await crud.create_api_key(db, schemas.ApiKeyCreate(name="bench", tags_and=["tag1"], tags_or=["tag2", "tag3"]), user_id=1)
+        for label in ("SQL", "bitmap index"):
+            if label == "bitmap index":
+                await tag_index.build(db)
+                stats = tag_index.stats()
+                print(f"index built in {stats['build_seconds']:.2f} s, {stats['bytes'] / 1e6:.1f} MB")
+            print(label)
+            for tags in filters:
+                async def listing():
+                    crud.image_counts.forget_user(1)
+                    result = await crud.get_images(db, user_id=1, limit=20, tags=tags)
+                    db.expunge_all()
+                    return result
+                total = (await listing())["total"]
+                page = await timed(listing, args.repeat)
+                random_pick = await timed(lambda: crud.get_random_image(db, tags[0]), args.repeat)
+                print(f"  {'+'.join(tags):<22} {total:>7} matches  page+count {page:8.2f} ms  random {random_pick:7.2f} ms")
+            pool = await timed(lambda: crud._build_candidate_pool(db, api_key), args.repeat)
+            print(f"  candidate pool build {pool:8.2f} ms")
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=200000)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--per-image", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(os.path.join(tmp, "bench.db"), args))
@@ -55,6 +55,16 @@ export const deleteApiKey = async (id) => {
   return response.data;
 };
 
+export const updateApiKeyMode = async (id, mode) => {
+  const response = await apiClient.put(`/keys/${id}/mode`, { mode });
+  return response.data;
+};
+
+export const updateApiKeyPrefetch = async (id, prefetchDepth) => {
+  const response = await apiClient.put(`/keys/${id}/prefetch`, { prefetch_depth: prefetchDepth });
+  return response.data;
+};
+
 export const addImage = async (imageData) => {
   const response = await apiClient.post('/images/', imageData);
   return response.data;